@@ -0,0 +1,125 @@
+"""
+Benchmark concurrent clients against the WSGI and the ASGI server.
+
+Opens the given number of concurrent clients against each server for a
+fixed duration and reports requests per second and latency percentiles.
+With --slow each client dribbles its request out over that many seconds,
+like a client on a poor connection, which holds a synchronous worker
+for the whole time.
+
+Start both servers with the same number of workers first, e.g.
+  gunicorn imgapi.wsgi -w 4 -b :8000
+  uvicorn imgapi.asgi:application --workers 4 --port 8001
+
+Usage: python -m benchmarks.asgi --token KEY [--clients 10 100 1000]
+       [--duration 10] [--slow 0] [--wsgi-path image/]
+       [--asgi-path async/image/]
+"""
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+async def request(host, port, path, token, slow):
+    """Send a single GET and return its status, reading until close"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        head = (
+            f'GET /{path} HTTP/1.1\r\n'
+            f'Host: {host}\r\n'
+            f'Authorization: Token {token}\r\n'
+            'Connection: close\r\n'
+            '\r\n'
+        ).encode()
+        if slow:
+            # Hold back the end of the request like a slow client
+            writer.write(head[:-2])
+            await writer.drain()
+            await asyncio.sleep(slow)
+            writer.write(head[-2:])
+        else:
+            writer.write(head)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        while await reader.read(65536):
+            pass
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def client(host, port, path, token, slow, deadline, results):
+    """Send requests one after another until the deadline"""
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            status = await request(host, port, path, token, slow)
+        except (OSError, IndexError, ValueError):
+            status = None
+        results.append((status, time.monotonic() - start))
+
+
+async def run(url, path, token, clients, duration, slow):
+    parts = urlsplit(url)
+    deadline = time.monotonic() + duration
+    results = []
+    await asyncio.gather(*[
+        client(parts.hostname, parts.port or 80, path, token, slow,
+               deadline, results)
+        for _ in range(clients)
+    ])
+    return results
+
+
+def percentile(values, fraction):
+    """Value at the given fraction of the sorted values"""
+    if not values:
+        return float('nan')
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--wsgi', default='http://localhost:8000',
+                        help='base URL of the WSGI server')
+    parser.add_argument('--asgi', default='http://localhost:8001',
+                        help='base URL of the ASGI server')
+    parser.add_argument('--wsgi-path', default='image/',
+                        help='path requested from the WSGI server')
+    parser.add_argument('--asgi-path', default='async/image/',
+                        help='path requested from the ASGI server')
+    parser.add_argument('--token', required=True,
+                        help='API token sent with every request')
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[10, 100, 1000],
+                        help='numbers of concurrent clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per measurement')
+    parser.add_argument('--slow', type=float, default=0,
+                        help='seconds each client takes to send a request')
+    args = parser.parse_args()
+
+    servers = {
+        'wsgi': (args.wsgi, args.wsgi_path.lstrip('/')),
+        'asgi': (args.asgi, args.asgi_path.lstrip('/')),
+    }
+
+    print(f'{"clients":>8} {"server":>6} {"req/s":>9} {"errors":>7} '
+          f'{"p50 ms":>8} {"p99 ms":>8}')
+    for clients in args.clients:
+        for server, (url, path) in servers.items():
+            results = asyncio.run(run(url, path, args.token, clients,
+                                      args.duration, args.slow))
+            latencies = sorted(latency for status, latency in results
+                               if status == 200)
+            errors = len(results) - len(latencies)
+            print(f'{clients:>8} {server:>6} '
+                  f'{len(latencies) / args.duration:>9.1f} {errors:>7} '
+                  f'{percentile(latencies, 0.5) * 1000:>8.1f} '
+                  f'{percentile(latencies, 0.99) * 1000:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
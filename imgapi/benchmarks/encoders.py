@@ -0,0 +1,108 @@
+"""
+Benchmark thumbnail encoder profiles against Pillow's defaults.
+
+Encodes 400px thumbnails of a photo-like and a screenshot-like image,
+or of every image in --corpus, in each output format Pillow can write,
+and reports encode time and size per profile. Times are the best of
+--runs, a median row is added for larger corpora.
+
+Usage: python -m benchmarks.encoders [--corpus DIR] [--runs 3]
+"""
+import argparse
+import io
+import os
+import statistics
+import time
+
+from PIL import Image, ImageDraw
+
+import django
+from django.conf import settings
+
+from core import formats, pipeline
+
+HEIGHT = 400
+
+
+def synthetic_corpus():
+    """A noisy photo-like and a flat screenshot-like image"""
+    noise = Image.effect_noise((1600, 1200), 48)
+    photo = Image.merge('RGB', (noise, noise.rotate(180), noise))
+    photo = photo.resize((800, 600)).resize((1600, 1200))
+
+    screenshot = Image.new('RGB', (1600, 1200), 'white')
+    draw = ImageDraw.Draw(screenshot)
+    for top in range(40, 1200, 60):
+        draw.rectangle((40, top, 1560, top + 30), fill=(230, 236, 245))
+        draw.text((60, top + 8), 'Lorem ipsum dolor sit amet ' * 6,
+                  fill='black')
+    return {'photo': photo, 'screenshot': screenshot}
+
+
+def load_corpus(directory):
+    corpus = {}
+    for name in sorted(os.listdir(directory)):
+        try:
+            with Image.open(os.path.join(directory, name)) as img:
+                corpus[name] = img.convert('RGB')
+        except OSError:
+            continue
+    return corpus
+
+
+def thumbnail(img):
+    width = pipeline.get_desired_width(img.width, img.height, HEIGHT)
+    return img.resize((width, HEIGHT), Image.LANCZOS)
+
+
+def encode(img, img_format, options, runs):
+    """Encode one thumbnail, return the best time in ms and its bytes"""
+    best = None
+    for _ in range(runs):
+        output = io.BytesIO()
+        start = time.perf_counter()
+        pipeline.save_thumbnail(img, output, img_format, dict(options))
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--corpus',
+                        help='directory of images, synthetic if omitted')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='encodes per image, the fastest is reported')
+    args = parser.parse_args()
+
+    # Profiles as configured, DJANGO_SETTINGS_MODULE and overrides apply
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'imgapi.settings')
+    django.setup()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus()
+    thumbnails = {name: thumbnail(img) for name, img in corpus.items()}
+    profiles = {'default': {}, **settings.THUMBNAIL_ENCODER_PROFILES}
+
+    print(f'{"image":>12} {"format":>6} {"profile":>9} '
+          f'{"ms":>8} {"KiB":>8}')
+    for img_format in formats.EXTENSIONS:
+        if not formats.can_save(img_format):
+            continue
+        for profile, options in profiles.items():
+            options = options.get(img_format, {})
+            results = {
+                name: encode(img, img_format, options, args.runs)
+                for name, img in thumbnails.items()
+            }
+            for name, (ms, size) in results.items():
+                print(f'{name[:12]:>12} {img_format:>6} {profile:>9} '
+                      f'{ms:>8.1f} {size / 1024:>8.1f}')
+            if len(results) > 2:
+                ms = statistics.median(ms for ms, _ in results.values())
+                size = statistics.median(size for _, size in results.values())
+                print(f'{"median":>12} {img_format:>6} {profile:>9} '
+                      f'{ms:>8.1f} {size / 1024:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Benchmark thumbnail rendering before and after the resize pipeline.
+
+Renders the Enterprise heights (200 and 400) for synthetic 12-50 MP
+JPEGs and reports CPU time and peak RSS per image. Every measurement
+runs in a fresh process so peak RSS is not shared between runs.
+
+Usage: python -m benchmarks.thumbnails [--sizes 12 24 50] [--runs 3]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+
+from PIL import Image
+
+from core import pipeline
+
+HEIGHTS = [200, 400]
+ASPECT = 4 / 3
+
+
+def legacy_render(path, heights):
+    """Render thumbnails the way UserImage.get_thumbnails used to"""
+    thumbnails = []
+    for height in heights:
+        with Image.open(path) as img:
+            img_copy = img.copy()
+            w, h = img_copy.size
+            width = pipeline.get_desired_width(w, h, height)
+            img_copy.thumbnail((width, height))
+            thumbnails.append((height, img_copy))
+    return thumbnails
+
+
+RENDERERS = {
+    'before': legacy_render,
+    'after': pipeline.render_thumbnails,
+}
+
+
+def create_jpeg(directory, megapixels):
+    """Create a noisy JPEG of roughly the given megapixels"""
+    height = int((megapixels * 1_000_000 / ASPECT) ** 0.5)
+    width = int(height * ASPECT)
+    path = os.path.join(directory, f'{megapixels}mp.jpg')
+    noise = Image.effect_noise((width, height), 64)
+    Image.merge('RGB', (noise, noise.rotate(180), noise)).save(
+        path, format='JPEG', quality=90
+    )
+    return path
+
+
+def peak_rss():
+    """
+    Peak RSS of this process in MiB. VmHWM is used where available
+    because ru_maxrss survives fork and would report the parent's peak.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(renderer, path, output_dir, queue):
+    """
+    Render and encode thumbnails, report CPU seconds and the peak RSS
+    of the whole process (an idle interpreter with Pillow is ~20 MiB)
+    """
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    for height, img in RENDERERS[renderer](path, HEIGHTS):
+        img.save(os.path.join(output_dir, f'{height}.jpg'), format='JPEG')
+    end = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu = (end.ru_utime - start.ru_utime) + (end.ru_stime - start.ru_stime)
+    queue.put((cpu, peak_rss()))
+
+
+def run(renderer, path, output_dir):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure,
+                              args=(renderer, path, output_dir, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[12, 24, 50],
+                        help='input sizes in megapixels')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='runs per input, the best one is reported')
+    args = parser.parse_args()
+
+    print(f'{"input":>8} {"renderer":>9} {"cpu s":>8} {"peak MiB":>9}')
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in args.sizes:
+            path = create_jpeg(directory, megapixels)
+            for renderer in RENDERERS:
+                cpu, rss = min(run(renderer, path, directory)
+                               for _ in range(args.runs))
+                print(f'{megapixels:>6}MP {renderer:>9} '
+                      f'{cpu:>8.3f} {rss:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
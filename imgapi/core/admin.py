@@ -44,5 +44,10 @@ class UserAdmin(BaseUserAdmin):
 
 # Register your models here.
 admin.site.register(models.User, UserAdmin)
+admin.site.register(models.Blob)
 admin.site.register(models.UserImage)
-admin.site.register(models.ExpiringLink)
\ No newline at end of file
+admin.site.register(models.Thumbnail)
+admin.site.register(models.ThumbnailJob)
+admin.site.register(models.ExpiringLink)
+admin.site.register(models.RevokedLink)
+admin.site.register(models.UploadSession)
@@ -0,0 +1,154 @@
+"""
+Async views of the hot read endpoints, served under /async/ and meant
+for an ASGI server (see imgapi/asgi.py). They use the async ORM and
+render thumbnails in a worker thread, so a worker is not held by a slow
+client or by Pillow. Responses match their DRF counterparts in
+core.views.
+
+File bytes are still read by Django's ASGI handler between sends, set
+SENDFILE_BACKEND to have the proxy send large files instead.
+"""
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views import View
+
+from asgiref.sync import sync_to_async
+
+from rest_framework.exceptions import APIException, NotAuthenticated
+
+from core.models import (
+    UserImage,
+    ExpiringLink,
+)
+
+from . import encoders, formats, list_cache, sendfile, serializers
+from .authentication import CachedTokenAuthentication
+from .link_cache import ResolvedLink, get_link_cache
+from .pagination import KeysetPagination
+from .views import thumbnail_response, vary_thumbnail
+
+
+def error_response(exc):
+    """Render an API exception like DRF's exception handler does"""
+    response = JsonResponse({'detail': exc.detail}, status=exc.status_code)
+    if exc.status_code == 401:
+        response.headers['WWW-Authenticate'] = 'Token'
+    return response
+
+
+def not_found():
+    return JsonResponse({'detail': 'Not found.'}, status=404)
+
+
+class AsyncAPIView(View):
+    """Authenticate the request token before dispatching"""
+    authentication = CachedTokenAuthentication()
+    require_user = True
+
+    async def dispatch(self, request, *args, **kwargs):
+        if self.require_user:
+            try:
+                resolved = await self.authentication.aauthenticate(request)
+                if resolved is None:
+                    raise NotAuthenticated()
+            except APIException as exc:
+                return error_response(exc)
+            request.user, request.auth = resolved
+
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncUserImageListView(AsyncAPIView):
+    """List images"""
+
+    async def get(self, request):
+        key = await sync_to_async(list_cache.get_key)(
+            request.user.pk, request.build_absolute_uri()
+        )
+        data = await sync_to_async(list_cache.get_page)(key)
+        if data is not None:
+            return JsonResponse(data)
+
+        paginator = KeysetPagination()
+        queryset = UserImage.objects.filter(
+            user=request.user
+        ).only(
+            'id', 'name', 'image', 'width', 'height', 'when_created'
+        ).prefetch_related('thumbnails')
+
+        try:
+            queryset = paginator.get_page_queryset(queryset, request)
+        except APIException as exc:
+            return error_response(exc)
+        page = paginator.get_page([image async for image in queryset])
+
+        serializer = serializers.UserImageListSerializer(
+            page,
+            many=True,
+            context={
+                'request': request,
+                'thumbnail_heights': request.user.thumbnail_heights,
+                'encoder_profile': encoders.get_profile(request.user),
+                'original_link': request.user.has_original_link,
+            },
+        )
+        # Listing may schedule missing thumbnails, which writes
+        results = await sync_to_async(lambda: serializer.data)()
+
+        data = {'next': paginator.get_next_link(), 'results': results}
+        await sync_to_async(list_cache.set_page)(key, data)
+        return JsonResponse(data)
+
+
+class AsyncUserImageThumbnailView(AsyncAPIView):
+    """Serve a thumbnail, rendering it on the first request"""
+
+    async def get(self, request, id, height):
+        if height not in request.user.thumbnail_heights:
+            return not_found()
+
+        try:
+            image = await UserImage.objects.aget(user=request.user, pk=id)
+        except UserImage.DoesNotExist:
+            return not_found()
+
+        thumbnail = await image.aget_thumbnail(
+            height,
+            formats.negotiate(request, image.image_format),
+            encoders.get_profile(request.user),
+        )
+        return thumbnail_response(request, thumbnail)
+
+
+class AsyncExpiringLinkDetailView(AsyncAPIView):
+    """Serve the image of an expiring link"""
+    require_user = False
+
+    async def get(self, request, id):
+        img_format = formats.negotiate(request, None)
+
+        async def resolve():
+            instance = await ExpiringLink.objects.live().select_related(
+                'image__user'
+            ).aget(pk=id)
+            return ResolvedLink(
+                await instance.image.aget_variant_name(instance.height,
+                                                       img_format),
+                instance.height,
+                instance.expires_at,
+            )
+
+        try:
+            link = await get_link_cache().aget_or_resolve((id, img_format),
+                                                          resolve)
+        except ExpiringLink.DoesNotExist:
+            return not_found()
+
+        remaining = link.expires_at - timezone.now()
+        response = sendfile.serve_file(
+            request,
+            link.name,
+            max_age=int(remaining.total_seconds()),
+            content_type=formats.get_mime_type(link.name),
+        )
+        return vary_thumbnail(response, link.height)
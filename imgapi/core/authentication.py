@@ -0,0 +1,115 @@
+"""
+Authentication
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.cache import caches
+
+from rest_framework.authentication import TokenAuthentication
+
+CACHE_KEY_PREFIX = 'auth-token:'
+
+
+class TokenCache:
+    """
+    In-process LRU of resolved tokens whose entries expire after `ttl`
+    seconds. Deletes only reach the LRU of the process making them,
+    other processes accept a deleted token until their entry expires.
+    With a Django cache alias the LRU is bypassed and entries are kept
+    only there, so a delete reaches every process at once.
+    """
+    def __init__(self, size, ttl, cache_alias=None):
+        self.size = size
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias] if self.cache_alias else None
+
+    def get(self, key):
+        if self.shared is not None:
+            return self.shared.get(CACHE_KEY_PREFIX + key)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    return value
+                del self.entries[key]
+
+        return None
+
+    def set(self, key, value):
+        if self.shared is not None:
+            self.shared.set(CACHE_KEY_PREFIX + key, value, self.ttl)
+        else:
+            self.set_local(key, value)
+
+    def set_local(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        if self.shared is not None:
+            self.shared.delete(CACHE_KEY_PREFIX + key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """Get the process-wide token cache, created on first use"""
+    global _token_cache
+    with _token_cache_lock:
+        if _token_cache is None:
+            config = settings.AUTH_TOKEN_CACHE
+            _token_cache = TokenCache(config['SIZE'],
+                                      config['TTL'],
+                                      config.get('CACHE'))
+    return _token_cache
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication that skips the Token + User query for tokens
+    resolved recently. Entries are dropped by signals when the token is
+    deleted or its user changes, see core.signals.
+    """
+    def authenticate_credentials(self, key):
+        token_cache = get_token_cache()
+        cached = token_cache.get(key)
+        if cached is None:
+            cached = super().authenticate_credentials(key)
+            token_cache.set(key, cached)
+
+        # Requests get their own copy, they may modify the user
+        user, token = cached
+        return copy.copy(user), token
+
+    async def aauthenticate(self, request):
+        """
+        Async authenticate for plain Django async views. Cached tokens
+        are still resolved without a query, misses query in a thread.
+        """
+        return await sync_to_async(self.authenticate)(request)
@@ -0,0 +1,109 @@
+"""
+Batch image uploads.
+
+Files are validated, hashed and their metadata read on a thread pool,
+Pillow releases the GIL while it reads them. Database work stays on
+the request thread: the blobs are created and locked in one
+transaction, new content is written to storage on the pool meanwhile,
+then the images and their pending thumbnails are inserted with
+bulk_create.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import get_error_detail
+
+from core import list_cache, pipeline, serializers, tasks
+from core.models import Blob, Thumbnail, UserImage
+
+
+def check(field, file):
+    """
+    Validate an uploaded file, returning its digest and metadata, or
+    None and the errors
+    """
+    try:
+        field.run_validation(file)
+    except ValidationError as exc:
+        return None, exc.detail
+    except DjangoValidationError as exc:
+        return None, get_error_detail(exc)
+
+    metadata = pipeline.read_metadata(file)
+    metadata['size'] = file.size
+    return (Blob.objects.get_digest(file), metadata), None
+
+
+def create_images(user, files):
+    """
+    Create an image of each uploaded file that is valid, named after
+    the file. Returns a result per file with its status code.
+    """
+    tasks.check_capacity()
+    field = serializers.UserImageCreateSerializer().fields['image']
+    heights = user.thumbnail_heights
+
+    results = []
+    accepted = []
+    metadata = []
+    with ThreadPoolExecutor(max_workers=settings.BATCH_UPLOAD_WORKERS,
+                            thread_name_prefix='batch') as executor:
+        checks = executor.map(lambda file: check(field, file), files)
+        for file, (checked, errors) in zip(files, checks):
+            if errors is None:
+                digest, file_metadata = checked
+                extension = os.path.splitext(file.name)[1].lower()
+                accepted.append((file, digest, extension))
+                metadata.append(file_metadata)
+            else:
+                results.append({
+                    'file': file.name,
+                    'status': status.HTTP_400_BAD_REQUEST,
+                    'errors': errors,
+                })
+
+        if not accepted:
+            return results
+
+        with transaction.atomic():
+            blobs = Blob.objects.store_many(accepted, executor)
+            images = UserImage.objects.bulk_create([
+                UserImage(user=user,
+                          name=os.path.splitext(file.name)[0],
+                          image=blob.file.name,
+                          blob=blob,
+                          **file_metadata)
+                for (file, _, _), blob, file_metadata in zip(accepted,
+                                                             blobs,
+                                                             metadata)
+            ])
+            Thumbnail.objects.bulk_create([
+                Thumbnail(image=image,
+                          height=height,
+                          format=image.image_format,
+                          status=Thumbnail.PENDING)
+                for image in images
+                for height in heights
+            ])
+            for image in images:
+                tasks.enqueue(image.pk, heights)
+            # bulk_create sends no signals
+            list_cache.invalidate(user.pk)
+
+    prefetch_related_objects(images, 'thumbnails')
+    data = serializers.UserImageCreateSerializer(images, many=True).data
+    for (file, _, _), image_data in zip(accepted, data):
+        results.append({
+            'file': file.name,
+            'status': status.HTTP_201_CREATED,
+            'image': image_data,
+        })
+
+    return results
@@ -0,0 +1,24 @@
+"""
+Thumbnail encoder profiles.
+
+THUMBNAIL_ENCODER_PROFILES names sets of encoder options per output
+format, TIER_ENCODER_PROFILES picks one per user tier. Thumbnail files
+are named after their profile, so thumbnails shared by images of users
+in different tiers don't overwrite each other.
+"""
+from django.conf import settings
+
+DEFAULT_PROFILE = 'standard'
+
+
+def get_profile(user):
+    """Get the name of the encoder profile of a user's tier"""
+    return settings.TIER_ENCODER_PROFILES.get(user.user_tier,
+                                              DEFAULT_PROFILE)
+
+
+def get_options(profile, img_format):
+    """Get the encoder options of a profile for a format"""
+    profiles = settings.THUMBNAIL_ENCODER_PROFILES
+    options = profiles.get(profile, profiles[DEFAULT_PROFILE])
+    return options.get(img_format, {})
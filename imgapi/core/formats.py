@@ -0,0 +1,83 @@
+"""
+Thumbnail output formats negotiated from the Accept header.
+
+THUMBNAIL_FORMATS lists the formats offered besides the original's, in
+order of preference. Formats the installed Pillow can't write are left
+out, AVIF needs a build or plugin supporting it.
+"""
+import os
+from functools import lru_cache
+
+from django.conf import settings
+
+from PIL import Image
+
+EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+    'AVIF': '.avif',
+}
+MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+}
+
+
+def get_mime_type(name):
+    """
+    Get the media type of a stored file from its extension, None if it
+    is not one of the output formats
+    """
+    extension = os.path.splitext(name)[1].lower()
+    for img_format, format_extension in EXTENSIONS.items():
+        if extension == format_extension:
+            return MIME_TYPES[img_format]
+    return None
+
+
+@lru_cache
+def can_save(img_format):
+    """Check if Pillow can write a format"""
+    Image.init()
+    return img_format in Image.SAVE
+
+
+def get_offered_formats():
+    return [
+        img_format for img_format in settings.THUMBNAIL_FORMATS
+        if can_save(img_format)
+    ]
+
+
+def parse_accept(header):
+    """Get the media types of an Accept header with their q values"""
+    accepted = {}
+    for part in (header or '').split(','):
+        media_type, *params = part.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[media_type.strip().lower()] = quality
+    return accepted
+
+
+def negotiate(request, default):
+    """
+    Pick the format to serve a thumbnail in: the first offered format
+    the client names, otherwise `default`, the original's format.
+    Wildcards don't count, clients send */* without decoding every
+    format.
+    """
+    accepted = parse_accept(request.headers.get('Accept'))
+    for img_format in get_offered_formats():
+        if accepted.get(MIME_TYPES[img_format], 0) > 0:
+            return img_format
+    return default
@@ -0,0 +1,138 @@
+"""
+In-process micro-cache of resolved expiring links.
+
+A publicly shared link is requested by many clients at once. The
+stored file a link serves is kept for EXPIRING_LINK_CACHE TTL seconds,
+never past the link's expiry, so a hot link costs about one query per
+TTL and process. Concurrent misses of a link wait for the first one to
+resolve it instead of querying themselves, in threads and in the event
+loop alike.
+
+Deleted links are dropped by a signal, see core.signals. Other
+processes keep serving a deleted link for at most the TTL.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from core import formats
+
+ResolvedLink = namedtuple('ResolvedLink', ['name', 'height', 'expires_at'])
+
+
+class LinkCache:
+    """
+    LRU of resolved links keyed by link id and negotiated format, None
+    for the original's format. Entries expire after `ttl` seconds or
+    with their link, whichever is first.
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Key -> [lock held while resolving, requests using it]
+        self.resolving = {}
+        # Same for async requests, only used from the event loop
+        self.aresolving = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            link, expires = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                return link
+            del self.entries[key]
+            return None
+
+    def set(self, key, link):
+        remaining = (link.expires_at - timezone.now()).total_seconds()
+        ttl = min(self.ttl, remaining)
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (link, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get_or_resolve(self, key, resolve):
+        """
+        Get a cached link, or resolve and cache it. Requests missing the
+        same key at once wait for a single call of `resolve`.
+        """
+        link = self.get(key)
+        if link is not None:
+            return link
+
+        with self.lock:
+            resolving = self.resolving.setdefault(key, [threading.Lock(), 0])
+            resolving[1] += 1
+        try:
+            with resolving[0]:
+                link = self.get(key)
+                if link is None:
+                    link = resolve()
+                    self.set(key, link)
+        finally:
+            with self.lock:
+                resolving[1] -= 1
+                if not resolving[1]:
+                    del self.resolving[key]
+
+        return link
+
+    async def aget_or_resolve(self, key, resolve):
+        """
+        Async get_or_resolve, `resolve` is a coroutine function. Waiting
+        requests yield to the event loop until it returns.
+        """
+        link = self.get(key)
+        if link is not None:
+            return link
+
+        resolving = self.aresolving.setdefault(key, [asyncio.Lock(), 0])
+        resolving[1] += 1
+        try:
+            async with resolving[0]:
+                link = self.get(key)
+                if link is None:
+                    link = await resolve()
+                    self.set(key, link)
+        finally:
+            resolving[1] -= 1
+            if not resolving[1]:
+                del self.aresolving[key]
+
+        return link
+
+    def delete(self, link_id):
+        """Drop a link in every format"""
+        with self.lock:
+            for img_format in [None, *formats.EXTENSIONS]:
+                self.entries.pop((link_id, img_format), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_link_cache = None
+_link_cache_lock = threading.Lock()
+
+
+def get_link_cache():
+    """Get the process-wide link cache, created on first use"""
+    global _link_cache
+    with _link_cache_lock:
+        if _link_cache is None:
+            config = settings.EXPIRING_LINK_CACHE
+            _link_cache = LinkCache(config['SIZE'], config['TTL'])
+    return _link_cache
@@ -0,0 +1,98 @@
+"""
+Versioned per-user cache of image list responses.
+
+Pages are cached under the user's current version and the request URL,
+so a page is built once until something it shows changes. Changes call
+invalidate, which gives the user a new version and orphans every page
+cached under the old one; orphans expire after IMAGE_LIST_CACHE TTL.
+Versions are random tokens rather than counters, so a version evicted
+from the cache is never reissued.
+
+Signals invalidate on saved and deleted images, thumbnails and users,
+see core.signals. Bulk writes and queryset updates must call invalidate
+themselves.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+VERSION_KEY_PREFIX = 'image-list-version:'
+PAGE_KEY_PREFIX = 'image-list:'
+
+
+def get_cache():
+    """Get the configured cache, None if list caching is disabled"""
+    alias = settings.IMAGE_LIST_CACHE['CACHE']
+    return caches[alias] if alias else None
+
+
+def get_version(cache, user_id):
+    version_key = f'{VERSION_KEY_PREFIX}{user_id}'
+    version = cache.get(version_key)
+    if version is None:
+        # Another request may set it first, then use that one
+        cache.add(version_key, uuid.uuid4().hex, None)
+        version = cache.get(version_key)
+    return version
+
+
+def get_key(user_id, url):
+    """
+    Get the key of a page, or None if caching is disabled. Read it
+    before building the page, so a change meanwhile is not missed.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+    version = get_version(cache, user_id)
+    url_hash = hashlib.sha256(url.encode()).hexdigest()
+    return f'{PAGE_KEY_PREFIX}{user_id}:{version}:{url_hash}'
+
+
+def get_page(key):
+    if key is None:
+        return None
+    return get_cache().get(key)
+
+
+def is_pending(data):
+    """Check whether thumbnails on a page are still being rendered"""
+    from core.models import Thumbnail
+
+    return any(thumbnail['status'] == Thumbnail.PENDING
+               for image in data['results']
+               for thumbnail in image['thumbnails'])
+
+
+def set_page(key, data):
+    """
+    Cache a page, unless it lists pending thumbnails, which change it
+    once rendered
+    """
+    if key is not None and not is_pending(data):
+        get_cache().set(key, data, settings.IMAGE_LIST_CACHE['TTL'])
+
+
+def bump(user_ids):
+    cache = get_cache()
+    if cache is not None:
+        cache.set_many({
+            f'{VERSION_KEY_PREFIX}{user_id}': uuid.uuid4().hex
+            for user_id in user_ids
+        }, None)
+
+
+def invalidate(*user_ids):
+    """
+    Drop the cached pages of users. Done again on commit: a page built
+    from the database before the change committed may be cached under
+    the new version meanwhile.
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+    bump(user_ids)
+    transaction.on_commit(lambda: bump(user_ids))
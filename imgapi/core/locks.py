@@ -0,0 +1,42 @@
+"""
+Single-flight locks for rendering thumbnail variants.
+
+A variant is locked with flock on one of THUMBNAIL_LOCK_STRIPES lock
+files under MEDIA_ROOT, picked by hashing its storage name, so workers
+of every process sharing the media volume render it once. Lock files
+are never deleted, a lock on a deleted file would not be seen by the
+next worker.
+"""
+import fcntl
+import hashlib
+import os
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+
+LOCK_DIR = '.locks'
+
+
+def get_stripe(name):
+    """Get the lock stripe of a storage name"""
+    digest = hashlib.sha1(name.encode()).digest()
+    return int.from_bytes(digest[:4], 'big') % settings.THUMBNAIL_LOCK_STRIPES
+
+
+@contextmanager
+def variant_locks(names):
+    """
+    Hold the locks of the given storage names, blocking until they are
+    free. Renders locking overlapping variants wait for each other, but
+    stripes are taken once each and in order, so they never deadlock.
+    """
+    lock_dir = os.path.join(settings.MEDIA_ROOT, LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    with ExitStack() as stack:
+        for stripe in sorted({get_stripe(name) for name in names}):
+            lock_file = stack.enter_context(
+                open(os.path.join(lock_dir, f'{stripe}.lock'), 'a')
+            )
+            # Released when the file is closed
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
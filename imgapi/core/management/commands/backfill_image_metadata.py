@@ -0,0 +1,82 @@
+"""
+Custom command to read the metadata of images uploaded before it was
+stored. Only headers are read, images sharing a blob are read once per
+batch. Rows are updated in batches, the command can be stopped and
+rerun.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import list_cache, pipeline
+from core.models import UserImage
+
+
+class Command(BaseCommand):
+    """Command to backfill image metadata"""
+    help = ('Store the dimensions, format, size and EXIF orientation of '
+            'images uploaded without them, in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows updated per batch',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help='Seconds to wait between batches',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        images = UserImage.objects.filter(width__isnull=True).only(
+            'id', 'image', 'user'
+        ).order_by('pk')
+        updated = failed = 0
+        last = None
+        while True:
+            batch = images
+            if last is not None:
+                batch = batch.filter(pk__gt=last)
+            batch = list(batch[:options['batch_size']])
+            if not batch:
+                break
+
+            read = {}
+            changed = []
+            for image in batch:
+                name = image.image.name
+                if name not in read:
+                    read[name] = self.read(image)
+                if read[name] is None:
+                    failed += 1
+                    continue
+                for field, value in read[name].items():
+                    setattr(image, field, value)
+                changed.append(image)
+
+            UserImage.objects.bulk_update(changed,
+                                          UserImage.METADATA_FIELDS)
+            list_cache.invalidate(*(image.user_id for image in changed))
+            updated += len(changed)
+            last = batch[-1].pk
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(f'Updated {updated} images, {failed} unreadable')
+        self.stdout.write(self.style.SUCCESS('Image metadata backfilled!'))
+
+    def read(self, image):
+        """Read the metadata of an original, None if it can't be read"""
+        storage = image.image.storage
+        try:
+            metadata = pipeline.read_metadata(storage.path(image.image.name))
+            metadata['size'] = storage.size(image.image.name)
+        except OSError as error:
+            self.stderr.write(f'Skipping image {image.pk}: {error}')
+            return None
+        return metadata
@@ -0,0 +1,97 @@
+"""
+Custom command to render queued thumbnails.
+Any number of workers can run side by side, each job is claimed by
+exactly one of them.
+"""
+import logging
+import signal
+import time
+
+from psycopg2 import OperationalError as Psycopg2Error
+
+from django.db import close_old_connections, connection
+from django.db.utils import DatabaseError, InterfaceError, OperationalError
+from django.core.management.base import BaseCommand
+
+from core import tasks
+
+logger = logging.getLogger(__name__)
+
+# Longest wait after repeated database errors while running jobs
+MAX_ERROR_DELAY = 60
+
+
+class Command(BaseCommand):
+    """Command to drain the thumbnail job queue"""
+    help = 'Render queued thumbnails until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once the queue is empty',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the queue is empty',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        self.stopping = False
+        handlers = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            self.process(options['once'], options['poll_interval'])
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def process(self, once, poll_interval):
+        """Claim and run jobs until stopped"""
+        self.stdout.write('Processing thumbnail jobs...')
+        processed = failed = errors = 0
+        while not self.stopping:
+            close_old_connections()
+            try:
+                job = tasks.claim_job()
+            except (Psycopg2Error, OperationalError):
+                self.stdout.write('Database unavailable, waiting 1 second...')
+                time.sleep(1)
+                continue
+
+            if job is None:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            try:
+                done = tasks.run_job(job)
+            except (DatabaseError, InterfaceError):
+                # The job's lock expires and a later claim retries it
+                logger.exception('Database error running thumbnail job %s',
+                                 job.pk)
+                connection.close()
+                failed += 1
+                errors += 1
+                time.sleep(min(2 ** (errors - 1), MAX_ERROR_DELAY))
+                continue
+
+            errors = 0
+            if done:
+                processed += 1
+            else:
+                failed += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {processed} jobs, {failed} failed'
+        ))
+
+    def stop(self, signum, frame):
+        """Finish the current job, then exit"""
+        self.stopping = True
@@ -0,0 +1,57 @@
+"""
+Custom command to delete expired links and uploads.
+Rows are deleted in small batches so locks are only held briefly.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import ExpiringLink, RevokedLink, UploadSession
+
+
+class Command(BaseCommand):
+    """Command to purge expired links"""
+    help = ('Delete expired expiring links, revocations and upload '
+            'sessions in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows deleted per transaction',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help='Seconds to wait between batches',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        now = timezone.now()
+        for model in (ExpiringLink, RevokedLink, UploadSession):
+            deleted = self.purge(model, now, options)
+            self.stdout.write(
+                f'Deleted {deleted} expired {model._meta.verbose_name}s'
+            )
+
+        self.stdout.write(self.style.SUCCESS('Expired links purged!'))
+
+    def purge(self, model, now, options):
+        """Delete expired rows of a model batch by batch"""
+        expired = model.objects.filter(
+            expires_at__lte=now
+        ).values_list('pk', flat=True)
+        deleted = 0
+        while True:
+            batch = list(expired[:options['batch_size']])
+            if not batch:
+                return deleted
+
+            model.objects.filter(pk__in=batch).delete()
+            deleted += len(batch)
+            if options['pause']:
+                time.sleep(options['pause'])
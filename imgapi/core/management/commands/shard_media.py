@@ -0,0 +1,136 @@
+"""
+Custom command to move stored media into the sharded layout.
+Files are moved before their rows are rewritten, a file already at its
+new name is not moved again, so the command can be stopped and rerun.
+"""
+import os
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Replace
+
+from core import list_cache
+from core.models import Blob, UserImage, Thumbnail
+
+
+def move(storage, old_name, new_name):
+    """Move a stored file unless it was moved already"""
+    old_path = storage.path(old_name)
+    new_path = storage.path(new_name)
+    if os.path.exists(old_path) and not os.path.exists(new_path):
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(old_path, new_path)
+
+
+class Command(BaseCommand):
+    """Command to shard stored media"""
+    help = ('Move originals and thumbnails into hashed subdirectories '
+            'and rewrite their names in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows read per batch',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help='Seconds to wait between batches',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        storage = default_storage
+
+        moved = 0
+        for blob in self.batches(Blob.objects.all(), options):
+            moved += self.shard_blob(storage, blob)
+        self.stdout.write(f'Moved {moved} blobs')
+
+        moved = 0
+        images = UserImage.objects.filter(blob__isnull=True)
+        for image in self.batches(images, options):
+            moved += self.shard_image(storage, image)
+        self.stdout.write(f'Moved {moved} images')
+
+        self.stdout.write(self.style.SUCCESS('Media sharded!'))
+
+    def batches(self, queryset, options):
+        """Iterate over rows in primary key order, a batch at a time"""
+        queryset = queryset.order_by('pk')
+        last = None
+        while True:
+            batch = queryset
+            if last is not None:
+                batch = batch.filter(pk__gt=last)
+            batch = list(batch[:options['batch_size']])
+            if not batch:
+                return
+
+            yield from batch
+            last = batch[-1].pk
+            if options['pause']:
+                time.sleep(options['pause'])
+
+    def shard_blob(self, storage, blob):
+        """Move a blob with its thumbnails, rewriting its images"""
+        old_name = blob.file.name
+        new_name = storage.generate_filename(old_name)
+        if new_name == old_name:
+            return 0
+
+        old_dir = f'thumbnails/{blob.sha256}'
+        new_dir = Blob.get_thumbnail_dir(blob.sha256, storage)
+        move(storage, old_name, new_name)
+        if storage.exists(old_dir):
+            for name in storage.listdir(old_dir)[1]:
+                move(storage, f'{old_dir}/{name}', f'{new_dir}/{name}')
+
+        with transaction.atomic():
+            Blob.objects.filter(pk=blob.pk).update(file=new_name)
+            images = UserImage.objects.filter(blob=blob)
+            list_cache.invalidate(*images.values_list('user_id', flat=True))
+            images.update(image=new_name)
+            Thumbnail.objects.filter(image__blob=blob).update(
+                file=Replace('file', Value(old_dir + '/'),
+                             Value(new_dir + '/')),
+                source=new_name,
+            )
+
+        try:
+            os.rmdir(storage.path(old_dir))
+        except OSError:
+            pass
+        return 1
+
+    def shard_image(self, storage, image):
+        """Move an image stored before blobs, with its thumbnails"""
+        old_name = image.image.name
+        new_name = storage.generate_filename(old_name)
+        if new_name == old_name:
+            return 0
+
+        thumbnails = list(image.thumbnails.exclude(file=''))
+        move(storage, old_name, new_name)
+        image.image.name = new_name
+        for thumbnail in thumbnails:
+            old_thumbnail = thumbnail.file.name
+            thumbnail.file.name = image.get_thumbnail_name(
+                thumbnail.height,
+                thumbnail.format,
+                thumbnail.profile,
+            )
+            thumbnail.source = new_name
+            move(storage, old_thumbnail, thumbnail.file.name)
+
+        with transaction.atomic():
+            UserImage.objects.filter(pk=image.pk).update(image=new_name)
+            Thumbnail.objects.bulk_update(thumbnails, ['file', 'source'])
+            list_cache.invalidate(image.user_id)
+        return 1
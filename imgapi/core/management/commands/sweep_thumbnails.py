@@ -0,0 +1,91 @@
+"""
+Custom command to keep thumbnail files within THUMBNAIL_CACHE_QUOTA.
+The least recently served files are deleted first and their thumbnails
+marked as evicted, listing or requesting one renders it again. A file
+shared by the images of a blob counts once, as recently as its latest
+access.
+"""
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, Max
+from django.utils import timezone
+
+from core import list_cache, locks
+from core.models import Thumbnail
+
+
+class Command(BaseCommand):
+    """Command to evict thumbnails over the quota"""
+    help = ('Delete the least recently served thumbnail files until the '
+            'rest fits in THUMBNAIL_CACHE_QUOTA bytes')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--quota',
+            type=int,
+            default=None,
+            help='Bytes to keep, THUMBNAIL_CACHE_QUOTA if omitted',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be evicted without deleting',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        quota = options['quota']
+        if quota is None:
+            quota = settings.THUMBNAIL_CACHE_QUOTA
+        if quota is None:
+            raise CommandError('Set THUMBNAIL_CACHE_QUOTA or pass --quota')
+
+        started = timezone.now()
+        files = Thumbnail.objects.filter(
+            status=Thumbnail.READY,
+        ).values('file').annotate(
+            file_size=Max('size'),
+            accessed=Max('last_accessed'),
+        )
+        total = sum(row['file_size'] or 0 for row in files.iterator())
+        self.stdout.write(f'{total} bytes of thumbnails stored')
+
+        # Picked before deleting, rows are not updated while iterated
+        candidates = []
+        excess = total - quota
+        lru = files.order_by(F('accessed').asc(nulls_first=True), 'file')
+        for row in lru.iterator():
+            if excess <= 0:
+                break
+            candidates.append((row['file'], row['file_size'] or 0))
+            excess -= row['file_size'] or 0
+
+        evicted = freed = 0
+        for name, size in candidates:
+            if options['dry_run'] or self.evict(name, started):
+                evicted += 1
+                freed += size
+
+        verb = 'Would evict' if options['dry_run'] else 'Evicted'
+        self.stdout.write(f'{verb} {evicted} files, {freed} bytes')
+        self.stdout.write(self.style.SUCCESS('Thumbnails swept!'))
+
+    def evict(self, name, started):
+        """
+        Delete a file and mark its thumbnails as evicted, unless it was
+        served or rendered again since the sweep started
+        """
+        with locks.variant_locks([name]):
+            thumbnails = Thumbnail.objects.filter(file=name,
+                                                  status=Thumbnail.READY)
+            if thumbnails.filter(last_accessed__gte=started).exists():
+                return False
+            user_ids = set(thumbnails.values_list('image__user_id',
+                                                  flat=True))
+            thumbnails.update(status=Thumbnail.EVICTED, file='')
+            default_storage.delete(name)
+
+        # Listed thumbnails show their status
+        list_cache.invalidate(*user_ids)
+        return True
@@ -0,0 +1,256 @@
+"""
+Request metrics in the Prometheus text format.
+
+metrics_middleware times every request by view, SQL queries are counted
+and timed by a wrapper installed on each database connection, and the
+thumbnail pipeline times its decode, resize and encode stages. The
+totals are served by the metrics view, the timings of a request are
+echoed in its Server-Timing header.
+
+Metrics are kept per process, scrape every worker or run one per
+container.
+"""
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import sync_and_async_middleware
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Prometheus client defaults, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Timings of the request being handled, None outside requests
+current_timings = ContextVar('current_timings', default=None)
+
+
+class Histogram:
+    """Cumulative histogram of observations per label set"""
+    def __init__(self, name, documentation, labels, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts = self.values.setdefault(
+                label_values, [[0] * len(self.buckets), 0, 0.0]
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} histogram']
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, (buckets, count, total) in values:
+            labels = format_labels(self.labels, label_values)
+            for bound, bucket in zip(self.buckets, buckets):
+                le = format_labels(self.labels + ('le',),
+                                   label_values + (repr(bound),))
+                lines.append(f'{self.name}_bucket{le} {bucket}')
+            inf = format_labels(self.labels + ('le',),
+                                label_values + ('+Inf',))
+            lines.append(f'{self.name}_bucket{inf} {count}')
+            lines.append(f'{self.name}_count{labels} {count}')
+            lines.append(f'{self.name}_sum{labels} {total}')
+        return lines
+
+
+class Counter:
+    """Monotonic total per label set"""
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} counter']
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, total in values:
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}{labels} {total}')
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'),
+        )
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+REQUEST_DURATION = Histogram(
+    'imgapi_request_duration_seconds',
+    'Time to produce a response, by view',
+    ('view', 'method', 'status'),
+)
+SQL_QUERIES = Counter(
+    'imgapi_sql_queries_total',
+    'SQL queries run while handling requests, by view',
+    ('view',),
+)
+SQL_DURATION = Counter(
+    'imgapi_sql_duration_seconds_total',
+    'Time spent in SQL queries while handling requests, by view',
+    ('view',),
+)
+STAGE_DURATION = Histogram(
+    'imgapi_pipeline_stage_duration_seconds',
+    'Time spent in a thumbnail pipeline stage',
+    ('stage',),
+)
+METRICS = [REQUEST_DURATION, SQL_QUERIES, SQL_DURATION, STAGE_DURATION]
+
+
+class RequestTimings:
+    """Seconds and number of calls per timed part of one request"""
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        # Pipeline stages may run on worker threads of the request
+        with self.lock:
+            self.durations[name] += seconds
+            self.counts[name] += 1
+
+    def server_timing(self, total):
+        """Format as a Server-Timing header value, durations in ms"""
+        parts = [
+            f'{name};dur={seconds * 1000:.1f};desc="{self.counts[name]}x"'
+            for name, seconds in sorted(self.durations.items())
+        ]
+        parts.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(parts)
+
+
+@contextmanager
+def stage(name):
+    """Time a thumbnail pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, name)
+        timings = current_timings.get()
+        if timings is not None:
+            timings.add(name, elapsed)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper timing queries run by requests"""
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add('db', time.perf_counter() - start)
+
+
+def install_query_recorder(connection):
+    """Time the queries of a database connection, once per connection"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name
+
+
+def finish(request, response, timings, start):
+    """Record a handled request, adding its Server-Timing header"""
+    total = time.perf_counter() - start
+    view = get_view_name(request)
+    REQUEST_DURATION.observe(total, view, request.method,
+                             response.status_code)
+    SQL_QUERIES.inc(timings.counts['db'], view)
+    SQL_DURATION.inc(timings.durations['db'], view)
+    if settings.METRICS['SERVER_TIMING']:
+        response.headers['Server-Timing'] = timings.server_timing(total)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Time requests under both WSGI and ASGI, see module docstring"""
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            timings = RequestTimings()
+            token = current_timings.set(timings)
+            start = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                current_timings.reset(token)
+            finish(request, response, timings, start)
+            return response
+    else:
+        def middleware(request):
+            timings = RequestTimings()
+            token = current_timings.set(timings)
+            start = time.perf_counter()
+            try:
+                response = get_response(request)
+            finally:
+                current_timings.reset(token)
+            finish(request, response, timings, start)
+            return response
+
+    return middleware
+
+
+def expose():
+    """Render every metric in the Prometheus text format"""
+    lines = []
+    for metric in METRICS:
+        lines += metric.expose()
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """
+    Serve the metrics to a scraper. With METRICS TOKEN set, requests
+    must send it as a bearer token.
+    """
+    token = settings.METRICS['TOKEN']
+    if token and not constant_time_compare(
+        request.headers.get('Authorization', ''), f'Bearer {token}'
+    ):
+        return HttpResponse(status=403)
+    return HttpResponse(expose(), content_type=CONTENT_TYPE)
@@ -0,0 +1,32 @@
+# Generated by Django 4.1.5 on 2026-10-18 20:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_userimage_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Thumbnail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('height', models.IntegerField()),
+                ('format', models.CharField(max_length=10)),
+                ('file', models.ImageField(max_length=255, upload_to='')),
+                ('width', models.IntegerField()),
+                ('size', models.IntegerField()),
+                ('source', models.CharField(max_length=255)),
+                ('when_created', models.DateTimeField(auto_now=True)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thumbnails', to='core.userimage')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='thumbnail',
+            constraint=models.UniqueConstraint(fields=('image', 'height', 'format'), name='unique_thumbnail_variant'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.1.5 on 2026-10-18 20:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_thumbnail'),
+    ]
+
+    operations = [
+        # Thumbnails recorded so far have all been rendered
+        migrations.AddField(
+            model_name='thumbnail',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=7),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', max_length=7),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='file',
+            field=models.ImageField(blank=True, max_length=255, upload_to=''),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='size',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='source',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='width',
+            field=models.IntegerField(null=True),
+        ),
+    ]
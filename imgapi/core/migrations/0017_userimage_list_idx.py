@@ -0,0 +1,17 @@
+# Generated by Django 4.1.5 on 2026-10-18 20:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_thumbnailjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userimage',
+            index=models.Index(fields=['user', '-when_created', 'id'], include=('name', 'image'), name='userimage_list_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.5 on 2026-10-18 20:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_userimage_list_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedLink',
+            fields=[
+                ('id', models.UUIDField(primary_key=True, serialize=False)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='expiringlink',
+            name='height',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='expiringlink',
+            name='link',
+            field=models.CharField(max_length=512, null=True),
+        ),
+    ]
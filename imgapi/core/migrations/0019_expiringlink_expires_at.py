@@ -0,0 +1,57 @@
+# Generated by Django 4.1.5 on 2026-10-18 20:31
+
+from datetime import timedelta
+
+from django.db import migrations, models
+import django.utils.timezone
+
+BATCH_SIZE = 1000
+
+
+def backfill_expires_at(apps, schema_editor):
+    """Store created_on + expires_after for existing links in batches"""
+    ExpiringLink = apps.get_model('core', 'ExpiringLink')
+    links = ExpiringLink.objects.filter(expires_at__isnull=True)
+
+    while True:
+        batch = list(links.only('created_on', 'expires_after')[:BATCH_SIZE])
+        if not batch:
+            break
+        for link in batch:
+            link.expires_at = link.created_on + timedelta(
+                seconds=link.expires_after
+            )
+        ExpiringLink.objects.bulk_update(batch, ['expires_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_signed_expiring_links'),
+    ]
+
+    operations = [
+        # Set before saving so expires_at can be derived from it
+        migrations.AlterField(
+            model_name='expiringlink',
+            name='created_on',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='expiringlink',
+            name='expires_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(backfill_expires_at,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='expiringlink',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='revokedlink',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
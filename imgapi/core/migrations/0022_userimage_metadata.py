@@ -0,0 +1,50 @@
+# Generated by Django 4.1.5 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_uploadsession'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='userimage',
+            name='userimage_list_idx',
+        ),
+        migrations.AddField(
+            model_name='userimage',
+            name='format',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='userimage',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userimage',
+            name='orientation',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userimage',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userimage',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='userimage',
+            index=models.Index(fields=['user', '-when_created', 'id'], include=('name', 'image', 'width', 'height'), name='userimage_list_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userimage',
+            index=models.Index(fields=['user', 'format'], name='userimage_format_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 20:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_userimage_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnail',
+            name='profile',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+    ]
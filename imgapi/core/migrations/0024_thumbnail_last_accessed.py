@@ -0,0 +1,27 @@
+# Generated by Django 4.1.5 on 2026-10-18 21:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_thumbnail_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnail',
+            name='last_accessed',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed'), ('evicted', 'Evicted')], default='pending', max_length=7),
+        ),
+        migrations.AddIndex(
+            model_name='thumbnail',
+            index=models.Index(fields=['file'], name='thumbnail_file_idx'),
+        ),
+    ]
@@ -1,12 +1,18 @@
+import hashlib
+import time
 import uuid
+from collections import Counter
 
 from PIL import Image
 
 import os
 
-from django.db import models
+from asgiref.sync import sync_to_async
+
 from django.conf import settings
-from urllib.parse import urljoin
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.core.validators import (
     FileExtensionValidator,
     MinValueValidator,
@@ -18,6 +24,8 @@ from django.contrib.auth.models import (
     PermissionsMixin,
 )
 
+from core import encoders, formats, locks, pipeline, tasks
+
 
 class UserManager(BaseUserManager):
     """Manager for users"""
@@ -92,6 +100,165 @@ class User(AbstractBaseUser, PermissionsMixin):
         elif self.user_tier == self.CUSTOM:
             return [self.custom_thumbnail_size, self.custom_original_link]
 
+    @property
+    def thumbnail_heights(self):
+        """Get available thumbnail heights without the original link flag"""
+        return [
+            height for height in self.available_thumbnails or []
+            if type(height) is int
+        ]
+
+    @property
+    def has_original_link(self):
+        """Check if a link to the original image is available"""
+        return any(height is True
+                   for height in self.available_thumbnails or [])
+
+
+class BlobManager(models.Manager):
+    """Manager for content-addressed blobs"""
+
+    def get_digest(self, file):
+        """
+        SHA-256 of an uploaded file. The hashing upload handlers compute
+        it while receiving, other files are read once more here.
+        """
+        digest = getattr(file, 'sha256', None)
+        if digest is None:
+            hasher = hashlib.sha256()
+            file.seek(0)
+            for chunk in file.chunks():
+                hasher.update(chunk)
+            file.seek(0)
+            digest = hasher.hexdigest()
+        return digest
+
+    def store(self, file, extension):
+        """
+        Get the blob of the file's content, storing the file only if the
+        content is new, and take a reference to it
+        """
+        digest = self.get_digest(file)
+        storage = self.model._meta.get_field('file').storage
+        with transaction.atomic():
+            blob, _ = self.select_for_update().get_or_create(
+                sha256=digest,
+                defaults={
+                    'file': storage.generate_filename(
+                        f'blobs/{digest}{extension}'
+                    ),
+                    'size': file.size,
+                },
+            )
+            if not storage.exists(blob.file.name):
+                storage.save(blob.file.name, file)
+            self.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+
+        return blob
+
+    def store_many(self, files, executor):
+        """
+        Like store for (file, digest, extension) tuples, returning their
+        blobs in order. The rows are created and locked in digest order
+        in a few queries, then new content is written on the executor
+        while the locks are held.
+        """
+        storage = self.model._meta.get_field('file').storage
+        new = {}
+        refs = Counter()
+        for file, digest, extension in files:
+            new.setdefault(digest, (file, extension))
+            refs[digest] += 1
+
+        with transaction.atomic():
+            self.bulk_create([
+                self.model(
+                    sha256=digest,
+                    file=storage.generate_filename(
+                        f'blobs/{digest}{extension}'
+                    ),
+                    size=file.size,
+                )
+                for digest, (file, extension) in sorted(new.items())
+            ], ignore_conflicts=True)
+            blobs = {
+                blob.pk: blob
+                for blob in self.select_for_update().filter(
+                    pk__in=new
+                ).order_by('pk')
+            }
+
+            missing = [
+                (blob.file.name, new[digest][0])
+                for digest, blob in blobs.items()
+                if not storage.exists(blob.file.name)
+            ]
+            list(executor.map(lambda args: storage.save(*args), missing))
+
+            by_count = {}
+            for digest, count in refs.items():
+                by_count.setdefault(count, []).append(digest)
+            for count, digests in by_count.items():
+                self.filter(pk__in=digests).update(
+                    refcount=F('refcount') + count
+                )
+
+        return [blobs[digest] for _, digest, _ in files]
+
+
+class Blob(models.Model):
+    """
+    Uploaded file stored once per content and shared by every image
+    with that content. Deleted with its files when the last image
+    referencing it is, see release.
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    file = models.ImageField(max_length=255)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    when_created = models.DateTimeField(auto_now_add=True)
+
+    objects = BlobManager()
+
+    def __str__(self):
+        return self.sha256
+
+    @staticmethod
+    def get_thumbnail_dir(sha256, storage):
+        """Get storage directory of the thumbnails of a blob"""
+        return storage.generate_filename(f'thumbnails/{sha256}')
+
+    @property
+    def thumbnail_dir(self):
+        return self.get_thumbnail_dir(self.sha256, self.file.storage)
+
+    def release(self):
+        """Drop a reference, deleting the blob when it was the last one"""
+        with transaction.atomic():
+            Blob.objects.filter(pk=self.pk).update(
+                refcount=F('refcount') - 1
+            )
+            deleted, _ = Blob.objects.filter(pk=self.pk,
+                                             refcount=0).delete()
+        if deleted:
+            transaction.on_commit(self.delete_files)
+
+    def delete_files(self):
+        """Delete the file and thumbnails unless re-uploaded meanwhile"""
+        if Blob.objects.filter(pk=self.pk).exists():
+            return
+
+        storage = self.file.storage
+        storage.delete(self.file.name)
+        if storage.exists(self.thumbnail_dir):
+            _, files = storage.listdir(self.thumbnail_dir)
+            for name in files:
+                storage.delete(f'{self.thumbnail_dir}/{name}')
+            try:
+                os.rmdir(storage.path(self.thumbnail_dir))
+            except OSError:
+                pass
+
 
 class UserImage(models.Model):
     """Model for user-uploaded image"""
@@ -103,11 +270,64 @@ class UserImage(models.Model):
         )
     name = models.CharField(max_length=255, null=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Shared stored content, empty for images uploaded before blobs
+    blob = models.ForeignKey(Blob,
+                             on_delete=models.PROTECT,
+                             null=True,
+                             blank=True,
+                             related_name='images')
+    # Read once at upload, width and height as displayed, i.e. with the
+    # EXIF orientation applied. Empty until `manage.py
+    # backfill_image_metadata` ran for images uploaded before.
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    format = models.CharField(max_length=10, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    orientation = models.PositiveSmallIntegerField(null=True, blank=True)
     when_created = models.DateTimeField(auto_now_add=True)
 
+    METADATA_FIELDS = ['width', 'height', 'format', 'size', 'orientation']
+
+    class Meta:
+        indexes = [
+            # Serves keyset pages of a user's images without table lookups
+            models.Index(fields=['user', '-when_created', 'id'],
+                         include=['name', 'image', 'width', 'height'],
+                         name='userimage_list_idx'),
+            models.Index(fields=['user', 'format'],
+                         name='userimage_format_idx'),
+        ]
+
     def __str__(self):
         return self.image.url
 
+    def save(self, *args, **kwargs):
+        # New uploads reference the blob of their content instead
+        if not self.image or self.image._committed:
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic():
+            previous = None
+            if not self._state.adding:
+                previous = UserImage.objects.filter(
+                    pk=self.pk
+                ).values_list('blob', flat=True).first()
+
+            self.set_metadata(self.image.file)
+            extension = os.path.splitext(self.image.name)[1].lower()
+            self.blob = Blob.objects.store(self.image.file, extension)
+            self.image = self.blob.file.name
+            super().save(*args, **kwargs)
+
+            if previous is not None:
+                Blob.objects.get(pk=previous).release()
+
+    def set_metadata(self, file, size=None):
+        """Read the metadata fields from the original's file or path"""
+        for field, value in pipeline.read_metadata(file).items():
+            setattr(self, field, value)
+        self.size = file.size if size is None else size
+
     def get_original_img_url(self):
         return self.image.url
 
@@ -116,52 +336,455 @@ class UserImage(models.Model):
         Get width that will allow to retain
         the appropriate ratio after resize
         """
-        return int((curr_width * height) / curr_height)
+        return pipeline.get_desired_width(curr_width, curr_height, height)
+
+    def get_thumbnail_width(self, height):
+        """
+        Get the width a thumbnail of the given height is rendered at,
+        None while the original's metadata is unknown
+        """
+        if self.width is None:
+            return None
+        if height >= self.height:
+            # Never enlarged
+            return self.width
+        return max(1, self.get_desired_width(self.width, self.height,
+                                             height))
+
+    @property
+    def image_format(self):
+        """Pillow format name of the original, derived from its extension"""
+        extension = os.path.splitext(self.image.name)[1].lower()
+        return Image.registered_extensions().get(extension)
+
+    @property
+    def encoder_profile(self):
+        """Name of the owner's thumbnail encoder profile"""
+        return encoders.get_profile(self.user)
+
+    def get_thumbnail_name(self, height, img_format=None, profile=None):
+        """
+        Get storage name of a thumbnail, in the original's format unless
+        another is given, and encoded with a profile if one is given.
+        Thumbnails of blobs are shared by every image with the same
+        content.
+        """
+        img_dir, img_name = os.path.split(self.image.name)
+        stem, extension = os.path.splitext(img_name)
+        if img_format is not None and img_format != self.image_format:
+            extension = formats.EXTENSIONS[img_format]
+        if profile:
+            extension = f'.{profile}{extension}'
+        if self.blob_id is not None:
+            thumbnail_dir = Blob.get_thumbnail_dir(self.blob_id,
+                                                   self.image.storage)
+            return f'{thumbnail_dir}/{height}{extension}'
+        return os.path.join(img_dir, 'thumbnails',
+                            f'{str(height)}_{stem}{extension}')
+
+    def write_thumbnails(self, heights, img_format=None, profile=None):
+        """
+        Render thumbnails of the given heights into storage, reusing the
+        shared thumbnails of the blob already rendered. Encoded with the
+        owner's profile unless another is given. Missing thumbnails are
+        rendered under their variant locks, a thumbnail written by
+        another worker while waiting is reused. Returns the lookup and
+        field values to record each thumbnail with.
+        """
+        storage = self.image.storage
+        img_format = img_format or self.image_format
+        profile = profile or self.encoder_profile
+        options = encoders.get_options(profile, img_format)
+        names = {
+            height: self.get_thumbnail_name(height, img_format, profile)
+            for height in heights
+        }
+        sizes = {}
+
+        def is_stored(height, since=None):
+            """Check a thumbnail is stored, and written after `since`"""
+            try:
+                mtime = os.path.getmtime(storage.path(names[height]))
+            except OSError:
+                return False
+            return since is None or mtime >= since
+
+        missing = [
+            height for height in heights
+            if self.blob_id is None or not is_stored(height)
+        ]
+        if missing:
+            waiting_since = time.time()
+            with locks.variant_locks(names[height] for height in missing):
+                missing = [
+                    height for height in missing
+                    if not is_stored(height, waiting_since)
+                ]
+                for height, img in pipeline.render_thumbnails(
+                    self.image.path, missing
+                ):
+                    pipeline.write_thumbnail(img,
+                                             storage.path(names[height]),
+                                             img_format,
+                                             options)
+                    sizes[height] = img.width
+
+        for height in heights:
+            if height not in sizes:
+                sizes[height] = self.get_thumbnail_width(height)
+            if sizes[height] is None:
+                with Image.open(storage.path(names[height])) as img:
+                    sizes[height] = img.width
+
+        written = []
+        for height in heights:
+            thumbnail_name = names[height]
+            written.append((
+                {'image': self, 'height': height, 'format': img_format},
+                {
+                    'status': Thumbnail.READY,
+                    'file': thumbnail_name,
+                    'width': sizes[height],
+                    'size': storage.size(thumbnail_name),
+                    'source': self.image.name,
+                    'profile': profile,
+                    'last_accessed': timezone.now(),
+                },
+            ))
+
+        return written
+
+    def render_thumbnails(self, heights, img_format=None, profile=None):
+        """Render thumbnails of the given heights and record them"""
+        return [
+            Thumbnail.objects.update_or_create(**lookup, defaults=fields)[0]
+            for lookup, fields in self.write_thumbnails(heights,
+                                                        img_format,
+                                                        profile)
+        ]
+
+    async def arender_thumbnails(self, heights, img_format=None,
+                                 profile=None):
+        """Async render_thumbnails, Pillow runs in a worker thread"""
+        written = await sync_to_async(
+            self.write_thumbnails,
+            thread_sensitive=False,
+        )(heights, img_format, profile)
+        rendered = []
+        for lookup, fields in written:
+            thumbnail, _ = await Thumbnail.objects.aupdate_or_create(
+                **lookup, defaults=fields
+            )
+            rendered.append(thumbnail)
+
+        return rendered
+
+    def schedule_thumbnails(self, heights):
+        """Mark thumbnails as pending and queue them for rendering"""
+        pending = []
+        for height in heights:
+            thumbnail, _ = Thumbnail.objects.update_or_create(
+                image=self,
+                height=height,
+                format=self.image_format,
+                defaults={'status': Thumbnail.PENDING},
+            )
+            pending.append(thumbnail)
+
+        tasks.enqueue(self.pk, heights)
+
+        return pending
+
+    def get_thumbnail(self, height, img_format=None, profile=None):
+        """
+        Get a ready thumbnail, in the original's format and encoded with
+        the owner's profile unless others are given, rendering it now if
+        missing or stale
+        """
+        img_format = img_format or self.image_format
+        profile = profile or self.encoder_profile
+        thumbnail = self.thumbnails.filter(
+            height=height,
+            format=img_format,
+            status=Thumbnail.READY,
+        ).first()
+        if thumbnail is None or not thumbnail.is_current(self, profile):
+            thumbnail, = self.render_thumbnails([height], img_format,
+                                                profile)
+        else:
+            thumbnail.touch()
+
+        return thumbnail
+
+    def get_variant_name(self, height=None, render=True, img_format=None,
+                         profile=None):
+        """
+        Get storage name of the original, or of a thumbnail if a height
+        is given. Unless `render` is False the thumbnail is rendered
+        first when missing.
+        """
+        if height is None:
+            return self.image.name
+        if not render:
+            return self.get_thumbnail_name(height, img_format,
+                                           profile or self.encoder_profile)
+        return self.get_thumbnail(height, img_format, profile).file.name
+
+    async def aget_thumbnail(self, height, img_format=None, profile=None):
+        """Async get_thumbnail"""
+        img_format = img_format or self.image_format
+        if profile is None:
+            profile = await sync_to_async(lambda: self.encoder_profile)()
+        thumbnail = await self.thumbnails.filter(
+            height=height,
+            format=img_format,
+            status=Thumbnail.READY,
+        ).afirst()
+        if thumbnail is None or not thumbnail.is_current(self, profile):
+            thumbnail, = await self.arender_thumbnails([height], img_format,
+                                                       profile)
+        else:
+            await thumbnail.atouch()
+
+        return thumbnail
+
+    async def aget_variant_name(self, height=None, img_format=None,
+                                profile=None):
+        """Async get_variant_name, rendering missing thumbnails"""
+        if height is None:
+            return self.image.name
+        thumbnail = await self.aget_thumbnail(height, img_format, profile)
+        return thumbnail.file.name
+
+    def get_thumbnails(self, heights=None, profile=None):
+        """
+        Get thumbnails for the given or the owner's available heights.
+        Missing and evicted thumbnails, and ones of another file or
+        encoder profile, are scheduled for rendering. Prefetch
+        `thumbnails` to keep listing to a single query.
+        """
+        rendered = {
+            thumbnail.height: thumbnail
+            for thumbnail in self.thumbnails.all()
+            if thumbnail.format == self.image_format
+        }
+
+        if heights is None:
+            heights = self.user.thumbnail_heights
+        profile = profile or self.encoder_profile
+        missing = [
+            height for height in heights
+            if height not in rendered
+            or rendered[height].status == Thumbnail.EVICTED
+            or (
+                rendered[height].status == Thumbnail.READY
+                and not rendered[height].is_current(self, profile)
+            )
+        ]
+        if missing:
+            for thumbnail in self.schedule_thumbnails(missing):
+                rendered[thumbnail.height] = thumbnail
+
+        return [rendered[height] for height in heights]
+
+
+class Thumbnail(models.Model):
+    """Model for a rendered thumbnail of a user image"""
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+    # File deleted by sweep_thumbnails, rendered again when listed or
+    # requested
+    EVICTED = 'evicted'
+
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+        (EVICTED, 'Evicted'),
+    ]
+    # Fields
+    image = models.ForeignKey(UserImage,
+                              on_delete=models.CASCADE,
+                              related_name='thumbnails')
+    height = models.IntegerField()
+    format = models.CharField(max_length=10)
+    status = models.CharField(
+        max_length=7,
+        choices=STATUS_CHOICES,
+        default=PENDING
+    )
+    file = models.ImageField(max_length=255, blank=True)
+    width = models.IntegerField(null=True)
+    size = models.IntegerField(null=True)
+    # Name of the original the thumbnail was rendered from
+    source = models.CharField(max_length=255, blank=True)
+    # Encoder profile, empty for thumbnails encoded before profiles
+    profile = models.CharField(max_length=20, blank=True)
+    when_created = models.DateTimeField(auto_now=True)
+    # Last served, updated at most every THUMBNAIL_ACCESS_INTERVAL
+    last_accessed = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['image', 'height', 'format'],
+                                    name='unique_thumbnail_variant'),
+        ]
+        indexes = [
+            # Finds every row of a file shared by a blob's images
+            models.Index(fields=['file'], name='thumbnail_file_idx'),
+        ]
 
-    def get_thumbnails(self):
-        """Get thumbnail urls"""
+    def __str__(self):
+        return f'{self.height}_{self.image_id} ({self.status})'
 
-        thumbnails = []
-        img_path = self.image.path
+    def is_current(self, image, profile):
+        """Check the thumbnail is of the image's file, with the profile"""
+        return self.source == image.image.name and self.profile == profile
 
-        for height in self.user.available_thumbnails:
-            if type(height) is int:
-                with Image.open(img_path) as img:
-                    img_copy = img.copy()
-                    w, h = img_copy.size
-                    width = self.get_desired_width(w, h, height)
-                    # Resize
-                    img_copy.thumbnail((width, height))
+    def is_accessed(self, now):
+        """Check the recorded access is recent enough to keep"""
+        return self.last_accessed is not None and (
+            now - self.last_accessed
+            < timezone.timedelta(seconds=settings.THUMBNAIL_ACCESS_INTERVAL)
+        )
 
-                    img_dir = os.path.dirname(img_path)
-                    thumbnail_name = f'{str(height)}_{os.path.basename(img_path)}'
-                    thumbnail_path = os.path.join(img_dir,
-                                                  'thumbnails',
-                                                  thumbnail_name)
+    def touch(self):
+        """Record an access for eviction, without a write on most calls"""
+        now = timezone.now()
+        if not self.is_accessed(now):
+            Thumbnail.objects.filter(pk=self.pk).update(last_accessed=now)
+            self.last_accessed = now
+
+    async def atouch(self):
+        """Async touch"""
+        now = timezone.now()
+        if not self.is_accessed(now):
+            await Thumbnail.objects.filter(pk=self.pk).aupdate(
+                last_accessed=now
+            )
+            self.last_accessed = now
 
-                    img_copy.save(thumbnail_path)
+    @property
+    def content_type(self):
+        return formats.MIME_TYPES.get(self.format,
+                                      'application/octet-stream')
 
-                    # Will be a URL in production
-                    thumbnail_url = urljoin(settings.MEDIA_URL, thumbnail_path)
+    @property
+    def etag(self):
+        """Strong ETag, changes whenever the thumbnail is re-rendered"""
+        version = f'{self.file.name}:{self.when_created.isoformat()}'
+        return f'"{hashlib.md5(version.encode()).hexdigest()}"'
+
+
+class ThumbnailJob(models.Model):
+    """
+    Durable queue entry for rendering thumbnails of an image.
+    Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, a running
+    job whose lock expired is handed to the next worker.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DEAD = 'dead'
+
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DEAD, 'Dead'),
+    ]
+    # Fields
+    image = models.ForeignKey(UserImage,
+                              on_delete=models.CASCADE,
+                              related_name='thumbnail_jobs')
+    heights = models.JSONField()
+    status = models.CharField(
+        max_length=7,
+        choices=STATUS_CHOICES,
+        default=QUEUED
+    )
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
+    when_created = models.DateTimeField(auto_now_add=True)
 
-                    thumbnails.append(thumbnail_url)
-            elif type(height) is bool and height:
-                thumbnails.append(self.get_original_img_url)
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'],
+                         name='thumbnail_job_claim_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.image_id} {self.heights} ({self.status})'
 
-        return thumbnails
+
+class ExpiringQuerySet(models.QuerySet):
+    """Queryset for rows that expire at `expires_at`"""
+    def live(self):
+        return self.filter(expires_at__gt=timezone.now())
+
+    def expired(self):
+        return self.filter(expires_at__lte=timezone.now())
 
 
 class ExpiringLink(models.Model):
     """Model for expiring links"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     image = models.ForeignKey(UserImage, on_delete=models.CASCADE)
+    # Thumbnail height the link is for, the original if empty
+    height = models.IntegerField(null=True, blank=True)
     expires_after = models.IntegerField(default=350,
                                         validators=[
                                             MinValueValidator(300),
                                             MaxValueValidator(30000)
                                             ])
-    link = models.CharField(max_length=255, null=True)
-    created_on = models.DateTimeField(auto_now_add=True)
+    link = models.CharField(max_length=512, null=True)
+    created_on = models.DateTimeField(default=timezone.now, editable=False)
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = ExpiringQuerySet.as_manager()
+
+    def __str__(self):
+        return str(self.id)
+
+    def save(self, *args, **kwargs):
+        if self.expires_at is None:
+            self.expires_at = self.created_on + timezone.timedelta(
+                seconds=self.expires_after
+            )
+        super().save(*args, **kwargs)
+
+
+class RevokedLink(models.Model):
+    """
+    Signed expiring link that was killed before it expired.
+    Kept until the link would have expired anyway.
+    """
+    id = models.UUIDField(primary_key=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class UploadSession(models.Model):
+    """
+    Resumable chunked upload. Received bytes are appended to a part
+    file whose length is the upload offset, see core.uploads.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255, null=True, blank=True)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    when_created = models.DateTimeField(auto_now_add=True)
+
+    objects = ExpiringQuerySet.as_manager()
 
     def __str__(self):
-        pass
+        return str(self.id)
+
+    @property
+    def part_name(self):
+        return f'uploads/{self.id}.part'
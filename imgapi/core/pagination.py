@@ -0,0 +1,136 @@
+"""
+Pagination
+"""
+import base64
+import binascii
+import uuid
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on (when_created, id), newest first.
+    Each page continues from the last row of the previous one,
+    so page N costs the same index range scan as page 1.
+    """
+    ordering = ('-when_created', 'id')
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.get_page(list(self.get_page_queryset(queryset, request)))
+
+    def get_page_queryset(self, queryset, request):
+        """
+        Narrow the queryset to the requested page, without evaluating it
+        so async views can fetch it with the async ORM. Pass the fetched
+        rows to get_page.
+        """
+        self.request = request
+        self.current_page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            when_created, pk = cursor
+            queryset = queryset.filter(
+                Q(when_created__lt=when_created)
+                | Q(when_created=when_created, id__gt=pk)
+            )
+
+        # Fetch one extra row to know whether there is a next page
+        return queryset[:self.current_page_size + 1]
+
+    def get_page(self, rows):
+        """Trim the extra row of get_page_queryset, noting the next cursor"""
+        page = rows[:self.current_page_size]
+        self.next_cursor = None
+        if len(rows) > self.current_page_size:
+            self.next_cursor = self.encode_cursor(page[-1])
+
+        return page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.GET[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size < 1:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def encode_cursor(self, instance):
+        position = f'{instance.when_created.isoformat()}|{instance.id}'
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.GET.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            position = base64.urlsafe_b64decode(encoded.encode()).decode()
+            when_created, pk = position.split('|')
+            when_created = parse_datetime(when_created)
+            pk = uuid.UUID(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if when_created is None:
+            raise NotFound(self.invalid_cursor_message)
+
+        return when_created, pk
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url,
+                                   self.cursor_query_param,
+                                   self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                    'format': 'uri',
+                },
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+        ]
@@ -0,0 +1,162 @@
+"""
+Image resize pipeline
+"""
+import io
+import os
+import tempfile
+
+from PIL import ExifTags, Image, ImageOps
+
+from core import metrics
+
+try:
+    from PIL import ImageCms
+except ImportError:
+    # Pillow built without LittleCMS, ICC profiles are always kept
+    ImageCms = None
+
+RESAMPLE = Image.Resampling.LANCZOS
+# Let Pillow shrink by an integer factor with Image.reduce before
+# resampling when the source is at least this many times larger
+REDUCING_GAP = 2.0
+# EXIF orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def get_orientation(img):
+    """Get the EXIF orientation of an opened image, 1 if it has none"""
+    return img.getexif().get(ExifTags.Base.Orientation, 1)
+
+
+def read_metadata(fp):
+    """
+    Read the displayed width and height, format and EXIF orientation of
+    an image file or path. Only the header is read.
+    """
+    with Image.open(fp) as img:
+        width, height = img.size
+        orientation = get_orientation(img)
+        img_format = img.format
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    if hasattr(fp, 'seek'):
+        fp.seek(0)
+
+    return {
+        'width': width,
+        'height': height,
+        'format': img_format,
+        'orientation': orientation,
+    }
+
+
+def get_desired_width(curr_width, curr_height, height):
+    """
+    Get width that will allow to retain
+    the appropriate ratio after resize
+    """
+    return int((curr_width * height) / curr_height)
+
+
+def render_thumbnails(path, heights):
+    """
+    Render thumbnails of the given heights from a single decode.
+
+    JPEGs are decoded at the smallest DCT scale that still covers the
+    largest thumbnail. The EXIF orientation is applied, so heights are
+    as displayed. Sizes are resized as a cascade, largest first, each
+    one from the previous (400 from the original, 200 from 400).
+    Images are never enlarged. Returns a list of (height, image).
+    """
+    thumbnails = []
+    heights = sorted(set(heights), reverse=True)
+    if not heights:
+        return thumbnails
+
+    with Image.open(path) as img:
+        with metrics.stage('decode'):
+            width, height = img.size
+            transposed = get_orientation(img) in TRANSPOSED_ORIENTATIONS
+            if transposed:
+                width, height = height, width
+            if img.format == 'JPEG':
+                largest = heights[0]
+                size = (max(1, get_desired_width(width, height, largest)),
+                        largest)
+                # Draft sizes are in stored, not displayed, orientation
+                img.draft(img.mode, size[::-1] if transposed else size)
+            img.load()
+            ImageOps.exif_transpose(img, in_place=True)
+
+        current = img
+        for thumbnail_height in heights:
+            if thumbnail_height < current.height:
+                thumbnail_width = get_desired_width(width,
+                                                    height,
+                                                    thumbnail_height)
+                size = (max(1, thumbnail_width), thumbnail_height)
+                with metrics.stage('resize'):
+                    current = current.resize(size,
+                                             RESAMPLE,
+                                             reducing_gap=REDUCING_GAP)
+            elif current is img:
+                current = img.copy()
+            thumbnails.append((thumbnail_height, current))
+
+    return thumbnails
+
+
+def is_srgb(icc_profile):
+    """Check if an ICC profile is sRGB, which is assumed without one"""
+    if ImageCms is None:
+        return False
+    try:
+        profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+    except (ImageCms.PyCMSError, OSError, TypeError):
+        return False
+    return 'sRGB' in (profile.profile.profile_description or '')
+
+
+def save_thumbnail(img, fp, img_format, options):
+    """
+    Encode a thumbnail with Pillow save options. EXIF and comments are
+    dropped, the ICC profile is kept unless it is sRGB. With the extra
+    option `quantize`, PNGs are reduced to an adaptive palette of that
+    many colours.
+    """
+    options = dict(options)
+    colors = options.pop('quantize', None)
+    icc_profile = img.info.get('icc_profile')
+    if icc_profile and is_srgb(icc_profile):
+        icc_profile = None
+
+    if colors and img_format == 'PNG' and img.mode in ('RGB', 'RGBA'):
+        img = img.quantize(colors)
+
+    with metrics.stage('encode'):
+        img.save(fp,
+                 format=img_format,
+                 icc_profile=icc_profile,
+                 exif=b'',
+                 comment=b'',
+                 **options)
+
+
+def write_thumbnail(img, path, img_format, options):
+    """
+    Encode a thumbnail to a path with save_thumbnail. The file is
+    written next to it under a temporary name and moved into place, so
+    readers never see a partly written thumbnail.
+    """
+    directory, name = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}.')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            save_thumbnail(img, fp, img_format, options)
+        # mkstemp creates the file readable by the owner only
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
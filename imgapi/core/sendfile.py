@@ -0,0 +1,124 @@
+"""
+Serving stored files.
+
+Behind a reverse proxy (SENDFILE_BACKEND 'nginx' or 'apache') only a
+header is returned and the proxy sends the file itself. Otherwise a
+FileResponse is returned, which WSGI servers with wsgi.file_wrapper
+(gunicorn, uWSGI) send from the kernel with os.sendfile.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeFile:
+    """
+    Read at most `length` bytes of a file from its current position.
+    Exposes fileno() so sendfile can still be used; servers limit it to
+    the Content-Length of the response.
+    """
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    Parse a single byte range into (start, end) inclusive. Returns None
+    when the header is missing or not understood, and raises ValueError
+    when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header or '')
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # Suffix range, the last N bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+
+    if start >= size or start > end:
+        raise ValueError('Unsatisfiable range')
+
+    return start, end
+
+
+def serve_file(request, name, max_age=None, storage=default_storage,
+               content_type=None):
+    """
+    Serve a stored file, honouring a single Range request. The content
+    type is guessed from the name unless given, mimetypes doesn't know
+    every image format on every Python.
+    """
+    content_type = (content_type or mimetypes.guess_type(name)[0]
+                    or 'application/octet-stream')
+    backend = settings.SENDFILE_BACKEND
+
+    if backend == 'nginx':
+        response = HttpResponse(content_type=content_type)
+        response.headers['X-Accel-Redirect'] = quote(
+            settings.SENDFILE_URL + name
+        )
+    elif backend == 'apache':
+        response = HttpResponse(content_type=content_type)
+        response.headers['X-Sendfile'] = storage.path(name)
+    else:
+        response = file_response(request, storage.path(name), content_type)
+
+    if max_age is not None:
+        response.headers['Cache-Control'] = f'private, max-age={max_age}'
+
+    return response
+
+
+def file_response(request, path, content_type):
+    """Stream a file from disk, answering Range requests with 206"""
+    file = open(path, 'rb')
+    size = os.fstat(file.fileno()).st_size
+
+    try:
+        byte_range = parse_range(request.headers.get('Range'), size)
+    except ValueError:
+        file.close()
+        response = HttpResponse(status=416)
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        file.seek(start)
+        response = FileResponse(RangeFile(file, end - start + 1),
+                                status=206,
+                                content_type=content_type)
+        response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response.headers['Content-Length'] = end - start + 1
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
@@ -3,15 +3,21 @@ Serializers
 """
 import uuid
 
+from django.conf import settings
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth import authenticate
+from django.core.files import File
 from django.utils.translation import gettext as _
 
 from rest_framework import serializers
 
+from core import signed_links, tasks, uploadhandlers, uploads
 from core.models import (
     UserImage,
+    Thumbnail,
     ExpiringLink,
+    UploadSession,
 )
 
 
@@ -40,34 +46,91 @@ class AuthTokenSerializer(serializers.Serializer):
         return attrs
 
 
+class ThumbnailSerializer(serializers.ModelSerializer):
+    """Serializer for thumbnails and their processing status"""
+    width = serializers.SerializerMethodField()
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Thumbnail
+        fields = [
+            'height',
+            'width',
+            'status',
+            'url',
+        ]
+
+    def get_width(self, instance):
+        # Known before rendering from the original's metadata
+        if instance.width is not None:
+            return instance.width
+        return instance.image.get_thumbnail_width(instance.height)
+
+    def get_url(self, instance):
+        if instance.status == Thumbnail.READY:
+            return instance.file.url
+        return None
+
+
 class UserImageListSerializer(serializers.ModelSerializer):
     """Serializer for listing images"""
     thumbnails = serializers.SerializerMethodField()
+    original = serializers.SerializerMethodField()
 
     class Meta:
         model = UserImage
         fields = [
             'name',
+            'width',
+            'height',
             'thumbnails',
+            'original',
         ]
 
     def get_thumbnails(self, instance):
-        return instance.get_thumbnails()
+        # Resolved once per request by the view, see get_serializer_context
+        heights = self.context.get('thumbnail_heights')
+        profile = self.context.get('encoder_profile')
+        return ThumbnailSerializer(instance.get_thumbnails(heights, profile),
+                                   many=True).data
+
+    def get_original(self, instance):
+        original_link = self.context.get('original_link')
+        if original_link is None:
+            original_link = instance.user.has_original_link
+        if original_link:
+            return instance.get_original_img_url()
+        return None
 
 
 class UserImageCreateSerializer(serializers.ModelSerializer):
     """Serializer for uploading images"""
+    thumbnails = ThumbnailSerializer(many=True, read_only=True)
 
     class Meta:
         model = UserImage
         fields = [
             'name',
             'image',
+            'thumbnails',
         ]
 
     def create(self, validated_data):
-        validated_data['user'] = self.context['request'].user
-        return UserImage.objects.create(**validated_data)
+        tasks.check_capacity()
+        user = self.context['request'].user
+        validated_data['user'] = user
+        image = UserImage.objects.create(**validated_data)
+        image.schedule_thumbnails(user.thumbnail_heights)
+
+        return image
+
+
+class UserImageBatchSerializer(serializers.Serializer):
+    """Serializer for uploading many images in one request"""
+    images = serializers.ListField(
+        child=serializers.FileField(),
+        required=False,
+    )
 
 
 class ExpiringLinkListSerializer(serializers.ModelSerializer):
@@ -87,9 +150,22 @@ class ExpiringLinkCreateSerializer(serializers.ModelSerializer):
         model = ExpiringLink
         fields = [
             'image',
+            'height',
             'expires_after',
         ]
 
+    def validate_image(self, value):
+        if value.user != self.context['request'].user:
+            raise serializers.ValidationError(_('Image not found'))
+        return value
+
+    def validate_height(self, value):
+        user = self.context['request'].user
+        if value is not None and value not in user.thumbnail_heights:
+            msg = _('Thumbnail height not available')
+            raise serializers.ValidationError(msg)
+        return value
+
     def create(self, validated_data):
         link_id = uuid.uuid4()
         full_url = self.context['request'].build_absolute_uri(
@@ -98,12 +174,23 @@ class ExpiringLinkCreateSerializer(serializers.ModelSerializer):
                     )
         expiring_link = ExpiringLink(id=link_id,
                                      image=self.validated_data['image'],
+                                     height=self.validated_data.get(
+                                         'height'
+                                         ),
                                      expires_after=self.validated_data[
                                          'expires_after'
                                          ],
                                      link=full_url)
         expiring_link.save()
 
+        if settings.EXPIRING_LINK_SIGNED:
+            # The expiry is only known once the link is saved
+            token = signed_links.sign_link(expiring_link)
+            expiring_link.link = self.context['request'].build_absolute_uri(
+                reverse('expiring-link-signed', kwargs={'token': token})
+            )
+            expiring_link.save(update_fields=['link'])
+
         return expiring_link
 
 
@@ -113,5 +200,52 @@ class ExpiringLinkDetailSerializer(serializers.ModelSerializer):
     class Meta:
         model = ExpiringLink
         fields = [
-            'image'
+            'image',
+            'height',
         ]
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """Serializer for resumable upload sessions"""
+    offset = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = [
+            'id',
+            'name',
+            'filename',
+            'size',
+            'offset',
+            'expires_at',
+        ]
+        read_only_fields = ['id', 'expires_at']
+
+    def get_offset(self, instance):
+        return uploads.get_offset(instance)
+
+    def validate_filename(self, value):
+        # Checked up front like image uploads, not after the last chunk
+        validator = UserImage._meta.get_field('image').validators[0]
+        validator(File(None, name=value))
+        return value
+
+    def validate_size(self, value):
+        user = self.context['request'].user
+        max_bytes = uploadhandlers.get_upload_limits(user)['MAX_BYTES']
+        if not 0 < value <= max_bytes:
+            msg = _('Upload size must be between 1 and %(max)s bytes') % {
+                'max': max_bytes,
+            }
+            raise serializers.ValidationError(msg)
+        return value
+
+    def create(self, validated_data):
+        validated_data['user'] = self.context['request'].user
+        validated_data['expires_at'] = timezone.now() + timezone.timedelta(
+            seconds=settings.UPLOAD_SESSION_TTL
+        )
+        session = super().create(validated_data)
+        uploads.create_part(session)
+
+        return session
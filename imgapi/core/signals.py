@@ -0,0 +1,112 @@
+"""
+Signal handlers
+"""
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from rest_framework.authtoken.models import Token
+
+from core import list_cache, locks, metrics, signed_links
+from core.authentication import get_token_cache
+from core.link_cache import get_link_cache
+from core.models import (
+    ExpiringLink,
+    Thumbnail,
+    UploadSession,
+    User,
+    UserImage,
+)
+
+
+@receiver(post_delete, sender=ExpiringLink)
+def revoke_signed_link(sender, instance, **kwargs):
+    """Keep deleted links dead even though their signature is valid"""
+    if settings.EXPIRING_LINK_SIGNED:
+        signed_links.revoke(instance)
+
+
+@receiver(post_delete, sender=ExpiringLink)
+def forget_deleted_link(sender, instance, **kwargs):
+    """Stop serving a revoked link from this process at once"""
+    get_link_cache().delete(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    """Logging out deletes the token, stop accepting it at once"""
+    get_token_cache().delete(instance.key)
+
+
+@receiver(post_save, sender=User)
+def forget_user_tokens(sender, instance, created, **kwargs):
+    """
+    Drop cached tokens of a changed user, e.g. a new password,
+    deactivation or a different tier
+    """
+    if created:
+        return
+    token_cache = get_token_cache()
+    for key in Token.objects.filter(user=instance).values_list('key',
+                                                               flat=True):
+        token_cache.delete(key)
+
+
+@receiver(post_delete, sender=UserImage)
+def release_blob(sender, instance, **kwargs):
+    """Delete the stored content once no image references it"""
+    if instance.blob_id is not None:
+        instance.blob.release()
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_image_list(sender, instance, **kwargs):
+    """A new tier changes the thumbnails and links listed"""
+    list_cache.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=UserImage)
+@receiver(post_delete, sender=UserImage)
+def invalidate_image_list(sender, instance, **kwargs):
+    list_cache.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=Thumbnail)
+def invalidate_thumbnail_image_list(sender, instance, **kwargs):
+    """Listed thumbnails show their status"""
+    list_cache.invalidate(instance.image.user_id)
+
+
+@receiver(post_delete, sender=Thumbnail)
+def delete_unused_thumbnail_file(sender, instance, **kwargs):
+    """
+    Delete the file of a deleted thumbnail once no other thumbnail uses
+    it. Files of a blob's images are shared, but one only the deleted
+    image's encoder profile produced is not, and sweep_thumbnails only
+    sees files thumbnails use.
+    """
+    name = instance.file.name
+    if not name:
+        return
+
+    def delete_file():
+        with locks.variant_locks([name]):
+            if not Thumbnail.objects.filter(file=name).exists():
+                default_storage.delete(name)
+
+    transaction.on_commit(delete_file)
+
+
+@receiver(post_delete, sender=UploadSession)
+def delete_upload_part(sender, instance, **kwargs):
+    """Finalized, abandoned and expired uploads leave no part file"""
+    default_storage.delete(instance.part_name)
+
+
+@receiver(connection_created)
+def record_queries(sender, connection, **kwargs):
+    """Count and time the queries run by requests, see core.metrics"""
+    metrics.install_query_recorder(connection)
@@ -0,0 +1,32 @@
+"""
+File storage
+"""
+import hashlib
+import posixpath
+
+from django.core.files.storage import FileSystemStorage
+
+
+def shard_name(name):
+    """
+    Insert two levels of hashed directories before the last part of a
+    name, 'media/x.jpg' becomes 'media/3f/a2/x.jpg'. Sharded names are
+    returned unchanged.
+    """
+    directory, basename = posixpath.split(name)
+    digest = hashlib.md5(basename.encode()).hexdigest()
+    shard = posixpath.join(digest[:2], digest[2:4])
+    if directory == shard or directory.endswith('/' + shard):
+        return name
+    return posixpath.join(directory, shard, basename)
+
+
+class ShardedFileSystemStorage(FileSystemStorage):
+    """
+    Keep directories small by spreading files over 65536 hashed
+    subdirectories. Names of uploads, blobs and blob thumbnails are
+    sharded by generate_filename, `manage.py shard_media` moves files
+    stored before.
+    """
+    def generate_filename(self, filename):
+        return shard_name(super().generate_filename(filename))
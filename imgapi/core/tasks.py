@@ -0,0 +1,208 @@
+"""
+Background thumbnail rendering.
+
+THUMBNAIL_QUEUE picks where queued thumbnails go: 'database' stores a
+ThumbnailJob drained by `manage.py process_thumbnails` workers, 'pool'
+renders them on an in-process thread pool.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from core import list_cache
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(APIException):
+    """Raised when an upload is rejected because the queue is full"""
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Thumbnail queue is full, try again later.'
+    default_code = 'queue_full'
+
+
+class ThumbnailPool:
+    """
+    Thread pool rendering thumbnails off the request path.
+    At most `workers + queue_size` renders are running or waiting.
+    """
+    def __init__(self, workers, queue_size):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='thumbnails')
+        self.capacity = workers + queue_size
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def is_full(self):
+        with self.condition:
+            return self.in_flight >= self.capacity
+
+    def submit(self, image_id, heights, block=True):
+        """
+        Queue a render. If the queue is full wait for a free slot,
+        or return False straight away when `block` is False.
+        """
+        with self.condition:
+            while self.in_flight >= self.capacity:
+                if not block:
+                    return False
+                self.condition.wait()
+            self.in_flight += 1
+
+        self.executor.submit(self.run, image_id, heights)
+        return True
+
+    def run(self, image_id, heights):
+        try:
+            render(image_id, heights)
+        finally:
+            # Worker threads keep their own connection, don't leak it
+            connection.close()
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Get the process-wide pool, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThumbnailPool(settings.THUMBNAIL_WORKERS,
+                                  settings.THUMBNAIL_QUEUE_SIZE)
+    return _pool
+
+
+def check_capacity():
+    """Refuse new work up front when the pool is full and set to reject"""
+    if settings.THUMBNAIL_QUEUE != 'pool':
+        return
+    if settings.THUMBNAIL_QUEUE_FULL == 'reject' and get_pool().is_full():
+        raise QueueFull()
+
+
+def enqueue(image_id, heights):
+    """Queue thumbnails of an image for rendering"""
+    from core.models import ThumbnailJob
+
+    if settings.THUMBNAIL_QUEUE == 'database':
+        # Stored in the caller's transaction, so it commits with the image
+        ThumbnailJob.objects.create(image_id=image_id, heights=heights)
+    else:
+        transaction.on_commit(lambda: schedule(image_id, heights))
+
+
+def schedule(image_id, heights):
+    """Hand thumbnails to the pool, honouring THUMBNAIL_QUEUE_FULL"""
+    block = settings.THUMBNAIL_QUEUE_FULL == 'block'
+    if not get_pool().submit(image_id, heights, block=block):
+        render(image_id, heights)
+
+
+def render(image_id, heights):
+    """Render thumbnails, marking them as failed if anything goes wrong"""
+    from core.models import UserImage
+
+    try:
+        UserImage.objects.get(pk=image_id).render_thumbnails(heights)
+    except Exception:
+        logger.exception('Rendering thumbnails of image %s failed', image_id)
+        mark_failed(image_id, heights)
+
+
+def mark_failed(image_id, heights):
+    """Mark thumbnails not rendered yet as failed"""
+    from core.models import Thumbnail, UserImage
+
+    Thumbnail.objects.filter(
+        image_id=image_id,
+        height__in=heights,
+    ).exclude(status=Thumbnail.READY).update(status=Thumbnail.FAILED)
+    # Queryset updates send no signals
+    list_cache.invalidate(*UserImage.objects.filter(
+        pk=image_id,
+    ).values_list('user_id', flat=True))
+
+
+def claim_job():
+    """
+    Claim the next due job, or a running one whose lock expired.
+    Rows locked by other workers are skipped rather than waited on.
+    """
+    from core.models import ThumbnailJob
+
+    now = timezone.now()
+    with transaction.atomic():
+        job = ThumbnailJob.objects.select_for_update(
+            skip_locked=True,
+        ).filter(
+            Q(status=ThumbnailJob.QUEUED, run_after__lte=now)
+            | Q(status=ThumbnailJob.RUNNING, locked_until__lt=now)
+        ).order_by('run_after').first()
+
+        if job is None:
+            return None
+
+        job.status = ThumbnailJob.RUNNING
+        job.attempts += 1
+        job.locked_until = now + timedelta(
+            seconds=settings.THUMBNAIL_JOB_TIMEOUT
+        )
+        job.save(update_fields=['status', 'attempts', 'locked_until'])
+
+    return job
+
+
+def run_job(job):
+    """Render a claimed job, retrying or dead-lettering it on failure"""
+    from core.models import ThumbnailJob, UserImage
+
+    # Only the worker holding the current lock may finish the job
+    owned = ThumbnailJob.objects.filter(pk=job.pk,
+                                        locked_until=job.locked_until)
+
+    if job.attempts > settings.THUMBNAIL_JOB_MAX_ATTEMPTS:
+        # A worker died while running it too many times
+        fail_job(job, owned, 'Worker lost the job too many times')
+        return False
+
+    try:
+        UserImage.objects.get(pk=job.image_id).render_thumbnails(job.heights)
+    except Exception as error:
+        logger.exception('Thumbnail job %s failed', job.pk)
+        fail_job(job, owned, repr(error))
+        return False
+
+    owned.delete()
+    return True
+
+
+def fail_job(job, owned, error):
+    """Put a failed job back with a backoff, or dead-letter it"""
+    from core.models import ThumbnailJob
+
+    if job.attempts >= settings.THUMBNAIL_JOB_MAX_ATTEMPTS:
+        owned.update(status=ThumbnailJob.DEAD,
+                     locked_until=None,
+                     last_error=error)
+        mark_failed(job.image_id, job.heights)
+        return
+
+    delay = settings.THUMBNAIL_JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+    owned.update(status=ThumbnailJob.QUEUED,
+                 locked_until=None,
+                 run_after=timezone.now() + timedelta(seconds=delay),
+                 last_error=error)
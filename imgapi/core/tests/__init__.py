@@ -0,0 +1,36 @@
+"""
+Helpers shared by the tests
+"""
+import io
+import tempfile
+
+from PIL import Image
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+
+
+def create_user(**params):
+    """Create and return a new user"""
+    return get_user_model().objects.create_user(**params)
+
+
+def create_image_upload(name='test.png', size=(800, 600), color='black',
+                        format='PNG'):
+    """Create and return an uploadable image, a PNG by default"""
+    image_file = io.BytesIO()
+    Image.new('RGB', size, color).save(image_file, format=format)
+    return SimpleUploadedFile(name, image_file.getvalue())
+
+
+class MediaRootMixin:
+    """Run each test with its own empty MEDIA_ROOT"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
@@ -0,0 +1,171 @@
+"""
+Tests for the async read endpoints
+"""
+import asyncio
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+
+from django.core.cache import cache
+from django.test import AsyncClient, TestCase
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+
+from core import tasks
+from core.authentication import get_token_cache
+from core.link_cache import get_link_cache
+from core.models import (
+    User,
+    UserImage,
+    ExpiringLink,
+    Thumbnail,
+)
+from core.tests import (
+    MediaRootMixin,
+    create_image_upload,
+    create_user,
+)
+
+ASYNC_IMG_URL = reverse('async-image-list')
+
+
+def async_thumbnail_url(image_id, height):
+    """Create and return an async thumbnail URL"""
+    return reverse('async-image-thumbnail',
+                   kwargs={'id': image_id, 'height': height})
+
+
+class AsyncViewsTests(MediaRootMixin, TestCase):
+    """Test the async views answer like their sync counterparts"""
+
+    def setUp(self):
+        super().setUp()
+        get_token_cache().clear()
+        cache.clear()
+        self.client = AsyncClient()
+        self.user = create_user(email='user@example.com',
+                                password='test123',
+                                user_tier=User.ENTERPRISE)
+        self.auth = {
+            'AUTHORIZATION': f'Token {Token.objects.create(user=self.user)}',
+        }
+        self.image = UserImage.objects.create(image=create_image_upload(),
+                                              user=self.user)
+
+    async def test_auth_required(self):
+        """Test missing and invalid tokens are rejected"""
+        res = await self.client.get(ASYNC_IMG_URL)
+        res2 = await self.client.get(ASYNC_IMG_URL,
+                                     AUTHORIZATION='Token invalid')
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(res['WWW-Authenticate'], 'Token')
+        self.assertEqual(res2.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_list_images(self):
+        """Test listing pages through the user's images"""
+        await UserImage.objects.acreate(image=create_image_upload(),
+                                        user=self.user)
+
+        res = await self.client.get(ASYNC_IMG_URL, {'page_size': 1},
+                                    **self.auth)
+        data = res.json()
+        res2 = await self.client.get(data['next'], **self.auth)
+        data2 = res2.json()
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(len(data['results'][0]['thumbnails']), 2)
+        self.assertIsNotNone(data['results'][0]['original'])
+        self.assertEqual(len(data2['results']), 1)
+        self.assertIsNone(data2['next'])
+
+    async def test_list_cached(self):
+        """Test a repeated listing is served from the list cache"""
+        # Pages listing pending thumbnails are not cached
+        await sync_to_async(tasks.render)(self.image.pk,
+                                          self.user.thumbnail_heights)
+        res = await self.client.get(ASYNC_IMG_URL, **self.auth)
+
+        with patch('core.serializers.UserImageListSerializer') as serializer:
+            res2 = await self.client.get(ASYNC_IMG_URL, **self.auth)
+
+        serializer.assert_not_called()
+        self.assertEqual(res2.json(), res.json())
+
+    async def test_invalid_cursor(self):
+        """Test an invalid cursor is not found"""
+        res = await self.client.get(ASYNC_IMG_URL, {'cursor': 'invalid'},
+                                    **self.auth)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_thumbnail_rendered_on_first_request(self):
+        """Test a missing thumbnail is rendered and served"""
+        res = await self.client.get(async_thumbnail_url(self.image.id, 400),
+                                    **self.auth)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        thumbnail = await Thumbnail.objects.aget(image=self.image,
+                                                 height=400)
+        self.assertEqual(res['ETag'], thumbnail.etag)
+        self.assertEqual(b''.join(res.streaming_content),
+                         thumbnail.file.read())
+
+        res2 = await self.client.get(async_thumbnail_url(self.image.id, 400),
+                                     IF_NONE_MATCH=res['ETag'],
+                                     **self.auth)
+        self.assertEqual(res2.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    async def test_thumbnail_unavailable_height(self):
+        """Test heights outside the user's tier are not served"""
+        res = await self.client.get(async_thumbnail_url(self.image.id, 300),
+                                    **self.auth)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_expiring_link_served(self):
+        """Test a live link serves its image and an expired one does not"""
+        link = await ExpiringLink.objects.acreate(image=self.image,
+                                                  expires_after=300)
+        url = reverse('async-expiring-link-detail', kwargs={'id': link.id})
+
+        res = await self.client.get(url, RANGE='bytes=0-9')
+
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        with open(self.image.image.path, 'rb') as original:
+            self.assertEqual(b''.join(res.streaming_content),
+                             original.read(10))
+
+        await ExpiringLink.objects.filter(pk=link.pk).aupdate(
+            expires_at=link.created_on
+        )
+        # As after the link cache TTL, updates send no signal
+        get_link_cache().clear()
+        res2 = await self.client.get(url)
+        self.assertEqual(res2.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_expiring_link_misses_coalesced(self):
+        """Test concurrent requests of an uncached link look it up once"""
+        get_link_cache().clear()
+        link = await ExpiringLink.objects.acreate(image=self.image,
+                                                  expires_after=300)
+        url = reverse('async-expiring-link-detail', kwargs={'id': link.id})
+        calls = []
+
+        async def aget_variant_name(image, *args):
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return image.image.name
+
+        with patch.object(UserImage, 'aget_variant_name', autospec=True,
+                          side_effect=aget_variant_name):
+            responses = await asyncio.gather(*[
+                self.client.get(url) for _ in range(5)
+            ])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual({res.status_code for res in responses},
+                         {status.HTTP_200_OK})
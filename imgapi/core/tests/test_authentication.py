@@ -0,0 +1,82 @@
+"""
+Tests for cached token authentication
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from core.authentication import (
+    CachedTokenAuthentication,
+    TokenCache,
+    get_token_cache,
+)
+from core.models import User
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    """Test caching resolved tokens"""
+
+    def setUp(self):
+        get_token_cache().clear()
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.auth = CachedTokenAuthentication()
+
+    def test_token_resolved_once(self):
+        """Test a cached token is authenticated without queries"""
+        with self.assertNumQueries(1):
+            user, token = self.auth.authenticate_credentials(self.token.key)
+        with self.assertNumQueries(0):
+            user2, token2 = self.auth.authenticate_credentials(self.token.key)
+
+        self.assertEqual(user2, self.user)
+        self.assertEqual(token2, self.token)
+        self.assertIsNot(user2, user)
+
+    def test_deleted_token_rejected(self):
+        """Test logging out stops the cached token from working"""
+        self.auth.authenticate_credentials(self.token.key)
+
+        self.token.delete()
+
+        with self.assertRaises(AuthenticationFailed):
+            self.auth.authenticate_credentials(self.token.key)
+
+    def test_password_change_invalidates(self):
+        """Test changing the password drops the cached user"""
+        self.auth.authenticate_credentials(self.token.key)
+
+        self.user.set_password('newpass123')
+        self.user.save()
+
+        with self.assertNumQueries(1):
+            user, _ = self.auth.authenticate_credentials(self.token.key)
+        self.assertTrue(user.check_password('newpass123'))
+
+    def test_tier_change_invalidates(self):
+        """Test changing the tier is seen by the next request"""
+        self.auth.authenticate_credentials(self.token.key)
+
+        self.user.user_tier = User.ENTERPRISE
+        self.user.save()
+
+        user, _ = self.auth.authenticate_credentials(self.token.key)
+        self.assertEqual(user.thumbnail_heights, [200, 400])
+
+    def test_shared_cache_deletes_reach_every_process(self):
+        """Test with a shared cache a delete applies to other processes"""
+        cache.clear()
+        process = TokenCache(size=10, ttl=60, cache_alias='default')
+        other = TokenCache(size=10, ttl=60, cache_alias='default')
+        process.set(self.token.key, (self.user, self.token))
+        self.assertIsNotNone(other.get(self.token.key))
+
+        process.delete(self.token.key)
+
+        self.assertIsNone(other.get(self.token.key))
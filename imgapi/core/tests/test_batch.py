@@ -0,0 +1,110 @@
+"""
+Tests for batch image uploads
+"""
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import Blob, Thumbnail, ThumbnailJob, UserImage
+from core.tests import MediaRootMixin, create_image_upload
+
+IMG_BATCH_URL = reverse('image-batch')
+
+
+class BatchUploadAPITests(MediaRootMixin, TestCase):
+    """Test uploading many images in one request"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+            user_tier='P',
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def post_images(self, files):
+        return self.client.post(IMG_BATCH_URL, {'images': files},
+                                format='multipart')
+
+    def test_batch_created(self):
+        """Test every file becomes an image, same content stored once"""
+        files = [
+            create_image_upload('black.png'),
+            create_image_upload('white.png', color='white'),
+            create_image_upload('copy.png'),
+        ]
+
+        res = self.post_images(files)
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            [result['file'] for result in res.data['results']],
+            ['black.png', 'white.png', 'copy.png'],
+        )
+        self.assertEqual(len(res.data['results'][0]['image']['thumbnails']),
+                         2)
+        images = UserImage.objects.filter(user=self.user)
+        self.assertEqual(sorted(images.values_list('name', flat=True)),
+                         ['black', 'copy', 'white'])
+        self.assertEqual(sorted(Blob.objects.values_list('refcount',
+                                                         flat=True)),
+                         [1, 2])
+        self.assertEqual(images.get(name='copy').image.name,
+                         images.get(name='black').image.name)
+        self.assertTrue(all(image.image.storage.exists(image.image.name)
+                            for image in images))
+        self.assertEqual(
+            Thumbnail.objects.filter(status=Thumbnail.PENDING).count(), 6
+        )
+        self.assertEqual(ThumbnailJob.objects.count(), 3)
+
+    def test_partial_failure(self):
+        """Test invalid files are reported while the rest is created"""
+        broken = b'\x89PNG\r\n\x1a\n' + b'not an image' * 10
+        files = [
+            create_image_upload('good.png'),
+            SimpleUploadedFile('text.png', b'not an image'),
+            SimpleUploadedFile('broken.png', broken),
+            create_image_upload('image.gif'),
+        ]
+
+        res = self.post_images(files)
+
+        self.assertEqual(res.status_code, status.HTTP_207_MULTI_STATUS)
+        results = {result['file']: result for result in res.data['results']}
+        self.assertEqual(results['good.png']['status'],
+                         status.HTTP_201_CREATED)
+        for name in ['text.png', 'broken.png', 'image.gif']:
+            self.assertEqual(results[name]['status'],
+                             status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(UserImage.objects.get().name, 'good')
+
+    def test_all_failed(self):
+        """Test a batch without a valid file is a bad request"""
+        res = self.post_images([SimpleUploadedFile('text.png', b'text')])
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(res.data['results']), 1)
+        self.assertFalse(Blob.objects.exists())
+
+    @override_settings(BATCH_UPLOAD_MAX_FILES=1)
+    def test_too_many_files(self):
+        """Test the number of files per batch is limited"""
+        files = [create_image_upload('a.png'), create_image_upload('b.png')]
+
+        res = self.post_images(files)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(UserImage.objects.exists())
+
+    def test_empty_batch(self):
+        """Test a batch needs at least one file"""
+        res = self.post_images([])
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
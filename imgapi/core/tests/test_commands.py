@@ -1,14 +1,33 @@
 """
 Test custom Django management commands
 """
-
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
 from unittest.mock import patch
 
 from psycopg2 import OperationalError as Psycopg2Error
 
-from django.core.management import call_command
-from django.db.utils import OperationalError
-from django.test import SimpleTestCase
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db.utils import InterfaceError, OperationalError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from core import tasks
+from core.storage import shard_name
+from core.models import (
+    Blob,
+    ExpiringLink,
+    RevokedLink,
+    Thumbnail,
+    ThumbnailJob,
+    UserImage,
+)
+from core.tests import MediaRootMixin, create_image_upload
 
 
 @patch('core.management.commands.wait_for_db.Command.check')
@@ -33,3 +52,319 @@ class CommandTests(SimpleTestCase):
 
         self.assertEqual(patched_check.call_count, 6)
         patched_check.assert_called_with(databases=['default'])
+
+
+@patch('core.management.commands.process_thumbnails.close_old_connections')
+@override_settings(THUMBNAIL_JOB_MAX_ATTEMPTS=2)
+class ProcessThumbnailsTests(TestCase):
+    """Test the thumbnail worker command"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+        )
+
+    def create_image(self):
+        return UserImage.objects.create(
+            image=create_image_upload(size=(400, 300)),
+            user=self.user,
+        )
+
+    def test_process_thumbnails(self, patched_close):
+        """Test queued jobs are rendered and removed"""
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            image = self.create_image()
+            image.schedule_thumbnails([200])
+
+            call_command('process_thumbnails', '--once', stdout=StringIO())
+
+        self.assertFalse(ThumbnailJob.objects.exists())
+        thumbnail = Thumbnail.objects.get(image=image)
+        self.assertEqual(thumbnail.status, Thumbnail.READY)
+
+    @patch('core.management.commands.process_thumbnails.time.sleep')
+    @patch('core.management.commands.process_thumbnails.connection')
+    @patch('core.tasks.run_job')
+    def test_database_error_keeps_worker_running(self, patched_run,
+                                                 patched_connection,
+                                                 patched_sleep,
+                                                 patched_close):
+        """Test a database error in a job is logged and backed off"""
+        image = UserImage.objects.create(image='media/test.png',
+                                         user=self.user)
+        image.schedule_thumbnails([200])
+        image.schedule_thumbnails([300])
+        patched_run.side_effect = [InterfaceError('connection lost'), True]
+        out = StringIO()
+
+        with self.assertLogs('core.management.commands.process_thumbnails',
+                             level='ERROR'):
+            call_command('process_thumbnails', '--once', stdout=out)
+
+        self.assertEqual(patched_run.call_count, 2)
+        patched_connection.close.assert_called_once_with()
+        patched_sleep.assert_called_once_with(1)
+        self.assertIn('Processed 1 jobs, 1 failed', out.getvalue())
+
+    def test_failed_job_retried_then_dead_lettered(self, patched_close):
+        """Test failing jobs back off and end up dead"""
+        image = UserImage.objects.create(image='media/missing.png',
+                                         user=self.user)
+        image.schedule_thumbnails([200])
+
+        with self.assertLogs('core.tasks', level='ERROR'):
+            self.assertFalse(tasks.run_job(tasks.claim_job()))
+        job = ThumbnailJob.objects.get()
+        self.assertEqual((job.status, job.attempts),
+                         (ThumbnailJob.QUEUED, 1))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIsNone(tasks.claim_job())
+
+        job.run_after = timezone.now()
+        job.save()
+        with self.assertLogs('core.tasks', level='ERROR'):
+            tasks.run_job(tasks.claim_job())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ThumbnailJob.DEAD)
+        self.assertIn('FileNotFoundError', job.last_error)
+        self.assertEqual(Thumbnail.objects.get(image=image).status,
+                         Thumbnail.FAILED)
+        self.assertIsNone(tasks.claim_job())
+
+    def test_expired_running_job_reclaimed(self, patched_close):
+        """Test jobs of crashed workers are picked up again"""
+        image = UserImage.objects.create(image='media/missing.png',
+                                         user=self.user)
+        job = ThumbnailJob.objects.create(
+            image=image,
+            heights=[200],
+            status=ThumbnailJob.RUNNING,
+            attempts=1,
+            locked_until=timezone.now() - timedelta(seconds=1),
+        )
+
+        claimed = tasks.claim_job()
+
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual(claimed.attempts, 2)
+        self.assertGreater(claimed.locked_until, timezone.now())
+        self.assertIsNone(tasks.claim_job())
+
+
+class PurgeExpiredLinksTests(TestCase):
+    """Test purging expired links"""
+
+    def test_purge_expired_links(self):
+        """Test only expired links are deleted, batch by batch"""
+        user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+        )
+        image = UserImage.objects.create(image='media/test.png', user=user)
+        now = timezone.now()
+        for _ in range(5):
+            ExpiringLink.objects.create(image=image,
+                                        expires_at=now - timedelta(seconds=1))
+        live = ExpiringLink.objects.create(image=image)
+        RevokedLink.objects.create(id=live.id,
+                                   expires_at=now - timedelta(seconds=1))
+
+        call_command('purge_expired_links', '--batch-size', '2',
+                     stdout=StringIO())
+
+        self.assertEqual(list(ExpiringLink.objects.all()), [live])
+        self.assertFalse(RevokedLink.objects.exists())
+
+
+class ShardMediaTests(MediaRootMixin, TestCase):
+    """Test moving media into the sharded layout"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+        )
+
+    def save_png(self, name):
+        """Store a PNG under the exact name, as before sharding"""
+        return default_storage.save(name, create_image_upload(size=(400, 300)))
+
+    def test_shard_media(self):
+        """Test files are moved and names rewritten, once"""
+        image = UserImage.objects.create(image=self.save_png('media/a.png'),
+                                         user=self.user)
+        thumbnail, = image.render_thumbnails([200])
+        self.assertEqual(thumbnail.file.name,
+                         'media/thumbnails/200_a.standard.png')
+
+        sha = 'f' * 64
+        blob = Blob.objects.create(sha256=sha,
+                                   file=self.save_png(f'blobs/{sha}.png'),
+                                   size=1,
+                                   refcount=1)
+        blob_image = UserImage.objects.create(image=blob.file.name,
+                                              blob=blob,
+                                              user=self.user)
+        blob_thumbnail = Thumbnail.objects.create(
+            image=blob_image,
+            height=200,
+            format='PNG',
+            status=Thumbnail.READY,
+            file=self.save_png(f'thumbnails/{sha}/200.png'),
+            source=blob.file.name,
+        )
+
+        out = StringIO()
+        call_command('shard_media', '--batch-size', '1', stdout=out)
+        call_command('shard_media', stdout=out)
+
+        image.refresh_from_db()
+        thumbnail.refresh_from_db()
+        self.assertEqual(image.image.name, shard_name('media/a.png'))
+        self.assertEqual(thumbnail.file.name,
+                         os.path.dirname(image.image.name)
+                         + '/thumbnails/200_a.standard.png')
+        self.assertEqual(thumbnail.source, image.image.name)
+        self.assertTrue(os.path.exists(image.image.path))
+        self.assertTrue(os.path.exists(thumbnail.file.path))
+
+        blob_image.refresh_from_db()
+        blob_thumbnail.refresh_from_db()
+        self.assertEqual(blob_image.image.name, shard_name(f'blobs/{sha}.png'))
+        self.assertEqual(Blob.objects.get().file.name, blob_image.image.name)
+        self.assertEqual(blob_thumbnail.file.name,
+                         blob_image.get_thumbnail_name(200))
+        self.assertTrue(os.path.exists(blob_image.image.path))
+        self.assertTrue(os.path.exists(blob_thumbnail.file.path))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.media_root.name, 'thumbnails', sha)
+        ))
+        self.assertIn('Moved 0 images', out.getvalue())
+
+
+class BackfillImageMetadataTests(MediaRootMixin, TestCase):
+    """Test storing the metadata of images uploaded before"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+        )
+
+    def test_backfill_image_metadata(self):
+        """Test missing metadata is read, unreadable files are skipped"""
+        name = default_storage.save('media/a.png',
+                                    create_image_upload(size=(400, 300)))
+        images = [
+            UserImage.objects.create(image=name, user=self.user),
+            UserImage.objects.create(image=name, user=self.user),
+            UserImage.objects.create(image='media/missing.png',
+                                     user=self.user),
+        ]
+
+        out = StringIO()
+        call_command('backfill_image_metadata', '--batch-size', '2',
+                     stdout=out, stderr=StringIO())
+
+        for image in images:
+            image.refresh_from_db()
+        self.assertEqual(
+            [(image.width, image.height, image.format) for image in images],
+            [(400, 300, 'PNG'), (400, 300, 'PNG'), (None, None, '')],
+        )
+        self.assertEqual(images[0].size, default_storage.size(name))
+        self.assertEqual(images[0].orientation, 1)
+        self.assertIn('Updated 2 images, 1 unreadable', out.getvalue())
+
+
+class SweepThumbnailsTests(MediaRootMixin, TestCase):
+    """Test evicting thumbnails over the disk quota"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+            user_tier='P',
+        )
+
+    def create_thumbnail(self, name, size, accessed_days_ago):
+        image = UserImage.objects.create(image=f'media/{name}.png',
+                                         user=self.user)
+        file = default_storage.save(f'media/thumbnails/200_{name}.png',
+                                    ContentFile(b'x' * size))
+        return Thumbnail.objects.create(
+            image=image,
+            height=200,
+            format='PNG',
+            status=Thumbnail.READY,
+            file=file,
+            size=size,
+            source=image.image.name,
+            last_accessed=timezone.now() - timedelta(days=accessed_days_ago),
+        )
+
+    def test_least_recently_served_evicted(self):
+        """Test the oldest files are deleted until the rest fits"""
+        oldest = self.create_thumbnail('a', 100, accessed_days_ago=3)
+        older = self.create_thumbnail('b', 100, accessed_days_ago=2)
+        recent = self.create_thumbnail('c', 100, accessed_days_ago=1)
+        paths = [oldest.file.path, older.file.path, recent.file.path]
+
+        out = StringIO()
+        call_command('sweep_thumbnails', '--quota', '150', stdout=out)
+
+        for thumbnail in (oldest, older, recent):
+            thumbnail.refresh_from_db()
+        self.assertEqual(
+            [oldest.status, older.status, recent.status],
+            [Thumbnail.EVICTED, Thumbnail.EVICTED, Thumbnail.READY],
+        )
+        self.assertEqual([os.path.exists(path) for path in paths],
+                         [False, False, True])
+        self.assertIn('Evicted 2 files, 200 bytes', out.getvalue())
+
+    def test_shared_file_counted_once(self):
+        """Test a blob's file counts once, as recent as its last access"""
+        thumbnail = self.create_thumbnail('a', 100, accessed_days_ago=3)
+        shared = self.create_thumbnail('b', 100, accessed_days_ago=3)
+        image = UserImage.objects.create(image='media/b.png', user=self.user)
+        Thumbnail.objects.create(image=image,
+                                 height=200,
+                                 format='PNG',
+                                 status=Thumbnail.READY,
+                                 file=shared.file.name,
+                                 size=100,
+                                 source=image.image.name,
+                                 last_accessed=timezone.now())
+
+        call_command('sweep_thumbnails', '--quota', '100', stdout=StringIO())
+
+        thumbnail.refresh_from_db()
+        self.assertEqual(thumbnail.status, Thumbnail.EVICTED)
+        self.assertEqual(
+            Thumbnail.objects.filter(file=shared.file.name).count(), 2
+        )
+
+    def test_dry_run(self):
+        """Test a dry run reports without deleting"""
+        thumbnail = self.create_thumbnail('a', 100, accessed_days_ago=3)
+
+        out = StringIO()
+        call_command('sweep_thumbnails', '--quota', '0', '--dry-run',
+                     stdout=out)
+
+        thumbnail.refresh_from_db()
+        self.assertEqual(thumbnail.status, Thumbnail.READY)
+        self.assertTrue(os.path.exists(thumbnail.file.path))
+        self.assertIn('Would evict 1 files, 100 bytes', out.getvalue())
+
+    def test_quota_required(self):
+        """Test sweeping without a quota is an error"""
+        with self.assertRaises(CommandError):
+            call_command('sweep_thumbnails', stdout=StringIO())
@@ -0,0 +1,42 @@
+"""
+Tests for thumbnail format negotiation
+"""
+from unittest.mock import patch
+
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from core import formats
+
+
+@override_settings(THUMBNAIL_FORMATS=['AVIF', 'WEBP'])
+@patch('core.formats.can_save', side_effect=lambda img_format: True)
+class NegotiateTests(SimpleTestCase):
+    """Test picking the format to serve"""
+
+    def negotiate(self, accept):
+        request = RequestFactory().get('/', HTTP_ACCEPT=accept)
+        return formats.negotiate(request, 'PNG')
+
+    def test_preferred_format_picked(self, patched_can_save):
+        """Test the first offered format the client names wins"""
+        self.assertEqual(self.negotiate('image/webp,image/avif'), 'AVIF')
+        self.assertEqual(self.negotiate('image/webp, */*;q=0.8'), 'WEBP')
+
+    def test_wildcards_ignored(self, patched_can_save):
+        """Test clients only naming wildcards get the original format"""
+        self.assertEqual(self.negotiate('image/*,*/*'), 'PNG')
+        self.assertEqual(self.negotiate(''), 'PNG')
+
+    def test_refused_format_skipped(self, patched_can_save):
+        """Test formats with q=0 or a broken q are not served"""
+        accept = 'image/avif;q=0, image/webp;q=oops'
+
+        self.assertEqual(self.negotiate(accept), 'PNG')
+
+    def test_unsupported_format_skipped(self, patched_can_save):
+        """Test formats Pillow can't write are not offered"""
+        patched_can_save.side_effect = lambda img_format: (
+            img_format != 'AVIF'
+        )
+
+        self.assertEqual(self.negotiate('image/avif,image/webp'), 'WEBP')
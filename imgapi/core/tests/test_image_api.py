@@ -1,18 +1,34 @@
+import hashlib
 import tempfile
 import os
 import shutil
+from datetime import datetime
+from unittest.mock import patch
 
 from PIL import Image
 
-from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from core.models import User, UserImage, ExpiringLink
-from core import serializers
+from core.models import (
+    Blob,
+    User,
+    UserImage,
+    ExpiringLink,
+    RevokedLink,
+    Thumbnail,
+)
+from core import serializers, tasks
+from core.tests import (
+    MediaRootMixin,
+    create_image_upload,
+    create_user,
+)
 
 IMG_URL = reverse('image-list')
 IMG_CREATE_URL = reverse('image-create')
@@ -21,9 +37,10 @@ TEMP_LINK_CREATE_URL = reverse('expiring-link-create')
 TEST_DIR = 'test_image'
 
 
-def create_user(**params):
-    """Create and return a new user"""
-    return get_user_model().objects.create_user(**params)
+def thumbnail_url(image_id, height):
+    """Create and return a thumbnail URL"""
+    return reverse('image-thumbnail',
+                   kwargs={'id': image_id, 'height': height})
 
 
 class PublicUserImageAPITest(TestCase):
@@ -60,6 +77,51 @@ class PrivateUserImageAPITest(TestCase):
 
         self.assertEqual(res.status_code, status.HTTP_201_CREATED)
         self.assertIn('image', res.data)
+        self.assertEqual(res.data['thumbnails'], [{
+            'height': 200,
+            'width': 10,
+            'status': 'pending',
+            'url': None,
+        }])
+
+    @override_settings(MEDIA_ROOT=os.path.join(TEST_DIR, 'media'))
+    def test_create_user_image_deduplicated(self):
+        """Test uploads are hashed while received and stored once"""
+        upload = create_image_upload()
+        content = upload.read()
+
+        with patch.object(Blob.objects, 'get_digest',
+                          wraps=Blob.objects.get_digest) as get_digest:
+            for _ in range(2):
+                upload.seek(0)
+                res = self.client.post(IMG_CREATE_URL, {'image': upload},
+                                       format='multipart')
+                self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(UserImage.objects.filter(blob=blob).count(), 2)
+        self.assertTrue(all(getattr(call.args[0], 'sha256', None)
+                            for call in get_digest.call_args_list))
+
+    @override_settings(MEDIA_ROOT=os.path.join(TEST_DIR, 'media'),
+                       THUMBNAIL_QUEUE='pool',
+                       THUMBNAIL_QUEUE_FULL='reject')
+    def test_create_user_image_queue_full(self):
+        """Test uploads are rejected while the thumbnail queue is full"""
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as image_file:
+            img = Image.new('RGB', (10, 10))
+            img.save(image_file, format='JPEG')
+            image_file.seek(0)
+            payload = {'image': image_file}
+            with patch.object(tasks.ThumbnailPool, 'is_full',
+                              return_value=True):
+                res = self.client.post(IMG_CREATE_URL, payload,
+                                       format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertFalse(UserImage.objects.exists())
 
     @override_settings(MEDIA_ROOT=os.path.join(TEST_DIR, 'test'))
     def test_list_user_images(self):
@@ -72,9 +134,90 @@ class PrivateUserImageAPITest(TestCase):
             self.client.post(IMG_CREATE_URL, payload, format='multipart')
 
         res = self.client.get(IMG_URL)
-        self.assertEqual(len(res.data), 1)
+        self.assertEqual(len(res.data['results']), 1)
+        self.assertIsNone(res.data['next'])
         self.assertEqual(res.status_code, status.HTTP_200_OK)
 
+    def test_list_user_images_paginated(self):
+        """Test images are paged newest first by cursor"""
+        images = [
+            UserImage.objects.create(image=f'media/test{i}.png',
+                                     name=f'test{i}',
+                                     user=self.user)
+            for i in range(5)
+        ]
+        # Two images share a timestamp, the id breaks the tie
+        UserImage.objects.filter(pk=images[1].pk).update(
+            when_created=images[2].when_created
+        )
+        expected = sorted(
+            UserImage.objects.all(),
+            key=lambda image: (-image.when_created.timestamp(),
+                               str(image.id)),
+        )
+
+        names = []
+        url = IMG_URL + '?page_size=2'
+        while url:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(res.data['results']), 2)
+            names += [image['name'] for image in res.data['results']]
+            url = res.data['next']
+
+        self.assertEqual(names, [image.name for image in expected])
+
+    def test_list_user_images_query_count(self):
+        """Test listing costs the same queries for any page size"""
+        self.user.user_tier = User.ENTERPRISE
+        self.user.save()
+
+        def create_image(i):
+            image = UserImage.objects.create(image=f'media/test{i}.png',
+                                             user=self.user)
+            for height in self.user.thumbnail_heights:
+                Thumbnail.objects.create(image=image,
+                                         height=height,
+                                         format='PNG',
+                                         status=Thumbnail.READY,
+                                         file=f'media/{height}_test{i}.png',
+                                         source=image.image.name,
+                                         profile=image.encoder_profile)
+
+        create_image(0)
+        with self.assertNumQueries(2):
+            res = self.client.get(IMG_URL)
+        self.assertEqual(len(res.data['results']), 1)
+
+        for i in range(1, 6):
+            create_image(i)
+        with self.assertNumQueries(2):
+            res = self.client.get(IMG_URL)
+        self.assertEqual(len(res.data['results']), 6)
+        self.assertIsNotNone(res.data['results'][0]['original'])
+
+    def test_list_user_images_dimensions(self):
+        """Test dimensions are listed from metadata, files are not read"""
+        image = UserImage.objects.create(image='media/missing.png',
+                                         user=self.user,
+                                         width=1600,
+                                         height=1200)
+        Thumbnail.objects.create(image=image, height=200, format='PNG')
+
+        with patch('PIL.Image.open') as image_open:
+            res = self.client.get(IMG_URL)
+
+        image_open.assert_not_called()
+        result = res.data['results'][0]
+        self.assertEqual((result['width'], result['height']), (1600, 1200))
+        self.assertEqual(result['thumbnails'][0]['width'], 266)
+
+    def test_list_user_images_invalid_cursor(self):
+        """Test an invalid cursor is rejected"""
+        res = self.client.get(IMG_URL, {'cursor': 'invalid'})
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_exp_link_list_and_create(self):
         """Test listing and creating expiring links"""
         user2 = create_user(email='email@example.com',
@@ -123,3 +266,310 @@ class PrivateUserImageAPITest(TestCase):
         except OSError:
             pass
         os.makedirs('/app/test_image/test/media/thumbnails')
+
+
+class UserImageThumbnailAPITest(MediaRootMixin, TestCase):
+    """Tests for serving thumbnails"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = create_user(email='user@example.com',
+                                password='test123',
+                                user_tier=User.PREMIUM)
+        self.client.force_authenticate(user=self.user)
+        self.image = UserImage.objects.create(image=create_image_upload(),
+                                              user=self.user)
+
+    def test_thumbnail_rendered_on_first_request(self):
+        """Test a missing thumbnail is rendered and served"""
+        res = self.client.get(thumbnail_url(self.image.id, 400))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'image/png')
+        self.assertIn('immutable', res['Cache-Control'])
+        thumbnail = Thumbnail.objects.get(image=self.image, height=400)
+        self.assertEqual(res['ETag'], thumbnail.etag)
+        self.assertEqual(b''.join(res.streaming_content),
+                         thumbnail.file.read())
+
+    def test_conditional_get_not_modified(self):
+        """Test revalidating with the ETag answers 304"""
+        res = self.client.get(thumbnail_url(self.image.id, 200))
+        res.close()
+
+        with patch.object(UserImage, 'render_thumbnails') as render:
+            res2 = self.client.get(thumbnail_url(self.image.id, 200),
+                                   HTTP_IF_NONE_MATCH=res['ETag'])
+            res3 = self.client.get(thumbnail_url(self.image.id, 200),
+                                   HTTP_IF_MODIFIED_SINCE=res['Last-Modified'])
+
+        render.assert_not_called()
+        self.assertEqual(res2.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(res2['ETag'], res['ETag'])
+        self.assertEqual(res3.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_thumbnail_format_negotiated(self):
+        """Test clients accepting WebP get it, each format is cached"""
+        res = self.client.get(thumbnail_url(self.image.id, 200),
+                              HTTP_ACCEPT='image/webp,*/*;q=0.8')
+        res.close()
+        with patch.object(UserImage, 'render_thumbnails') as render:
+            res2 = self.client.get(thumbnail_url(self.image.id, 200),
+                                   HTTP_ACCEPT='image/webp,*/*;q=0.8')
+            res2.close()
+        res3 = self.client.get(thumbnail_url(self.image.id, 200),
+                               HTTP_ACCEPT='*/*')
+        res3.close()
+
+        render.assert_not_called()
+        self.assertEqual(res['Content-Type'], 'image/webp')
+        self.assertEqual(res2['ETag'], res['ETag'])
+        self.assertEqual(res3['Content-Type'], 'image/png')
+        self.assertNotEqual(res3['ETag'], res['ETag'])
+        for response in (res, res3):
+            self.assertEqual(response['Vary'], 'Accept')
+        webp = Thumbnail.objects.get(image=self.image, format='WEBP')
+        self.assertTrue(webp.file.name.endswith('/200.standard.webp'))
+        with Image.open(webp.file.path) as img:
+            self.assertEqual((img.format, img.height), ('WEBP', 200))
+
+    @override_settings(THUMBNAIL_FORMATS=[])
+    def test_thumbnail_formats_disabled(self):
+        """Test only the original's format is served when none offered"""
+        res = self.client.get(thumbnail_url(self.image.id, 200),
+                              HTTP_ACCEPT='image/webp')
+        res.close()
+
+        self.assertEqual(res['Content-Type'], 'image/png')
+
+    def test_unavailable_height_not_found(self):
+        """Test heights outside the user's tier are not served"""
+        res = self.client.get(thumbnail_url(self.image.id, 300))
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_other_users_image_not_found(self):
+        """Test thumbnails of other users' images are not served"""
+        other = create_user(email='other@example.com',
+                            password='test123',
+                            user_tier=User.PREMIUM)
+        self.client.force_authenticate(user=other)
+
+        res = self.client.get(thumbnail_url(self.image.id, 200))
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(EXPIRING_LINK_SIGNED=True)
+class SignedExpiringLinkAPITest(MediaRootMixin, TestCase):
+    """Tests for signed expiring links"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.client = APIClient()
+        self.user = create_user(email='user@example.com',
+                                password='test123',
+                                user_tier=User.ENTERPRISE)
+        self.client.force_authenticate(user=self.user)
+        self.image = UserImage.objects.create(image=create_image_upload(),
+                                              user=self.user)
+
+    def create_link(self, **params):
+        payload = {'image': self.image.id, 'expires_after': 300}
+        payload.update(params)
+        res = self.client.post(TEMP_LINK_CREATE_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        return ExpiringLink.objects.get(image=self.image, **params)
+
+    def test_signed_link_served_without_queries(self):
+        """Test a valid signed link is verified without the database"""
+        link = self.create_link(height=400)
+        self.assertIn('/expiring-link/s/', link.link)
+        client = APIClient()
+        # Renders the thumbnail and loads the revocation list
+        client.get(link.link).close()
+
+        with self.assertNumQueries(0):
+            res = client.get(link.link)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        thumbnail = Thumbnail.objects.get(image=self.image, height=400)
+        self.assertEqual(b''.join(res.streaming_content),
+                         thumbnail.file.read())
+
+    def test_signed_link_format_negotiated(self):
+        """Test thumbnails of signed links are negotiated too"""
+        link = self.create_link(height=400)
+        client = APIClient()
+        client.get(link.link, HTTP_ACCEPT='image/webp').close()
+
+        with self.assertNumQueries(0):
+            res = client.get(link.link, HTTP_ACCEPT='image/webp')
+
+        self.assertEqual(res['Content-Type'], 'image/webp')
+        self.assertEqual(res['Vary'], 'Accept')
+        thumbnail = Thumbnail.objects.get(image=self.image,
+                                          height=400,
+                                          format='WEBP')
+        self.assertEqual(b''.join(res.streaming_content),
+                         thumbnail.file.read())
+
+    def test_tampered_signed_link_not_found(self):
+        """Test a link with a modified payload is rejected"""
+        link = self.create_link()
+        token = link.link.rsplit('/', 1)[1]
+        value, signature = token.rsplit(':', 1)
+        tampered = reverse('expiring-link-signed',
+                           kwargs={'token': f'{value}x:{signature}'})
+
+        res = APIClient().get(tampered)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_expired_signed_link(self):
+        """Test an expired signed link is dead"""
+        link = self.create_link()
+        expired = timezone.now() + timezone.timedelta(seconds=301)
+
+        with patch('core.signed_links.datetime') as patched_datetime:
+            patched_datetime.now.return_value = expired
+            patched_datetime.fromtimestamp = datetime.fromtimestamp
+            res = APIClient().get(link.link)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_revoked_signed_link(self):
+        """Test a revoked signed link stops working"""
+        link = self.create_link()
+        client = APIClient()
+        self.assertEqual(client.get(link.link).status_code,
+                         status.HTTP_200_OK)
+
+        res = self.client.post(reverse('expiring-link-revoke',
+                                       kwargs={'id': link.id}))
+
+        self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertTrue(RevokedLink.objects.filter(id=link.id).exists())
+        self.assertEqual(client.get(link.link).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+    def test_signed_link_of_deleted_image_not_found(self):
+        """Test a link outliving its image is not found before revoked"""
+        link = self.create_link(height=200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.image.delete()
+
+        # A process whose revocations were loaded before the delete
+        with patch('core.signed_links.get_revoked', return_value=set()):
+            res = APIClient().get(link.link)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_link_for_unavailable_height_rejected(self):
+        """Test links are only created for the user's heights"""
+        payload = {'image': self.image.id,
+                   'height': 300,
+                   'expires_after': 300}
+
+        res = self.client.post(TEMP_LINK_CREATE_URL, payload)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_link_for_other_users_image_rejected(self):
+        """Test links are only created for the user's own images"""
+        other = create_user(email='other@example.com',
+                            password='test123',
+                            user_tier=User.ENTERPRISE)
+        self.client.force_authenticate(user=other)
+
+        res = self.client.post(TEMP_LINK_CREATE_URL,
+                               {'image': self.image.id,
+                                'expires_after': 300})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ExpiringLinkDetailAPITest(MediaRootMixin, TestCase):
+    """Tests for serving images through expiring links"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = create_user(email='user@example.com',
+                                password='test123',
+                                user_tier=User.ENTERPRISE)
+        self.image = UserImage.objects.create(image=create_image_upload(),
+                                              user=self.user)
+        self.link = ExpiringLink.objects.create(image=self.image,
+                                                expires_after=300)
+        self.url = reverse('expiring-link-detail',
+                           kwargs={'id': self.link.id})
+        with open(self.image.image.path, 'rb') as original:
+            self.content = original.read()
+
+    def test_original_streamed(self):
+        """Test the link streams the original file"""
+        res = self.client.get(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'image/png')
+        self.assertEqual(res['Accept-Ranges'], 'bytes')
+        self.assertEqual(int(res['Content-Length']), len(self.content))
+        self.assertIn('max-age=', res['Cache-Control'])
+        self.assertEqual(b''.join(res.streaming_content), self.content)
+
+    def test_negotiated_format_typed(self):
+        """Test a thumbnail in a negotiated format is sent with its type"""
+        link = ExpiringLink.objects.create(image=self.image,
+                                           height=200,
+                                           expires_after=300)
+        url = reverse('expiring-link-detail', kwargs={'id': link.id})
+
+        # Like Pythons whose mimetypes don't know WebP or AVIF
+        with patch('core.sendfile.mimetypes.guess_type',
+                   return_value=(None, None)):
+            res = self.client.get(url, HTTP_ACCEPT='image/webp')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'image/webp')
+
+    def test_range_request(self):
+        """Test a byte range is answered with partial content"""
+        res = self.client.get(self.url, HTTP_RANGE='bytes=10-29')
+        res2 = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        res3 = self.client.get(self.url, HTTP_RANGE='bytes=999999-')
+
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(res['Content-Range'],
+                         f'bytes 10-29/{len(self.content)}')
+        self.assertEqual(b''.join(res.streaming_content),
+                         self.content[10:30])
+        self.assertEqual(b''.join(res2.streaming_content),
+                         self.content[-5:])
+        self.assertEqual(res3.status_code,
+                         status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+    @override_settings(SENDFILE_BACKEND='nginx')
+    def test_reverse_proxy_sends_file(self):
+        """Test only a redirect header is sent behind nginx"""
+        res = self.client.get(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['X-Accel-Redirect'],
+                         '/protected/' + self.image.image.name)
+        self.assertEqual(res.content, b'')
+
+    def test_expired_link_not_found(self):
+        """Test an expired link serves nothing and is not listed"""
+        ExpiringLink.objects.filter(pk=self.link.pk).update(
+            expires_at=timezone.now()
+        )
+        self.client.force_authenticate(user=self.user)
+
+        res = self.client.get(self.url)
+        res2 = self.client.get(TEMP_LINK_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(res2.data, [])
@@ -0,0 +1,156 @@
+"""
+Tests for the expiring link micro-cache
+"""
+import asyncio
+import threading
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.link_cache import LinkCache, ResolvedLink, get_link_cache
+from core.models import ExpiringLink, User, UserImage
+from core.tests import MediaRootMixin, create_image_upload
+
+
+def resolved_link(expires_in=300):
+    return ResolvedLink('media/test.png', None,
+                        timezone.now() + timedelta(seconds=expires_in))
+
+
+class LinkCacheTests(SimpleTestCase):
+    """Test the cache of resolved links"""
+
+    def test_entry_expires_with_link(self):
+        """Test a link is not cached past its expiry"""
+        link_cache = LinkCache(size=10, ttl=60)
+        link_cache.set('short', resolved_link(expires_in=0.05))
+        link_cache.set('long', resolved_link())
+
+        time.sleep(0.1)
+
+        self.assertIsNone(link_cache.get('short'))
+        self.assertIsNotNone(link_cache.get('long'))
+
+    def test_concurrent_misses_coalesced(self):
+        """Test requests missing a link at once resolve it once"""
+        link_cache = LinkCache(size=10, ttl=60)
+        first_resolving = threading.Event()
+        calls = []
+        results = []
+
+        def resolve():
+            calls.append(1)
+            first_resolving.set()
+            time.sleep(0.1)
+            return resolved_link()
+
+        def request():
+            results.append(link_cache.get_or_resolve('link', resolve))
+
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        threads[0].start()
+        first_resolving.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(link_cache.resolving, {})
+
+    async def test_concurrent_async_misses_coalesced(self):
+        """Test async requests missing a link at once resolve it once"""
+        link_cache = LinkCache(size=10, ttl=60)
+        calls = []
+
+        async def resolve():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return resolved_link()
+
+        results = await asyncio.gather(*[
+            link_cache.aget_or_resolve('link', resolve) for _ in range(5)
+        ])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(link_cache.aresolving, {})
+
+    def test_failed_resolve_not_cached(self):
+        """Test an error is raised to every waiter and nothing cached"""
+        link_cache = LinkCache(size=10, ttl=60)
+
+        with self.assertRaises(LookupError):
+            link_cache.get_or_resolve('link', self.fail_resolve)
+
+        self.assertIsNone(link_cache.get('link'))
+        self.assertEqual(link_cache.resolving, {})
+
+    def fail_resolve(self):
+        raise LookupError('missing')
+
+
+class ExpiringLinkCacheAPITests(MediaRootMixin, TestCase):
+    """Test hot expiring links are served from the cache"""
+
+    def setUp(self):
+        super().setUp()
+        get_link_cache().clear()
+        self.client = APIClient()
+        user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+            user_tier=User.ENTERPRISE,
+        )
+        image = UserImage.objects.create(image=create_image_upload(),
+                                         user=user)
+        self.link = ExpiringLink.objects.create(image=image,
+                                                height=200,
+                                                expires_after=300)
+        self.url = reverse('expiring-link-detail',
+                           kwargs={'id': self.link.id})
+
+    def test_repeat_request_served_without_queries(self):
+        """Test a resolved link is served again without the database"""
+        self.client.get(self.url)
+
+        with self.assertNumQueries(0):
+            res = self.client.get(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_formats_cached_apart(self):
+        """Test each negotiated format is its own entry"""
+        res = self.client.get(self.url)
+        res2 = self.client.get(self.url, HTTP_ACCEPT='image/webp')
+
+        self.assertEqual(res['Content-Type'], 'image/png')
+        self.assertEqual(res2['Content-Type'], 'image/webp')
+
+    def test_deleted_link_not_served(self):
+        """Test deleting a link drops it from the cache"""
+        self.client.get(self.url)
+
+        self.link.delete()
+        res = self.client.get(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cached_link_max_age(self):
+        """Test max-age of a cached link counts down to its expiry"""
+        self.client.get(self.url)
+
+        with patch('core.views.timezone.now',
+                   return_value=self.link.expires_at - timedelta(seconds=5)):
+            res = self.client.get(self.url)
+
+        self.assertIn('max-age=5', res['Cache-Control'])
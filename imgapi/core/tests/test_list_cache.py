@@ -0,0 +1,156 @@
+"""
+Tests for the image list cache
+"""
+import tempfile
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache.backends.filebased import FileBasedCache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from core import list_cache, tasks
+from core.models import Thumbnail, User, UserImage
+
+IMG_URL = reverse('image-list')
+
+
+class ImageListCacheTests(TestCase):
+    """Test list pages are cached until what they show changes"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache_settings = override_settings(CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            },
+            'shared': {
+                'BACKEND':
+                    'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': self.cache_dir.name,
+            },
+        })
+        self.cache_settings.enable()
+
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+            user_tier=User.PREMIUM,
+        )
+        self.client.force_authenticate(user=self.user)
+        self.image = UserImage.objects.create(image='media/test.png',
+                                              user=self.user)
+        for height in self.user.thumbnail_heights:
+            Thumbnail.objects.create(image=self.image,
+                                     height=height,
+                                     format='PNG',
+                                     status=Thumbnail.READY,
+                                     file=f'media/{height}_test.png',
+                                     source=self.image.image.name,
+                                     profile=self.image.encoder_profile)
+
+    def tearDown(self):
+        self.cache_settings.disable()
+        self.cache_dir.cleanup()
+
+    def test_repeat_list_served_without_queries(self):
+        """Test a listed page is served again from the cache"""
+        res = self.client.get(IMG_URL)
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(IMG_URL)
+
+        self.assertEqual(cached.data, res.data)
+
+    def test_query_parameters_cached_apart(self):
+        """Test each page size and cursor is its own entry"""
+        UserImage.objects.create(image='media/test2.png', user=self.user)
+        self.client.get(IMG_URL)
+
+        res = self.client.get(IMG_URL, {'page_size': 1})
+
+        self.assertEqual(len(res.data['results']), 1)
+        self.assertIsNotNone(res.data['next'])
+
+    def test_new_and_deleted_images_listed(self):
+        """Test uploads and deletions invalidate the user's pages"""
+        self.client.get(IMG_URL)
+
+        image = UserImage.objects.create(image='media/test2.png',
+                                         user=self.user)
+        self.assertEqual(len(self.client.get(IMG_URL).data['results']), 2)
+
+        image.delete()
+        self.assertEqual(len(self.client.get(IMG_URL).data['results']), 1)
+
+    def test_tier_change_listed(self):
+        """Test a new tier lists its thumbnail heights"""
+        self.client.get(IMG_URL)
+
+        self.user.user_tier = User.BASIC
+        self.user.save()
+        res = self.client.get(IMG_URL)
+
+        self.assertEqual(len(res.data['results'][0]['thumbnails']), 1)
+        self.assertIsNone(res.data['results'][0]['original'])
+
+    def test_thumbnail_status_listed(self):
+        """Test rendered and failed thumbnails update the listing"""
+        thumbnail = self.image.thumbnails.first()
+        thumbnail.status = Thumbnail.PENDING
+        thumbnail.save()
+        self.client.get(IMG_URL)
+
+        tasks.mark_failed(self.image.pk, [thumbnail.height])
+        res = self.client.get(IMG_URL)
+
+        statuses = {t['height']: t['status']
+                    for t in res.data['results'][0]['thumbnails']}
+        self.assertEqual(statuses[thumbnail.height], Thumbnail.FAILED)
+
+    def test_pending_thumbnails_not_cached(self):
+        """Test a page listing pending thumbnails is built every time"""
+        Thumbnail.objects.filter(image=self.image).update(
+            status=Thumbnail.PENDING
+        )
+        self.client.get(IMG_URL)
+
+        with self.assertNumQueries(2):
+            self.client.get(IMG_URL)
+
+    def test_invalidated_by_other_processes(self):
+        """Test changes made by another process, like a command, list"""
+        self.client.get(IMG_URL)
+
+        other_cache = FileBasedCache(self.cache_dir.name, {})
+        with patch.object(list_cache, 'get_cache',
+                          return_value=other_cache), \
+                self.captureOnCommitCallbacks(execute=True):
+            UserImage.objects.create(image='media/test2.png', user=self.user)
+        res = self.client.get(IMG_URL)
+
+        self.assertEqual(len(res.data['results']), 2)
+
+    def test_other_users_unaffected(self):
+        """Test pages are cached per user"""
+        other = get_user_model().objects.create_user(
+            email='other@example.com',
+            password='test123',
+        )
+        self.client.get(IMG_URL)
+        self.client.force_authenticate(user=other)
+
+        res = self.client.get(IMG_URL)
+
+        self.assertEqual(res.data['results'], [])
+
+    @override_settings(IMAGE_LIST_CACHE={'CACHE': None, 'TTL': 300})
+    def test_cache_disabled(self):
+        """Test every list call is built when caching is disabled"""
+        self.client.get(IMG_URL)
+
+        with self.assertNumQueries(2):
+            self.client.get(IMG_URL)
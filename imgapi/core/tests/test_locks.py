@@ -0,0 +1,41 @@
+"""
+Tests for thumbnail variant locks
+"""
+import threading
+
+from django.test import SimpleTestCase, override_settings
+
+from core import locks
+from core.tests import MediaRootMixin
+
+
+class VariantLockTests(MediaRootMixin, SimpleTestCase):
+    """Test variants are rendered by one worker at a time"""
+
+    def test_lock_excludes_other_workers(self):
+        """Test a second holder of a variant waits for the first"""
+        events = []
+        locked = threading.Event()
+
+        def hold():
+            with locks.variant_locks(['thumbnails/a/200.png']):
+                locked.set()
+                events.append('waiter')
+
+        with locks.variant_locks(['thumbnails/a/200.png']):
+            thread = threading.Thread(target=hold)
+            thread.start()
+            self.assertFalse(locked.wait(0.2))
+            events.append('holder')
+        thread.join()
+
+        self.assertEqual(events, ['holder', 'waiter'])
+
+    @override_settings(THUMBNAIL_LOCK_STRIPES=1)
+    def test_shared_stripe_taken_once(self):
+        """Test variants hashed onto one lock file don't deadlock"""
+        names = ['thumbnails/a/200.png', 'thumbnails/a/400.png']
+        self.assertEqual(len({locks.get_stripe(name) for name in names}), 1)
+
+        with locks.variant_locks(names):
+            pass
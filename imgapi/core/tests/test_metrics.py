@@ -0,0 +1,127 @@
+"""
+Tests for request metrics
+"""
+from django.contrib.auth import get_user_model
+from django.test import (
+    AsyncClient,
+    SimpleTestCase,
+    TestCase,
+    override_settings,
+)
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core import metrics
+from core.authentication import get_token_cache
+from core.models import User, UserImage
+from core.tests import MediaRootMixin, create_image_upload
+
+METRICS_URL = reverse('metrics')
+
+
+def server_timing(response):
+    """Parse a Server-Timing header into durations by name"""
+    durations = {}
+    for part in response['Server-Timing'].split(','):
+        name, *params = part.strip().split(';')
+        durations[name] = dict(param.split('=', 1) for param in params)
+    return durations
+
+
+class ExpositionTests(SimpleTestCase):
+    """Test metrics are written in the Prometheus text format"""
+
+    def test_histogram(self):
+        """Test buckets are cumulative and end with +Inf"""
+        histogram = metrics.Histogram('test_seconds', 'Test', ('view',),
+                                      buckets=(0.1, 1.0))
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+        histogram.observe(5, 'a')
+
+        self.assertEqual(histogram.expose(), [
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{view="a",le="0.1"} 1',
+            'test_seconds_bucket{view="a",le="1.0"} 2',
+            'test_seconds_bucket{view="a",le="+Inf"} 3',
+            'test_seconds_count{view="a"} 3',
+            'test_seconds_sum{view="a"} 5.55',
+        ])
+
+    def test_counter_labels_escaped(self):
+        """Test label values are escaped"""
+        counter = metrics.Counter('test_total', 'Test', ('view',))
+        counter.inc(2, 'say "hi"\n')
+
+        self.assertEqual(counter.expose()[-1],
+                         'test_total{view="say \\"hi\\"\\n"} 2.0')
+
+
+class MetricsMiddlewareTests(MediaRootMixin, TestCase):
+    """Test requests are timed and the metrics served"""
+
+    def setUp(self):
+        super().setUp()
+        get_token_cache().clear()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+            user_tier=User.PREMIUM,
+        )
+        self.client.force_authenticate(user=self.user)
+        self.image = UserImage.objects.create(image=create_image_upload(),
+                                              user=self.user)
+
+    def test_sql_timed(self):
+        """Test queries are counted in the header and the metrics"""
+        res = self.client.get(reverse('image-list'))
+
+        timings = server_timing(res)
+        self.assertGreater(int(timings['db']['desc'].strip('"x')), 0)
+        self.assertIn('total', timings)
+        exposed = self.client.get(METRICS_URL).content.decode()
+        self.assertIn('imgapi_request_duration_seconds_count{'
+                      'view="image-list",method="GET",status="200"}',
+                      exposed)
+        self.assertIn('imgapi_sql_queries_total{view="image-list"}',
+                      exposed)
+
+    def test_pipeline_stages_timed(self):
+        """Test rendering a thumbnail reports its Pillow stages"""
+        res = self.client.get(reverse(
+            'image-thumbnail', kwargs={'id': self.image.id, 'height': 200}
+        ))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertLessEqual({'decode', 'resize', 'encode', 'db'},
+                             set(server_timing(res)))
+        exposed = self.client.get(METRICS_URL).content.decode()
+        self.assertIn('imgapi_pipeline_stage_duration_seconds_count{'
+                      'stage="resize"}', exposed)
+
+    async def test_async_view_timed(self):
+        """Test queries run in threads by async views are counted"""
+        token = await Token.objects.acreate(user=self.user)
+
+        res = await AsyncClient().get(reverse('async-image-list'),
+                                      AUTHORIZATION=f'Token {token}')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn('db', server_timing(res))
+
+    @override_settings(METRICS={'TOKEN': 'secret', 'SERVER_TIMING': False})
+    def test_metrics_token_required(self):
+        """Test the metrics need the token when one is set"""
+        res = self.client.get(METRICS_URL)
+        res2 = self.client.get(METRICS_URL,
+                               HTTP_AUTHORIZATION='Bearer secret')
+
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(res2.status_code, status.HTTP_200_OK)
+        self.assertEqual(res2['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertNotIn('Server-Timing', res2)
@@ -1,14 +1,30 @@
 """
 Tests for models
 """
-from django.test import TestCase
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from PIL import Image
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
+from core import locks, pipeline, tasks
+from core.storage import shard_name
 from core.models import (
+    Blob,
     User,
     UserImage,
     ExpiringLink,
+    Thumbnail,
+    ThumbnailJob,
 )
+from core.tests import MediaRootMixin, create_image_upload
 
 
 def create_user(email='test@example.com',
@@ -71,6 +87,22 @@ class ModelTests(TestCase):
 
         self.assertEqual(img.user, user)
 
+    def test_image_metadata_stored(self):
+        """Test uploads store their metadata, thumbnail widths follow"""
+        upload = create_image_upload('test.jpg', size=(800, 600),
+                                     format='JPEG')
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            img = UserImage.objects.create(image=upload, user=create_user())
+        img.refresh_from_db()
+
+        self.assertEqual((img.width, img.height), (800, 600))
+        self.assertEqual(img.format, 'JPEG')
+        self.assertEqual(img.size, upload.size)
+        self.assertEqual(img.orientation, 1)
+        self.assertEqual(img.get_thumbnail_width(300), 400)
+        self.assertEqual(img.get_thumbnail_width(1000), 800)
+
     def test_expiring_link_created(self):
         user = create_user(user_tier=User.ENTERPRISE)
         image = UserImage.objects.create(image="media/media/test/test.png",
@@ -79,3 +111,273 @@ class ModelTests(TestCase):
                                                expires_after=300)
 
         self.assertEqual(exp_link.image.id, image.id)
+        self.assertEqual(exp_link.expires_at,
+                         exp_link.created_on + timezone.timedelta(seconds=300))
+
+    def test_thumbnails_scheduled_rendered_and_reused(self):
+        """Test thumbnails are queued, rendered once and looked up"""
+        user = create_user(user_tier=User.PREMIUM)
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            image = UserImage.objects.create(image=create_image_upload(),
+                                             user=user)
+
+            pending = image.get_thumbnails()
+
+            job = ThumbnailJob.objects.get(image=image)
+            self.assertEqual(job.heights, [200, 400])
+            self.assertEqual([t.status for t in pending],
+                             [Thumbnail.PENDING] * 2)
+
+            tasks.render(image.pk, [200, 400])
+
+            thumbnail = Thumbnail.objects.get(image=image, height=200)
+            self.assertEqual(thumbnail.status, Thumbnail.READY)
+            self.assertEqual((thumbnail.width, thumbnail.format),
+                             (266, 'PNG'))
+            self.assertEqual(thumbnail.size, thumbnail.file.size)
+
+            with patch.object(UserImage, 'schedule_thumbnails') as schedule:
+                ready = image.get_thumbnails()
+            schedule.assert_not_called()
+            self.assertEqual([t.status for t in ready],
+                             [Thumbnail.READY] * 2)
+
+    @override_settings(THUMBNAIL_QUEUE='pool')
+    def test_thumbnails_scheduled_on_pool(self):
+        """Test the pool queue renders after the transaction commits"""
+        user = create_user()
+        image = UserImage.objects.create(image='media/test.png', user=user)
+
+        with patch('core.tasks.schedule') as schedule, \
+                self.captureOnCommitCallbacks(execute=True):
+            image.schedule_thumbnails([200])
+
+        schedule.assert_called_once_with(image.pk, [200])
+        self.assertFalse(ThumbnailJob.objects.exists())
+
+    @override_settings(THUMBNAIL_ENCODER_PROFILES={
+        'standard': {'PNG': {'quantize': 16}},
+        'high': {'PNG': {}},
+    })
+    def test_thumbnails_encoded_with_tier_profile(self):
+        """Test the tier picks the encoder, a new tier re-encodes"""
+        user = create_user(user_tier=User.PREMIUM)
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            image = UserImage.objects.create(image=create_image_upload(),
+                                             user=user)
+            standard = image.get_thumbnail(200)
+            with Image.open(standard.file.path) as img:
+                self.assertEqual(img.mode, 'P')
+
+            user.user_tier = User.ENTERPRISE
+            user.save()
+            image = UserImage.objects.get(pk=image.pk)
+            with patch('core.tasks.enqueue') as enqueue:
+                listed, = image.get_thumbnails([200])
+            high = image.get_thumbnail(200)
+            with Image.open(high.file.path) as img:
+                self.assertEqual(img.mode, 'RGB')
+
+        enqueue.assert_called_once_with(image.pk, [200])
+        self.assertEqual(listed.status, Thumbnail.PENDING)
+        self.assertEqual(standard.profile, 'standard')
+        self.assertEqual(high.pk, standard.pk)
+        self.assertEqual(high.profile, 'high')
+        self.assertNotEqual(high.file.name, standard.file.name)
+
+    @override_settings(THUMBNAIL_ACCESS_INTERVAL=3600)
+    def test_thumbnail_access_recorded_coarsely(self):
+        """Test serving records the access at most once per interval"""
+        user = create_user(user_tier=User.PREMIUM)
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            image = UserImage.objects.create(image=create_image_upload(),
+                                             user=user)
+            rendered = image.get_thumbnail(200)
+            Thumbnail.objects.filter(pk=rendered.pk).update(
+                last_accessed=timezone.now() - timezone.timedelta(hours=2)
+            )
+
+            image.get_thumbnail(200)
+            accessed = Thumbnail.objects.get(pk=rendered.pk).last_accessed
+            with self.assertNumQueries(1):
+                image.get_thumbnail(200)
+
+        self.assertIsNotNone(rendered.last_accessed)
+        self.assertGreater(accessed,
+                           timezone.now() - timezone.timedelta(minutes=1))
+
+    def test_evicted_thumbnail_rendered_on_request(self):
+        """Test an evicted thumbnail is scheduled when listed, served again"""
+        user = create_user(user_tier=User.PREMIUM)
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            image = UserImage.objects.create(image=create_image_upload(),
+                                             user=user)
+            rendered = image.get_thumbnail(200)
+            os.remove(rendered.file.path)
+            Thumbnail.objects.filter(pk=rendered.pk).update(
+                status=Thumbnail.EVICTED, file=''
+            )
+
+            with patch('core.tasks.enqueue') as enqueue:
+                listed = image.get_thumbnails([200])
+            served = image.get_thumbnail(200)
+            self.assertTrue(os.path.exists(served.file.path))
+
+        enqueue.assert_called_once_with(image.pk, [200])
+        self.assertEqual(listed[0].status, Thumbnail.PENDING)
+        self.assertEqual(served.pk, rendered.pk)
+        self.assertEqual(served.status, Thumbnail.READY)
+
+    def test_failed_render_marks_thumbnails_failed(self):
+        """Test thumbnails are marked failed when rendering fails"""
+        user = create_user()
+        image = UserImage.objects.create(image='media/missing.png',
+                                         user=user)
+        image.schedule_thumbnails([200])
+
+        with self.assertLogs('core.tasks', level='ERROR'):
+            tasks.render(image.pk, [200])
+
+        thumbnail = Thumbnail.objects.get(image=image)
+        self.assertEqual(thumbnail.status, Thumbnail.FAILED)
+
+
+class BlobTests(MediaRootMixin, TestCase):
+    """Test uploads are stored once per content"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user(user_tier=User.PREMIUM)
+        self.other = create_user(email='other@example.com',
+                                 user_tier=User.PREMIUM)
+
+    def test_same_content_stored_once(self):
+        """Test images with the same content share one blob"""
+        upload = create_image_upload()
+        content = upload.read()
+
+        image = UserImage.objects.create(image=create_image_upload('a.png'),
+                                         user=self.user)
+        image2 = UserImage.objects.create(image=create_image_upload('b.png'),
+                                          user=self.other)
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(blob.size, len(content))
+        self.assertEqual(image.image.name,
+                         shard_name(f'blobs/{blob.sha256}.png'))
+        self.assertEqual(image2.image.name, image.image.name)
+        self.assertTrue(os.path.exists(image.image.path))
+
+    def test_thumbnails_shared(self):
+        """Test thumbnails are rendered once per content and height"""
+        image = UserImage.objects.create(image=create_image_upload(),
+                                         user=self.user)
+        image2 = UserImage.objects.create(image=create_image_upload(),
+                                          user=self.other)
+
+        thumbnail = image.get_thumbnail(200)
+        with patch('core.pipeline.render_thumbnails') as render:
+            render.return_value = []
+            thumbnail2 = image2.get_thumbnail(200)
+
+        render.assert_not_called()
+        thumbnail_dir = shard_name(f'thumbnails/{image.blob_id}')
+        self.assertEqual(thumbnail.file.name,
+                         f'{thumbnail_dir}/200.standard.png')
+        self.assertEqual(thumbnail2.file.name, thumbnail.file.name)
+        self.assertEqual(thumbnail2.width, thumbnail.width)
+        self.assertNotEqual(thumbnail2.pk, thumbnail.pk)
+
+    def test_concurrent_renders_single_flight(self):
+        """Test a variant requested twice at once is rendered once"""
+        image = UserImage.objects.create(image=create_image_upload(),
+                                         user=self.user)
+        variant_locks = locks.variant_locks
+        render_thumbnails = pipeline.render_thumbnails
+        both_missing = threading.Barrier(2, timeout=5)
+        rendered = []
+        written = {}
+
+        @contextmanager
+        def locks_after_both_checked(names):
+            both_missing.wait()
+            with variant_locks(names):
+                yield
+
+        def render(path, heights):
+            rendered.extend(heights)
+            return render_thumbnails(path, heights)
+
+        def write(name):
+            written[name] = image.write_thumbnails([200, 400],
+                                                   profile='standard')
+
+        with patch('core.locks.variant_locks', locks_after_both_checked), \
+                patch('core.pipeline.render_thumbnails', render):
+            threads = [
+                threading.Thread(target=write, args=(name,))
+                for name in ['first', 'second']
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(sorted(rendered), [200, 400])
+        for (_, first), (_, second) in zip(written['first'],
+                                           written['second']):
+            self.assertEqual((first['file'], first['width'], first['size']),
+                             (second['file'], second['width'],
+                              second['size']))
+        _, files = image.image.storage.listdir(image.blob.thumbnail_dir)
+        self.assertEqual(sorted(files),
+                         ['200.standard.png', '400.standard.png'])
+
+    def test_unused_thumbnail_deleted_with_image(self):
+        """Test thumbnail files go with the last image using them"""
+        image = UserImage.objects.create(image=create_image_upload(),
+                                         user=self.user)
+        image2 = UserImage.objects.create(image=create_image_upload(),
+                                          user=self.other)
+        enterprise = create_user(email='enterprise@example.com',
+                                 user_tier=User.ENTERPRISE)
+        image3 = UserImage.objects.create(image=create_image_upload(),
+                                          user=enterprise)
+        standard = image.get_thumbnail(200)
+        image2.get_thumbnail(200)
+        high = image3.get_thumbnail(200)
+        self.assertNotEqual(high.file.name, standard.file.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            image2.delete()
+            image3.delete()
+
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        self.assertTrue(os.path.exists(standard.file.path))
+        self.assertFalse(os.path.exists(high.file.path))
+
+    def test_blob_deleted_with_last_image(self):
+        """Test the blob and its files outlive all but the last image"""
+        image = UserImage.objects.create(image=create_image_upload(),
+                                         user=self.user)
+        image2 = UserImage.objects.create(image=create_image_upload(),
+                                          user=self.other)
+        thumbnail = image.get_thumbnail(200)
+        path = image.image.path
+
+        with self.captureOnCommitCallbacks(execute=True):
+            image.delete()
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        self.assertTrue(os.path.exists(path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            image2.delete()
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(thumbnail.file.path))
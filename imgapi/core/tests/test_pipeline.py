@@ -0,0 +1,165 @@
+"""
+Tests for the image resize pipeline
+"""
+import io
+import os
+import tempfile
+from unittest import skipIf
+from unittest.mock import patch
+
+from PIL import ExifTags, Image
+
+from django.test import SimpleTestCase
+
+from core import pipeline
+
+
+class RenderThumbnailsTests(SimpleTestCase):
+    """Test rendering thumbnails"""
+
+    def setUp(self):
+        self.image_file = tempfile.NamedTemporaryFile(suffix='.jpg')
+        Image.new('RGB', (3200, 2400)).save(self.image_file, format='JPEG')
+        self.image_file.seek(0)
+
+    def tearDown(self):
+        self.image_file.close()
+
+    def test_render_all_sizes_from_one_decode(self):
+        """Test the original is opened once for every height"""
+        with patch('core.pipeline.Image.open',
+                   side_effect=Image.open) as image_open:
+            thumbnails = pipeline.render_thumbnails(self.image_file.name,
+                                                    [200, 400])
+
+        image_open.assert_called_once()
+        self.assertEqual([(h, img.size) for h, img in thumbnails],
+                         [(400, (533, 400)), (200, (266, 200))])
+
+    def test_jpeg_decoded_at_reduced_scale(self):
+        """Test JPEGs are drafted to cover only the largest height"""
+        with patch.object(Image.Image, 'resize',
+                          autospec=True,
+                          side_effect=Image.Image.resize) as resize:
+            pipeline.render_thumbnails(self.image_file.name, [400])
+
+        source = resize.call_args.args[0]
+        self.assertEqual(source.size, (800, 600))
+
+    def test_thumbnails_never_enlarged(self):
+        """Test heights above the original keep the original size"""
+        thumbnails = pipeline.render_thumbnails(self.image_file.name, [5000])
+
+        self.assertEqual(thumbnails[0][1].size, (3200, 2400))
+
+
+class ExifOrientationTests(SimpleTestCase):
+    """Test images are handled as displayed"""
+
+    def setUp(self):
+        # Stored landscape, displayed portrait
+        self.image_file = tempfile.NamedTemporaryFile(suffix='.jpg')
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = 6
+        Image.new('RGB', (1600, 1200)).save(self.image_file,
+                                            format='JPEG',
+                                            exif=exif)
+        self.image_file.seek(0)
+
+    def tearDown(self):
+        self.image_file.close()
+
+    def test_read_metadata(self):
+        """Test dimensions are read as displayed from the header"""
+        metadata = pipeline.read_metadata(self.image_file)
+
+        self.assertEqual(metadata, {
+            'width': 1200,
+            'height': 1600,
+            'format': 'JPEG',
+            'orientation': 6,
+        })
+        self.assertEqual(self.image_file.tell(), 0)
+
+    def test_thumbnails_transposed(self):
+        """Test thumbnails are rotated and sized as displayed"""
+        thumbnails = pipeline.render_thumbnails(self.image_file.name,
+                                                [400, 200])
+
+        self.assertEqual([(h, img.size) for h, img in thumbnails],
+                         [(400, (300, 400)), (200, (150, 200))])
+        self.assertNotIn(ExifTags.Base.Orientation, thumbnails[0][1].getexif())
+
+
+class SaveThumbnailTests(SimpleTestCase):
+    """Test encoding thumbnails with encoder options"""
+
+    def encode(self, img, img_format, options=None):
+        output = io.BytesIO()
+        pipeline.save_thumbnail(img, output, img_format, options or {})
+        output.seek(0)
+        return Image.open(output)
+
+    def test_metadata_stripped(self):
+        """Test EXIF and comments of the original are not copied"""
+        img = Image.new('RGB', (40, 30))
+        img.info['exif'] = Image.Exif().tobytes()
+        img.info['comment'] = b'camera'
+
+        encoded = self.encode(img, 'JPEG', {'progressive': True,
+                                            'quality': 70})
+
+        self.assertNotIn('exif', encoded.info)
+        self.assertNotIn('comment', encoded.info)
+        self.assertTrue(encoded.info.get('progressive'))
+
+    @skipIf(pipeline.ImageCms is None, 'Pillow built without LittleCMS')
+    def test_icc_profile_kept_unless_srgb(self):
+        """Test wide gamut colour profiles survive, sRGB is implied"""
+        ImageCms = pipeline.ImageCms
+        lab = ImageCms.ImageCmsProfile(ImageCms.createProfile('LAB'))
+        srgb = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB'))
+        img = Image.new('RGB', (40, 30))
+
+        img.info['icc_profile'] = lab.tobytes()
+        kept = self.encode(img, 'JPEG')
+        img.info['icc_profile'] = srgb.tobytes()
+        dropped = self.encode(img, 'PNG')
+
+        self.assertEqual(kept.info.get('icc_profile'), lab.tobytes())
+        self.assertNotIn('icc_profile', dropped.info)
+
+    def test_png_quantized(self):
+        """Test PNGs are reduced to an adaptive palette if configured"""
+        img = Image.effect_noise((40, 30), 64).convert('RGB')
+
+        encoded = self.encode(img, 'PNG', {'quantize': 16})
+
+        self.assertEqual(encoded.mode, 'P')
+        self.assertLessEqual(len(encoded.getcolors()), 16)
+
+
+class WriteThumbnailTests(SimpleTestCase):
+    """Test thumbnails are published atomically"""
+
+    def test_failed_write_keeps_previous_file(self):
+        """Test a failed encode leaves the old file and no temp file"""
+        img = Image.new('RGB', (40, 30))
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/thumbnails/200.png'
+            pipeline.write_thumbnail(img, path, 'PNG', {})
+            with open(path, 'rb') as thumbnail:
+                previous = thumbnail.read()
+
+            def fail(img, fp, img_format, options):
+                fp.write(b'partial')
+                raise OSError('disk full')
+
+            with patch('core.pipeline.save_thumbnail', fail), \
+                    self.assertRaises(OSError):
+                pipeline.write_thumbnail(img, path, 'PNG', {})
+
+            with open(path, 'rb') as thumbnail:
+                self.assertEqual(thumbnail.read(), previous)
+            self.assertEqual(os.listdir(os.path.dirname(path)),
+                             ['200.png'])
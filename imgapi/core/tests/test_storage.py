@@ -0,0 +1,28 @@
+"""
+Tests for file storage
+"""
+from django.test import SimpleTestCase
+
+from core.storage import ShardedFileSystemStorage, shard_name
+
+
+class ShardedStorageTests(SimpleTestCase):
+    """Test spreading files over hashed subdirectories"""
+
+    def test_shard_name(self):
+        """Test names get two hashed directory levels, once"""
+        sharded = shard_name('media/photo.jpg')
+        directory, shard1, shard2, basename = sharded.split('/')
+
+        self.assertEqual((directory, basename), ('media', 'photo.jpg'))
+        self.assertEqual((len(shard1), len(shard2)), (2, 2))
+        self.assertEqual(shard_name(sharded), sharded)
+        self.assertEqual(shard_name('photo.jpg').count('/'), 2)
+
+    def test_generate_filename(self):
+        """Test uploaded names are sharded and cleaned"""
+        storage = ShardedFileSystemStorage()
+
+        name = storage.generate_filename('media/my photo.jpg')
+
+        self.assertEqual(name, shard_name('media/my_photo.jpg'))
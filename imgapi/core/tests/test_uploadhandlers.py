@@ -0,0 +1,131 @@
+"""
+Tests for upload handlers
+"""
+import io
+import os
+from unittest.mock import patch
+
+from PIL import Image
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import UserImage
+from core.tests import MediaRootMixin, create_image_upload
+from core.uploadhandlers import (
+    HashingMixin,
+    ImageSniffer,
+    UploadRejected,
+    UploadTooLarge,
+)
+
+IMG_CREATE_URL = reverse('image-create')
+LIMITS = {'MAX_BYTES': 10 * 1024 * 1024, 'MAX_PIXELS': 1_000_000}
+
+
+class ImageSnifferTests(SimpleTestCase):
+    """Test judging images from their first bytes"""
+
+    def test_image_accepted(self):
+        """Test an image within the limits passes in small chunks"""
+        content = create_image_upload().read()
+        sniffer = ImageSniffer('.png', LIMITS)
+
+        for start in range(0, len(content), 16):
+            sniffer.feed(content[start:start + 16])
+
+        self.assertEqual(sniffer.size, (800, 600))
+
+    def test_wrong_magic_number(self):
+        """Test content not matching the extension is rejected at once"""
+        sniffer = ImageSniffer('.png', LIMITS)
+
+        with self.assertRaises(UploadRejected):
+            sniffer.feed(create_image_upload(format='JPEG').read()[:4])
+
+    def test_unsupported_extension(self):
+        """Test only PNG and JPEG files are accepted"""
+        with self.assertRaises(UploadRejected):
+            ImageSniffer('.gif', LIMITS).feed(b'GIF89a')
+
+    def test_too_many_pixels(self):
+        """Test dimensions over the limit are rejected from the header"""
+        content = create_image_upload(size=(2000, 1000),
+                                      format='JPEG').read()
+        sniffer = ImageSniffer('.jpg', LIMITS)
+
+        with self.assertRaises(UploadTooLarge):
+            sniffer.feed(content[:1024])
+
+    @patch('PIL.Image.MAX_IMAGE_PIXELS', 100_000)
+    def test_decompression_bomb(self):
+        """Test Pillow's decompression bomb threshold is applied"""
+        sniffer = ImageSniffer('.png', LIMITS)
+
+        with self.assertRaises(UploadTooLarge):
+            sniffer.feed(create_image_upload(size=(400, 300)).read())
+
+    def test_too_many_bytes(self):
+        """Test uploads over the byte limit are rejected"""
+        sniffer = ImageSniffer('.png', {'MAX_BYTES': 100,
+                                        'MAX_PIXELS': 1_000_000})
+
+        with self.assertRaises(UploadTooLarge):
+            sniffer.feed(create_image_upload().read())
+
+
+class SniffingUploadHandlerTests(MediaRootMixin, TestCase):
+    """Test uploads are stopped before they are received"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def post_image(self, name, content):
+        return self.client.post(
+            IMG_CREATE_URL,
+            {'image': SimpleUploadedFile(name, content)},
+            format='multipart',
+        )
+
+    def test_image_uploaded(self):
+        """Test acceptable images pass through the handlers"""
+        res = self.post_image('test.png', create_image_upload().read())
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+    def test_wrong_type_rejected(self):
+        """Test a JPEG named .png is refused"""
+        content = create_image_upload(format='JPEG').read()
+        res = self.post_image('test.png', content)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(UserImage.objects.exists())
+
+    @override_settings(TIER_UPLOAD_LIMITS={
+        'B': {'MAX_BYTES': 10 * 1024 * 1024, 'MAX_PIXELS': 100_000},
+    })
+    def test_oversized_rejected_from_first_chunk(self):
+        """Test images over the tier limits are stopped early"""
+        content = os.urandom(1024 * 1024)
+        noise = Image.frombytes('RGB', (1024, 341), content)
+        image_file = io.BytesIO()
+        noise.save(image_file, format='PNG')
+
+        with patch.object(HashingMixin, 'receive_data_chunk') as receive:
+            res = self.post_image('test.png', image_file.getvalue())
+
+        self.assertEqual(res.status_code,
+                         status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        receive.assert_not_called()
+        self.assertFalse(UserImage.objects.exists())
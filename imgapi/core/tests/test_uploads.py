@@ -0,0 +1,184 @@
+"""
+Tests for resumable chunked uploads
+"""
+import hashlib
+import os
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core import uploads
+from core.models import Blob, UploadSession, UserImage
+from core.tests import MediaRootMixin, create_image_upload
+
+UPLOAD_CREATE_URL = reverse('upload-create')
+
+
+def detail_url(session_id):
+    """Create and return an upload session URL"""
+    return reverse('upload-detail', kwargs={'id': session_id})
+
+
+def finalize_url(session_id):
+    """Create and return an upload finalize URL"""
+    return reverse('upload-finalize', kwargs={'id': session_id})
+
+
+class UploadSessionAPITests(MediaRootMixin, TestCase):
+    """Test uploading images in resumable chunks"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='test123',
+        )
+        self.client.force_authenticate(user=self.user)
+        self.content = create_image_upload().read()
+
+    def start(self, content=None):
+        """Start an upload session and return its id"""
+        content = self.content if content is None else content
+        res = self.client.post(UPLOAD_CREATE_URL, {
+            'name': 'Noise',
+            'filename': 'noise.png',
+            'size': len(content),
+        })
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['offset'], 0)
+        return res.data['id']
+
+    def put_chunk(self, session_id, start, end, content=None):
+        """Send bytes start-end of the content"""
+        content = self.content if content is None else content
+        return self.client.put(
+            detail_url(session_id),
+            content[start:end + 1],
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes {start}-{end}/{len(content)}',
+        )
+
+    def test_chunked_upload(self):
+        """Test an upload sent in chunks becomes an image"""
+        session_id = self.start()
+        half = len(self.content) // 2
+
+        res = self.put_chunk(session_id, 0, half - 1)
+        res2 = self.client.head(detail_url(session_id))
+        self.put_chunk(session_id, half, len(self.content) - 1)
+        with patch.object(Blob.objects, 'get_digest',
+                          wraps=Blob.objects.get_digest) as get_digest:
+            res3 = self.client.post(finalize_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['offset'], half)
+        self.assertEqual(res2['Upload-Offset'], str(half))
+        self.assertEqual(res3.status_code, status.HTTP_201_CREATED)
+
+        image = UserImage.objects.get(user=self.user)
+        self.assertEqual(image.name, 'Noise')
+        self.assertEqual(image.blob_id,
+                         hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(get_digest.call_args.args[0].sha256, image.blob_id)
+        with open(image.image.path, 'rb') as stored:
+            self.assertEqual(stored.read(), self.content)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.media_root.name,
+                                                 'uploads')), [])
+
+    def test_chunk_must_continue_upload(self):
+        """Test chunks not starting at the offset are refused"""
+        session_id = self.start()
+        self.put_chunk(session_id, 0, 99)
+
+        res = self.put_chunk(session_id, 50, 149)
+        res2 = self.client.post(finalize_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(res.data['offset'], '100')
+        self.assertEqual(res2.status_code, status.HTTP_409_CONFLICT)
+
+    def test_chunk_beyond_size_rejected(self):
+        """Test Content-Range must fit the declared size"""
+        session_id = self.start()
+
+        res = self.client.put(
+            detail_url(session_id),
+            b'x',
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes 0-0/{len(self.content) + 1}',
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_resumed_on_another_process(self):
+        """Test the part file is rehashed when the hasher is missing"""
+        session_id = self.start()
+        self.put_chunk(session_id, 0, 999)
+        uploads._hashers.clear()
+        self.put_chunk(session_id, 1000, len(self.content) - 1)
+
+        res = self.client.post(finalize_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(UserImage.objects.get().blob_id,
+                         hashlib.sha256(self.content).hexdigest())
+
+    def test_invalid_image_discarded(self):
+        """Test an upload that is not an image is rejected and removed"""
+        content = b'\x89PNG\r\n\x1a\n' + b'not an image' * 10
+        session_id = self.start(content)
+        self.put_chunk(session_id, 0, len(content) - 1, content)
+
+        res = self.client.post(finalize_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(UserImage.objects.exists())
+
+    def test_other_users_session_not_found(self):
+        """Test sessions are private to their user"""
+        session_id = self.start()
+        other = get_user_model().objects.create_user(
+            email='other@example.com',
+            password='test123',
+        )
+        self.client.force_authenticate(user=other)
+
+        res = self.put_chunk(session_id, 0, 99)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_expired_session_purged(self):
+        """Test abandoned uploads are purged with their part file"""
+        session_id = self.start()
+        self.put_chunk(session_id, 0, 99)
+        session = UploadSession.objects.get(pk=session_id)
+        session.expires_at = timezone.now()
+        session.save()
+
+        res = self.put_chunk(session_id, 100, 199)
+        call_command('purge_expired_links', stdout=StringIO())
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(uploads.get_part_path(session)))
+
+    def test_wrong_type_rejected_from_first_chunk(self):
+        """Test the header is checked before the rest is sent"""
+        session_id = self.start()
+        content = b'GIF89a' + self.content[6:]
+
+        res = self.put_chunk(session_id, 0, 999, content)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(UploadSession.objects.exists())
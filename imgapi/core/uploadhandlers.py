@@ -0,0 +1,181 @@
+"""
+Upload handlers
+"""
+import hashlib
+import io
+import os
+import warnings
+
+from PIL import Image
+
+from django.conf import settings
+from django.core.files.uploadhandler import (
+    FileUploadHandler,
+    MemoryFileUploadHandler,
+    SkipFile,
+    StopUpload,
+    TemporaryFileUploadHandler,
+)
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+# Headers are expected within this many bytes, JPEG EXIF can be large
+SNIFF_LIMIT = 256 * 1024
+
+MAGIC_NUMBERS = {
+    '.png': (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    '.jpg': (b'\xff\xd8\xff', 'JPEG'),
+}
+
+
+class UploadRejected(APIException):
+    """Raised when an upload is not an acceptable image"""
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = 'Upload is not an acceptable image.'
+    default_code = 'upload_rejected'
+
+
+class UploadTooLarge(UploadRejected):
+    """Raised when an upload exceeds the user's limits"""
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Upload exceeds the size limits.'
+    default_code = 'upload_too_large'
+
+
+def get_upload_limits(user):
+    """Get the upload limits of a user's tier"""
+    tier = getattr(user, 'user_tier', None)
+    return settings.TIER_UPLOAD_LIMITS.get(
+        tier, settings.TIER_UPLOAD_LIMITS['B']
+    )
+
+
+class ImageSniffer:
+    """
+    Judge an upload from its first bytes: the magic number must match
+    the extension and the dimensions in the header must be within the
+    limits. Only the header is parsed, nothing is decoded.
+    """
+    def __init__(self, extension, limits):
+        self.magic, self.format = MAGIC_NUMBERS.get(extension.lower(),
+                                                    (None, None))
+        self.limits = limits
+        self.head = b''
+        self.received = 0
+        self.size = None
+
+    @property
+    def max_pixels(self):
+        if Image.MAX_IMAGE_PIXELS is None:
+            return self.limits['MAX_PIXELS']
+        return min(self.limits['MAX_PIXELS'], Image.MAX_IMAGE_PIXELS)
+
+    def feed(self, data):
+        """Check the next bytes, raising UploadRejected"""
+        self.received += len(data)
+        if self.received > self.limits['MAX_BYTES']:
+            raise UploadTooLarge(
+                f'Uploads are limited to {self.limits["MAX_BYTES"]} bytes.'
+            )
+        if self.size is not None:
+            return
+        if self.magic is None:
+            raise UploadRejected('Unsupported file type.')
+
+        self.head += data[:SNIFF_LIMIT - len(self.head)]
+        if not self.head.startswith(self.magic[:len(self.head)]):
+            raise UploadRejected('File content does not match its type.')
+
+        self.size = self.read_size()
+        if self.size is None:
+            if len(self.head) >= SNIFF_LIMIT:
+                raise UploadRejected('Image header could not be read.')
+            return
+
+        width, height = self.size
+        if width * height > self.max_pixels:
+            raise UploadTooLarge(
+                f'Images are limited to {self.max_pixels} pixels.'
+            )
+        self.head = b''
+
+    def read_size(self):
+        """Get the dimensions once the whole header was received"""
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', Image.DecompressionBombWarning)
+            try:
+                with Image.open(io.BytesIO(self.head),
+                                formats=[self.format]) as img:
+                    return img.size
+            except (Image.DecompressionBombWarning,
+                    Image.DecompressionBombError):
+                raise UploadTooLarge(
+                    f'Images are limited to {self.max_pixels} pixels.'
+                )
+            except (OSError, SyntaxError, ValueError, EOFError):
+                # Incomplete header
+                return None
+
+
+class SniffingUploadHandler(FileUploadHandler):
+    """
+    Stop receiving an upload as soon as its first chunks show it will be
+    rejected, see ImageSniffer. Must come first in FILE_UPLOAD_HANDLERS.
+    The reason is kept as request.upload_error for the view to raise.
+    Views receiving many files set request.upload_rejections to a list
+    first, a rejected file is then skipped and recorded there.
+    """
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self.sniffer = ImageSniffer(os.path.splitext(file_name)[1],
+                                    get_upload_limits(self.request.user))
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            self.sniffer.feed(raw_data)
+        except UploadRejected as exc:
+            rejections = getattr(self.request, 'upload_rejections', None)
+            if rejections is not None:
+                rejections.append((self.file_name, exc))
+                raise SkipFile()
+            self.request.upload_error = exc
+            # Leave the rest of the body unread
+            raise StopUpload(connection_reset=True)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+class HashingMixin:
+    """
+    Compute the SHA-256 of an upload while it is received and set it as
+    `sha256` on the uploaded file, so storing it needs no second read.
+    Only the handler that keeps the data hashes it.
+    """
+    def new_file(self, *args, **kwargs):
+        # Set first, the memory handler stops the chain in new_file
+        self.hasher = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super().receive_data_chunk(raw_data, start)
+        if data is None:
+            self.hasher.update(raw_data)
+        return data
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.hasher.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingMixin, MemoryFileUploadHandler):
+    """Keep small uploads in memory, hashing them"""
+
+
+class HashingTemporaryFileUploadHandler(HashingMixin,
+                                        TemporaryFileUploadHandler):
+    """Stream large uploads to a temporary file, hashing them"""
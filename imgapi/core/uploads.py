@@ -0,0 +1,176 @@
+"""
+Resumable chunked uploads.
+
+Each session appends the bytes it receives to a part file in media
+storage, and the length of that file is the session's offset. Only one
+request can write a session at a time. The SHA-256 of the received
+bytes is kept per process. If a chunk reaches a different process, the
+part file is hashed again from disk. On finalize the part file is
+renamed into storage, so the data is not copied or read again.
+"""
+import fcntl
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError
+
+from core.uploadhandlers import ImageSniffer, SNIFF_LIMIT, get_upload_limits
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+READ_SIZE = 64 * 1024
+MAX_HASHERS = 1024
+
+
+class UploadConflict(APIException):
+    """Raised when a chunk does not continue the upload"""
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Chunk does not start at the upload offset.'
+    default_code = 'upload_conflict'
+
+
+class SessionFile(UploadedFile):
+    """
+    The part file of a complete session. Storages move files exposing
+    temporary_file_path instead of copying them.
+    """
+    def __init__(self, path, name, size, sha256):
+        super().__init__(open(path, 'rb'), name, None, size)
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.file.name
+
+    def close(self):
+        try:
+            return self.file.close()
+        except FileNotFoundError:
+            # Moved into storage already
+            pass
+
+
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+def get_hasher(session, offset):
+    """
+    Get the hasher of the first `offset` bytes of a session, rehashing
+    the part file when this process did not receive them
+    """
+    with _hashers_lock:
+        hashed_offset, hasher = _hashers.pop(session.pk, (None, None))
+    if hashed_offset == offset:
+        return hasher
+
+    hasher = hashlib.sha256()
+    with open(get_part_path(session), 'rb') as part:
+        remaining = offset
+        while remaining:
+            chunk = part.read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
+
+
+def keep_hasher(session, offset, hasher):
+    with _hashers_lock:
+        _hashers[session.pk] = (offset, hasher)
+        while len(_hashers) > MAX_HASHERS:
+            _hashers.popitem(last=False)
+
+
+def get_part_path(session):
+    return default_storage.path(session.part_name)
+
+
+def create_part(session):
+    """Create the empty part file of a new session"""
+    path = get_part_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'xb').close()
+
+
+def get_offset(session):
+    """Get the number of bytes received so far"""
+    try:
+        return os.path.getsize(get_part_path(session))
+    except FileNotFoundError:
+        return 0
+
+
+def parse_content_range(header, size):
+    """Parse 'bytes start-end/total' into (start, length)"""
+    match = CONTENT_RANGE_RE.match(header or '')
+    if match is None:
+        raise ParseError('Content-Range must be bytes start-end/total.')
+
+    start, end, total = (int(value) for value in match.groups())
+    if total != size or start > end or end >= size:
+        raise ParseError('Content-Range does not fit the upload size.')
+
+    return start, end - start + 1
+
+
+def append_chunk(session, stream, start, length):
+    """
+    Append `length` bytes read from stream at offset `start`, returning
+    the new offset. Bytes received before a dropped connection are kept
+    and the client resumes after them.
+    """
+    with open(get_part_path(session), 'ab') as part:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadConflict('Another chunk is being received.')
+
+        offset = os.fstat(part.fileno()).st_size
+        if start != offset:
+            raise UploadConflict({
+                'detail': UploadConflict.default_detail,
+                'offset': offset,
+            })
+
+        hasher = get_hasher(session, offset)
+        remaining = length
+        try:
+            while remaining:
+                chunk = stream.read(min(READ_SIZE, remaining))
+                if not chunk:
+                    break
+                part.write(chunk)
+                hasher.update(chunk)
+                remaining -= len(chunk)
+        finally:
+            part.flush()
+            keep_hasher(session, offset + length - remaining, hasher)
+
+    return offset + length - remaining
+
+
+def check_head(session, user):
+    """
+    Check the start of the part file like uploads sent in one request,
+    raising UploadRejected. Passes until the header was received.
+    """
+    sniffer = ImageSniffer(os.path.splitext(session.filename)[1],
+                           get_upload_limits(user))
+    with open(get_part_path(session), 'rb') as part:
+        sniffer.feed(part.read(SNIFF_LIMIT))
+
+
+def complete(session):
+    """Get the received upload as a file to store, with its SHA-256"""
+    digest = get_hasher(session, session.size).hexdigest()
+    return SessionFile(get_part_path(session),
+                       session.filename,
+                       session.size,
+                       digest)
@@ -1,22 +1,47 @@
 """
 Views
 """
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.signing import BadSignature
+from django.db import transaction
+from django.http import FileResponse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema
 
 from rest_framework import generics, status
+from rest_framework.views import APIView
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.settings import api_settings
 from rest_framework.response import Response
+from rest_framework.exceptions import NotFound, ParseError, ValidationError
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.parsers import MultiPartParser
 
 from core.models import (
     UserImage,
-    ExpiringLink
+    ExpiringLink,
+    UploadSession,
 )
 
-from . import serializers
+from . import (
+    batch,
+    encoders,
+    formats,
+    list_cache,
+    sendfile,
+    serializers,
+    signed_links,
+    uploadhandlers,
+    uploads,
+)
+from .authentication import CachedTokenAuthentication
+from .link_cache import ResolvedLink, get_link_cache
+from .pagination import KeysetPagination
 from .permissions import ExpiringLinkAllowed
 
 
@@ -29,12 +54,103 @@ class CreateTokenView(ObtainAuthToken):
 class UserImageListView(generics.ListAPIView):
     """List images"""
     serializer_class = serializers.UserImageListSerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         """Restrict list to the authenticated user"""
-        return UserImage.objects.filter(user=self.request.user).order_by('-when_created')
+        return UserImage.objects.filter(
+            user=self.request.user
+        ).only(
+            'id', 'name', 'image', 'width', 'height', 'when_created'
+        ).prefetch_related('thumbnails')
+
+    def list(self, request, *args, **kwargs):
+        """Serve the page from the list cache, building it on a miss"""
+        key = list_cache.get_key(request.user.pk,
+                                 request.build_absolute_uri())
+        data = list_cache.get_page(key)
+        if data is not None:
+            return Response(data)
+
+        response = super().list(request, *args, **kwargs)
+        list_cache.set_page(key, response.data)
+        return response
+
+    def get_serializer_context(self):
+        """Resolve the user's tier once for the whole page"""
+        context = super().get_serializer_context()
+        context['thumbnail_heights'] = self.request.user.thumbnail_heights
+        context['encoder_profile'] = encoders.get_profile(self.request.user)
+        context['original_link'] = self.request.user.has_original_link
+
+        return context
+
+
+class UserImageThumbnailView(generics.RetrieveAPIView):
+    """Serve a thumbnail, rendering it on the first request"""
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    lookup_field = 'id'
+
+    def get_queryset(self):
+        """Restrict to the authenticated user's images"""
+        return UserImage.objects.filter(user=self.request.user)
+
+    def perform_content_negotiation(self, request, force=False):
+        """Serve image bytes whatever the client accepts"""
+        return super().perform_content_negotiation(request, force=True)
+
+    @extend_schema(responses={200: OpenApiTypes.BINARY, 304: None})
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        height = kwargs['height']
+        if height not in request.user.thumbnail_heights:
+            raise NotFound()
+
+        image = self.get_object()
+        thumbnail = image.get_thumbnail(
+            height,
+            formats.negotiate(request, image.image_format),
+            encoders.get_profile(request.user),
+        )
+        return thumbnail_response(request, thumbnail)
+
+
+def thumbnail_response(request, thumbnail):
+    """
+    Serve a thumbnail, or 304 if the client's copy is current. The
+    format depends on the Accept header, see core.formats.
+    """
+    headers = {
+        'ETag': thumbnail.etag,
+        'Last-Modified': http_date(thumbnail.when_created.timestamp()),
+        'Cache-Control': settings.THUMBNAIL_CACHE_CONTROL,
+    }
+
+    response = get_conditional_response(
+        request,
+        etag=thumbnail.etag,
+        last_modified=int(thumbnail.when_created.timestamp()),
+    )
+    if response is None:
+        response = FileResponse(thumbnail.file.open('rb'),
+                                content_type=thumbnail.content_type)
+    for header, value in headers.items():
+        response.headers[header] = value
+    patch_vary_headers(response, ['Accept'])
+
+    return response
+
+
+def vary_thumbnail(response, height):
+    """Mark a served link as negotiated when it is a thumbnail"""
+    if height is not None:
+        patch_vary_headers(response, ['Accept'])
+    return response
 
 
 class UserImageCreateView(generics.CreateAPIView):
@@ -42,44 +158,284 @@ class UserImageCreateView(generics.CreateAPIView):
     queryset = UserImage.objects.all()
     serializer_class = serializers.UserImageCreateSerializer
     parser_classes = [MultiPartParser]
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def create(self, request, *args, **kwargs):
+        # Parse first, the upload handlers may have stopped the upload
+        request.data
+        error = getattr(request._request, 'upload_error', None)
+        if error is not None:
+            raise error
+        return super().create(request, *args, **kwargs)
+
+
+class UserImageBatchView(generics.GenericAPIView):
+    """
+    Create many images from one request. Every file gets a result, the
+    response is 201 if all were created, 207 if only some were.
+    """
+    serializer_class = serializers.UserImageBatchSerializer
+    parser_classes = [MultiPartParser]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
+    @extend_schema(responses={201: OpenApiTypes.OBJECT,
+                              207: OpenApiTypes.OBJECT})
+    def post(self, request, *args, **kwargs):
+        # Skip files the upload handlers reject instead of stopping
+        request._request.upload_rejections = []
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        files = serializer.validated_data.get('images', [])
+        rejections = request._request.upload_rejections
+        count = len(files) + len(rejections)
+        if not 0 < count <= settings.BATCH_UPLOAD_MAX_FILES:
+            raise ValidationError({'images': [
+                f'Send between 1 and {settings.BATCH_UPLOAD_MAX_FILES} '
+                f'files.'
+            ]})
+
+        results = [
+            {
+                'file': name,
+                'status': exc.status_code,
+                'errors': [exc.detail],
+            }
+            for name, exc in rejections
+        ]
+        results += batch.create_images(request.user, files)
+
+        created = sum(result['status'] == status.HTTP_201_CREATED
+                      for result in results)
+        if created == len(results):
+            response_status = status.HTTP_201_CREATED
+        elif created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+
+        return Response({'results': results}, status=response_status)
+
 
 class ExpiringLinkListView(generics.ListAPIView):
     """List expiring links"""
     serializer_class = serializers.ExpiringLinkListSerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated, ExpiringLinkAllowed]
 
     def get_queryset(self):
-        """Restrict only to the registered user"""
-        return ExpiringLink.objects.filter(image__user=self.request.user)
+        """Restrict only to the registered user's live links"""
+        return ExpiringLink.objects.live().filter(
+            image__user=self.request.user
+        )
 
 
 class ExpiringLinkCreateView(generics.CreateAPIView):
     """Create expiring link"""
     queryset = ExpiringLink.objects.all()
     serializer_class = serializers.ExpiringLinkCreateSerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated, ExpiringLinkAllowed]
 
 
 class ExpiringLinkDetailView(generics.RetrieveAPIView):
-    """Retrieve an instance"""
-    queryset = ExpiringLink.objects.all()
+    """Serve the image of an expiring link"""
     serializer_class = serializers.ExpiringLinkDetailSerializer
     lookup_field = 'id'
 
+    def get_queryset(self):
+        """Expired links are left to purge_expired_links"""
+        return ExpiringLink.objects.live().select_related('image__user')
+
+    def perform_content_negotiation(self, request, force=False):
+        """Serve image bytes whatever the client accepts"""
+        return super().perform_content_negotiation(request, force=True)
+
+    @extend_schema(responses={200: OpenApiTypes.BINARY})
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
     def retrieve(self, request, *args, **kwargs):
+        # None serves the original's format, known once the link is read
+        img_format = formats.negotiate(request, None)
+        link = get_link_cache().get_or_resolve(
+            (self.kwargs[self.lookup_field], img_format),
+            lambda: self.resolve(img_format),
+        )
+        remaining = link.expires_at - timezone.now()
+
+        response = sendfile.serve_file(
+            request,
+            link.name,
+            max_age=int(remaining.total_seconds()),
+            content_type=formats.get_mime_type(link.name),
+        )
+        return vary_thumbnail(response, link.height)
+
+    def resolve(self, img_format):
+        """Read the link, rendering its thumbnail if missing"""
         instance = self.get_object()
-        serializer = self.get_serializer(instance)
+        return ResolvedLink(
+            instance.image.get_variant_name(instance.height,
+                                            img_format=img_format),
+            instance.height,
+            instance.expires_at,
+        )
+
+
+class ExpiringLinkSignedView(APIView):
+    """Serve the image of a signed expiring link"""
+    authentication_classes = []
+    permission_classes = []
+
+    def perform_content_negotiation(self, request, force=False):
+        """Serve image bytes whatever the client accepts"""
+        return super().perform_content_negotiation(request, force=True)
+
+    @extend_schema(responses={200: OpenApiTypes.BINARY})
+    def get(self, request, token):
+        try:
+            link = signed_links.verify_link(token)
+        except (BadSignature, signed_links.LinkExpired):
+            raise NotFound()
+
+        # Served straight from the token while the file is on disk
+        stub = UserImage(image=link.name, blob_id=link.blob_id)
+        img_format = formats.negotiate(request, stub.image_format)
+        name = stub.get_variant_name(
+            link.height,
+            render=False,
+            img_format=img_format,
+            profile=link.profile or encoders.DEFAULT_PROFILE,
+        )
+        if not default_storage.exists(name):
+            try:
+                image = UserImage.objects.get(pk=link.image_id)
+            except UserImage.DoesNotExist:
+                # Deleted before this process reloaded its revocations
+                raise NotFound()
+            name = image.get_variant_name(link.height, img_format=img_format)
+
+        remaining = link.expires_at - timezone.now()
+        response = sendfile.serve_file(
+            request,
+            name,
+            max_age=int(remaining.total_seconds()),
+            content_type=formats.get_mime_type(name),
+        )
+        return vary_thumbnail(response, link.height)
+
+
+class ExpiringLinkRevokeView(generics.GenericAPIView):
+    """Revoke an expiring link before it expires"""
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated, ExpiringLinkAllowed]
+    lookup_field = 'id'
+
+    def get_queryset(self):
+        """Restrict only to the registered user's live links"""
+        return ExpiringLink.objects.live().filter(
+            image__user=self.request.user
+        )
+
+    @extend_schema(request=None, responses={204: None})
+    def post(self, request, *args, **kwargs):
+        self.get_object().delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadSessionCreateView(generics.CreateAPIView):
+    """Start a resumable upload"""
+    queryset = UploadSession.objects.all()
+    serializer_class = serializers.UploadSessionSerializer
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+
+class UploadSessionDetailView(generics.RetrieveAPIView):
+    """Get the offset of a resumable upload, or send the next chunk"""
+    serializer_class = serializers.UploadSessionSerializer
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    lookup_field = 'id'
+
+    def get_queryset(self):
+        """Restrict to the authenticated user's unexpired uploads"""
+        return UploadSession.objects.live().filter(user=self.request.user)
+
+    def retrieve(self, request, *args, **kwargs):
+        response = super().retrieve(request, *args, **kwargs)
+        # Answers HEAD requests too
+        response.headers['Upload-Offset'] = response.data['offset']
+        return response
+
+    @extend_schema(
+        request={'application/octet-stream': OpenApiTypes.BINARY},
+        parameters=[OpenApiParameter(
+            'Content-Range',
+            location=OpenApiParameter.HEADER,
+            required=True,
+            description='bytes start-end/size, start is the offset',
+        )],
+    )
+    def put(self, request, *args, **kwargs):
+        session = self.get_object()
+        start, length = uploads.parse_content_range(
+            request.headers.get('Content-Range'),
+            session.size,
+        )
+        if request.headers.get('Content-Length') != str(length):
+            raise ParseError('Content-Length must match Content-Range.')
+
+        # The body is streamed to the part file, never parsed
+        uploads.append_chunk(session, request.stream, start, length)
+        if start < uploadhandlers.SNIFF_LIMIT:
+            try:
+                uploads.check_head(session, request.user)
+            except uploadhandlers.UploadRejected:
+                session.delete()
+                raise
+
+        return self.retrieve(request, *args, **kwargs)
+
+
+class UploadSessionFinalizeView(generics.GenericAPIView):
+    """Create the image of a complete resumable upload"""
+    serializer_class = serializers.UserImageCreateSerializer
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    lookup_field = 'id'
+
+    def get_queryset(self):
+        """Finalize each upload once"""
+        return UploadSession.objects.live().filter(
+            user=self.request.user
+        ).select_for_update()
 
-        current_time = timezone.now()
-        expiration_time = instance.created_on + timezone.timedelta(seconds=instance.expires_after)
+    @extend_schema(request=None,
+                   responses={201: serializers.UserImageCreateSerializer})
+    def post(self, request, *args, **kwargs):
+        with transaction.atomic():
+            session = self.get_object()
+            if uploads.get_offset(session) != session.size:
+                raise uploads.UploadConflict('Upload is not complete.')
 
-        if current_time > expiration_time:
-            instance.delete()
-            return Response(status=status.HTTP_204_NO_CONTENT)
+            upload = uploads.complete(session)
+            serializer = self.get_serializer(data={
+                'name': session.name,
+                'image': upload,
+            })
+            valid = serializer.is_valid()
+            try:
+                if valid:
+                    serializer.save()
+            finally:
+                upload.close()
+            # Invalid bytes will never make a valid image either
+            session.delete()
 
-        return Response(serializer.data)
+        if not valid:
+            raise ValidationError(serializer.errors)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
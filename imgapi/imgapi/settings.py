@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,6 +92,29 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# 'shared' is seen by every process using the same SHARED_CACHE_DIR,
+# like the app and the process_thumbnails worker. Point it at a volume
+# both mount when they run in separate containers. Tests use per-process
+# caches instead, see core.test_runner.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get(
+            'SHARED_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'imgapi-cache'),
+        ),
+    },
+}
+
+TEST_RUNNER = 'core.test_runner.TestRunner'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -128,6 +153,130 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 STATIC_URL='/static/'
 
+# Media is spread over hashed subdirectories, see core.storage
+DEFAULT_FILE_STORAGE = 'core.storage.ShardedFileSystemStorage'
+
+# Upload limits per user tier, in bytes and in pixels (width x height).
+# Images above Pillow's decompression bomb threshold are always refused.
+TIER_UPLOAD_LIMITS = {
+    'B': {'MAX_BYTES': 10 * 1024 * 1024, 'MAX_PIXELS': 25_000_000},
+    'P': {'MAX_BYTES': 25 * 1024 * 1024, 'MAX_PIXELS': 50_000_000},
+    'E': {'MAX_BYTES': 100 * 1024 * 1024, 'MAX_PIXELS': 80_000_000},
+    'C': {'MAX_BYTES': 25 * 1024 * 1024, 'MAX_PIXELS': 50_000_000},
+}
+
+# Uploads are checked from their first chunks and hashed while
+# received, see core.uploadhandlers and core.models.Blob
+FILE_UPLOAD_HANDLERS = [
+    'core.uploadhandlers.SniffingUploadHandler',
+    'core.uploadhandlers.HashingMemoryFileUploadHandler',
+    'core.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+
+# Batch uploads take at most this many files, validated and stored on
+# this many threads per request
+BATCH_UPLOAD_MAX_FILES = 100
+BATCH_UPLOAD_WORKERS = 4
+
+# Thumbnails
+# Uploads queue thumbnail rendering. With 'database' the jobs are stored
+# and rendered by `manage.py process_thumbnails` workers, with 'pool'
+# they are rendered on a bounded thread pool in the web process.
+
+THUMBNAIL_QUEUE = os.environ.get('THUMBNAIL_QUEUE', 'database')
+
+# A running job is handed to another worker after this many seconds,
+# failed jobs are retried with a doubling delay and dead-lettered
+# after the last attempt.
+THUMBNAIL_JOB_TIMEOUT = 300
+THUMBNAIL_JOB_MAX_ATTEMPTS = 5
+THUMBNAIL_JOB_RETRY_DELAY = 10
+
+# Pool size. When all workers are busy and the queue is full, 'block'
+# waits for a free slot, 'inline' renders in the request and 'reject'
+# answers 503.
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+THUMBNAIL_QUEUE_SIZE = int(os.environ.get('THUMBNAIL_QUEUE_SIZE', 64))
+THUMBNAIL_QUEUE_FULL = os.environ.get('THUMBNAIL_QUEUE_FULL', 'block')
+
+# Formats thumbnails are also offered in, by preference. Clients listing
+# one in their Accept header get it, others get the original's format.
+# AVIF is skipped unless the installed Pillow can write it.
+THUMBNAIL_FORMATS = ['AVIF', 'WEBP']
+
+# Thumbnail encoder options per output format, in named profiles picked
+# per user tier, see core.encoders. Options are passed to Pillow, except
+# `quantize`, the colours of the adaptive palette PNGs are reduced to.
+# EXIF and comments are stripped, ICC profiles other than sRGB are kept.
+# Thumbnails are named after their profile: after changing a profile,
+# rename it to re-encode its thumbnails.
+THUMBNAIL_ENCODER_PROFILES = {
+    'standard': {
+        'JPEG': {'quality': 80, 'optimize': True, 'progressive': True},
+        'PNG': {'optimize': True, 'quantize': 256},
+        'WEBP': {'quality': 80, 'method': 4},
+        'AVIF': {'quality': 60, 'speed': 6},
+    },
+    'high': {
+        'JPEG': {'quality': 90, 'optimize': True, 'progressive': True,
+                 'subsampling': 0},
+        'PNG': {'optimize': True},
+        'WEBP': {'quality': 90, 'method': 4},
+        'AVIF': {'quality': 75, 'speed': 6},
+    },
+}
+TIER_ENCODER_PROFILES = {
+    'B': 'standard',
+    'P': 'standard',
+    'E': 'high',
+    'C': 'high',
+}
+
+# Each thumbnail variant is rendered by one worker at a time, others
+# wait and reuse it. Variants are hashed onto this many lock files
+# under MEDIA_ROOT, see core.locks.
+THUMBNAIL_LOCK_STRIPES = 1024
+
+# Bytes of thumbnail files kept on disk, None for no limit. Run
+# `manage.py sweep_thumbnails` periodically to evict the least recently
+# served files down to the quota, they are rendered again on request.
+# Accesses are recorded at most once per interval (seconds) per
+# thumbnail.
+THUMBNAIL_CACHE_QUOTA = None
+THUMBNAIL_ACCESS_INTERVAL = 3600
+
+# Served thumbnails never change under the same ETag
+THUMBNAIL_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Files served through expiring links. Behind nginx set 'nginx' and map
+# SENDFILE_URL to MEDIA_ROOT in an internal location, behind Apache with
+# mod_xsendfile set 'apache'. Otherwise the WSGI server sends the file.
+
+SENDFILE_BACKEND = os.environ.get('SENDFILE_BACKEND', '')
+SENDFILE_URL = '/protected/'
+
+# Expiring links
+# Signed links carry the image, variant and expiry in the URL and are
+# verified with an HMAC keyed by SECRET_KEY instead of a database read.
+# Revocations reach every process within the refresh interval (seconds).
+
+EXPIRING_LINK_SIGNED = bool(int(os.environ.get('EXPIRING_LINK_SIGNED', 0)))
+EXPIRING_LINK_REVOCATION_REFRESH = 60
+
+# Resolved expiring links are kept in an in-process LRU for TTL seconds,
+# never past their expiry, so a viral link costs about one query per
+# second per process. Deleted links are dropped from the deleting
+# process at once and from the others within the TTL.
+EXPIRING_LINK_CACHE = {
+    'SIZE': 4096,
+    'TTL': 1,
+}
+
+# Resumable uploads
+# Sessions not finalized within UPLOAD_SESSION_TTL seconds are removed
+# by `manage.py purge_expired_links`. Sizes are limited per tier.
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -135,6 +284,36 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = 'core.User'
 
+# Resolved API tokens are kept in an in-process LRU for TTL seconds.
+# Logging out, a password change, deactivation or a new tier only drop
+# the entry of the process handling it: other processes keep accepting
+# the old token or user for up to TTL seconds. Set CACHE to a Django
+# cache alias shared by all processes to keep entries only there, so
+# changes apply everywhere at once.
+AUTH_TOKEN_CACHE = {
+    'SIZE': 1024,
+    'TTL': 60,
+    'CACHE': None,
+}
+
+# Image list pages are cached per user until an image, thumbnail or the
+# user's tier changes, see core.list_cache. CACHE must be shared by every
+# process changing images, the worker and management commands included,
+# or their changes are listed only after TTL seconds. None disables.
+IMAGE_LIST_CACHE = {
+    'CACHE': 'shared',
+    'TTL': 300,
+}
+
+# Request, SQL and thumbnail pipeline timings are served at /metrics
+# in the Prometheus text format, see core.metrics. With TOKEN set the
+# scraper must send it as a bearer token. SERVER_TIMING echoes the
+# timings of each request in a Server-Timing response header.
+METRICS = {
+    'TOKEN': os.environ.get('METRICS_TOKEN', ''),
+    'SERVER_TIMING': True,
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
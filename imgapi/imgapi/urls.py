@@ -21,7 +21,7 @@ from django.conf.urls.static import static
 
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 
-from core import views
+from core import async_views, metrics, views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -31,13 +31,20 @@ urlpatterns = [
     path('api/docs/',
          SpectacularSwaggerView.as_view(url_name='api-schema'),
          name='api-docs'),
+    path('metrics', metrics.metrics_view, name='metrics'),
     path('token/', views.CreateTokenView.as_view(), name='token'),
     path('image/',
          views.UserImageListView.as_view(),
          name='image-list'),
+    path('image/<uuid:id>/thumbnail/<int:height>',
+         views.UserImageThumbnailView.as_view(),
+         name='image-thumbnail'),
     path('image/create',
          views.UserImageCreateView.as_view(),
          name='image-create'),
+    path('image/batch',
+         views.UserImageBatchView.as_view(),
+         name='image-batch'),
     path('expiring-link/',
          views.ExpiringLinkListView.as_view(),
          name='expiring-link-list'),
@@ -47,4 +54,28 @@ urlpatterns = [
     path('expiring-link/<uuid:id>',
          views.ExpiringLinkDetailView.as_view(),
          name='expiring-link-detail'),
+    path('expiring-link/<uuid:id>/revoke',
+         views.ExpiringLinkRevokeView.as_view(),
+         name='expiring-link-revoke'),
+    path('expiring-link/s/<str:token>',
+         views.ExpiringLinkSignedView.as_view(),
+         name='expiring-link-signed'),
+    path('upload/create',
+         views.UploadSessionCreateView.as_view(),
+         name='upload-create'),
+    path('upload/<uuid:id>',
+         views.UploadSessionDetailView.as_view(),
+         name='upload-detail'),
+    path('upload/<uuid:id>/finalize',
+         views.UploadSessionFinalizeView.as_view(),
+         name='upload-finalize'),
+    path('async/image/',
+         async_views.AsyncUserImageListView.as_view(),
+         name='async-image-list'),
+    path('async/image/<uuid:id>/thumbnail/<int:height>',
+         async_views.AsyncUserImageThumbnailView.as_view(),
+         name='async-image-thumbnail'),
+    path('async/expiring-link/<uuid:id>',
+         async_views.AsyncExpiringLinkDetailView.as_view(),
+         name='async-expiring-link-detail'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)